@@ -0,0 +1,62 @@
+"""
+Caching helpers for the photometry calcfunctions.
+
+FitsData nodes hash by file content and curated header, so with caching
+enabled a rerun of a pipeline, or a parameter sweep, reuses every
+calcfunction whose inputs did not change.
+"""
+from contextlib import contextmanager
+
+from aiida.manage.caching import enable_caching, get_use_cache
+from aiida.orm import CalcFunctionNode
+
+from aiida_photometry import calcfunctions
+
+CALCFUNCTION_PREFIX = "aiida_photometry.calcfunctions"
+
+
+def photometry_calcfunctions():
+    """
+    Return {name: calcfunction} for everything exported by the calcfunctions package.
+    """
+    return {name: getattr(calcfunctions, name) for name in calcfunctions.__all__}
+
+
+def process_type(function):
+    """
+    The process type (caching identifier) of a calcfunction.
+    """
+    return function.process_class.build_process_type()
+
+
+@contextmanager
+def enable_photometry_caching():
+    """
+    Enable caching for all calcfunctions of this plugin within the context.
+    """
+    with enable_caching(identifier=f"{CALCFUNCTION_PREFIX}.*"):
+        yield
+
+
+def check_cacheable(require_enabled=False):
+    """
+    Validate that every exported calcfunction can be reused from the cache.
+
+    A calcfunction qualifies if it is a process function creating a
+    CalcFunctionNode whose class allows caching. With require_enabled, the
+    current caching configuration must also enable it.
+
+    Returns {name: reason} for the calcfunctions that do not qualify; an
+    empty dict means all of them can be cached.
+    """
+    problems = {}
+    for name, function in photometry_calcfunctions().items():
+        if not getattr(function, "is_process_function", False):
+            problems[name] = "not a process function"
+        elif not issubclass(function.node_class, CalcFunctionNode):
+            problems[name] = f"creates {function.node_class.__name__} nodes"
+        elif not function.node_class._cachable:
+            problems[name] = "node class is not cachable"
+        elif require_enabled and not get_use_cache(identifier=process_type(function)):
+            problems[name] = "caching is disabled for it in the configuration"
+    return problems
@@ -1,11 +1,12 @@
-
 from .centroids import (
     centroid_com_cf,
     centroid_quadratic_cf,
     centroid_1dg_cf,
     centroid_2dg_cf,
     centroid_sources_cf,
-    detect_sources_cf
+    centroid_batch_cf,
+    detect_sources_mef_cf,
+    detect_sources_cf,
 )
 from .aperture import (
     circular_aperture_photometry_cf,
@@ -13,49 +14,76 @@ from .aperture import (
     elliptical_aperture_photometry_cf,
     elliptical_annulus_photometry_cf,
     rectangular_aperture_photometry_cf,
-    rectangular_annulus_photometry_cf
+    rectangular_annulus_photometry_cf,
+    local_background_photometry_cf,
 )
+from .psf import psf_photometry_cf
 
 from .calibration import (
     create_master_bias,
     create_master_dark,
     create_master_flat,
-    calibrate_science
+    calibrate_science,
+    calibrate_science_batch,
+    calibrate_science_mef,
 )
 
+from .cosmic_rays import cosmicray_lacosmic_cf
+
+from .light_curve import forced_photometry_cf
+
+from .registration import register_frames_cf, stack_frames_cf
+
+from .crossmatch import crossmatch_sources_cf
+
+from .batch import summarize_photometry_cf
+
 from .background import (
     global_background_cf,
     background_2d_cf,
-    subtract_background
+    background_2d_mef_cf,
+    subtract_background,
 )
 
 __all__ = [
-    #centroids
+    # centroids
     "centroid_com_cf",
     "centroid_quadratic_cf",
     "centroid_1dg_cf",
     "centroid_2dg_cf",
     "centroid_sources_cf",
-    "detect_sources_cf"
-    
-    #aperture
+    "centroid_batch_cf",
+    "detect_sources_mef_cf",
+    "detect_sources_cf",
+    # aperture
     "circular_aperture_photometry_cf",
     "circular_annulus_photometry_cf",
     "elliptical_aperture_photometry_cf",
     "elliptical_annulus_photometry_cf",
-    "rectangular_aperture_photometry_cf"
-    "rectangular_annulus_photometry_cf"
-
-    #calibration
+    "rectangular_aperture_photometry_cf",
+    "rectangular_annulus_photometry_cf",
+    "local_background_photometry_cf",
+    "psf_photometry_cf",
+    # calibration
     "create_master_bias",
     "create_master_dark",
     "create_master_flat",
-    "calibrate_science"
-
-    #background
+    "calibrate_science",
+    "calibrate_science_batch",
+    "calibrate_science_mef",
+    "cosmicray_lacosmic_cf",
+    # light curves
+    "forced_photometry_cf",
+    # registration
+    "register_frames_cf",
+    "stack_frames_cf",
+    # cross-matching
+    "crossmatch_sources_cf",
+    # batch
+    "summarize_photometry_cf",
+    # background
     "background_2d_cf",
     "global_background_cf",
-    "subtract_background"
-
+    "background_2d_mef_cf",
+    "subtract_background",
 ]
-
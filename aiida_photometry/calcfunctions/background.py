@@ -1,46 +1,295 @@
 from photutils.background import Background2D, MedianBackground
+from photutils.utils import ShepardIDWInterpolator
 
-from aiida_photometry.data.fits_data import FitsData
+from aiida_photometry.data.fits_data import FitsData, memmap_hdu
+from aiida_photometry.instrumentation import instrumented, phase
+from aiida_photometry.utils import (
+    _write_hdulist_to_fitsdata,
+    chip_label,
+    parallel_map,
+)
 from aiida.engine import calcfunction
 from aiida.orm import ArrayData, Dict
-from aiida.engine import calcfunction
-import ccdproc
-from astropy.nddata import CCDData
-import tempfile
+import warnings
 import numpy as np
+from astropy import units as u
 from astropy.io import fits
-import os
+from scipy import ndimage
+
+from astropy.stats import sigma_clip, sigma_clipped_stats
+from astropy.utils.exceptions import AstropyUserWarning
+
+
+def mesh_to_map(mesh, box_size, shape, order=3):
+    """
+    Interpolate a low-resolution background mesh to a full-resolution map.
+
+    Same spline zoom as photutils' BkgZoomInterpolator: the mesh is zoomed
+    by the box size on the padded grid, cropped to the image shape and
+    clipped to the range of the mesh.
+    """
+    mesh = np.asarray(mesh, dtype=float)
+    if np.ptp(mesh) == 0:
+        return np.full(shape, mesh.min())
+
+    box_y, box_x = np.broadcast_to(box_size, 2)
+    full = ndimage.zoom(
+        mesh,
+        (box_y, box_x),
+        order=order,
+        mode="reflect",
+        grid_mode=True,
+    )
+    full = full[: shape[0], : shape[1]]
+    return np.clip(full, mesh.min(), mesh.max(), out=full)
+
+
+def background_map(background: ArrayData, name="background"):
+    """
+    Full-resolution 'background' or 'background_rms' of a background node.
+
+    Nodes stored with store="mesh" only hold '<name>_mesh'; the map is then
+    rebuilt from the mesh and its stored interpolation settings.
+    """
+    if name in background.get_arraynames():
+        return background.get_array(name)
+
+    attrs = background.base.attributes
+    return mesh_to_map(
+        background.get_array(f"{name}_mesh"),
+        attrs.get("box_size"),
+        attrs.get("image_shape"),
+        order=attrs.get("interpolation_order", 3),
+    )
+
+
+def _mesh_strip_stats(job):
+    """
+    Sigma-clipped median and std of every box in one row of boxes.
+
+    Runs in a worker process, which reads its rows from the file and pads
+    them with NaN to whole boxes. As in Background2D, non-finite and clipped
+    pixels are masked and boxes with more than `threshold` masked pixels are
+    NaN.
+    """
+    (path, hdu_index), row, box_size, n_cols, sigma, maxiters, threshold = job
+
+    strip = np.full((box_size, n_cols * box_size), np.nan)
+    with memmap_hdu(path, hdu_index) as data:
+        block = data[row * box_size : (row + 1) * box_size]
+        strip[: block.shape[0], : block.shape[1]] = block
+    strip[~np.isfinite(strip)] = np.nan
+
+    values = (
+        strip.reshape(box_size, n_cols, box_size).transpose(1, 0, 2).reshape(n_cols, -1)
+    )
+    with warnings.catch_warnings():
+        # Boxes that are all NaN are excluded below
+        warnings.simplefilter("ignore", AstropyUserWarning)
+        warnings.simplefilter("ignore", RuntimeWarning)
+        values = sigma_clip(
+            values, sigma=sigma, maxiters=maxiters, axis=1, masked=False
+        )
+        values[np.isnan(values).sum(axis=1) > threshold] = np.nan
+        return np.nanmedian(values, axis=1), np.nanstd(values, axis=1)
+
+
+def _fill_bad_boxes(mesh):
+    # Excluded boxes are filled by Background2D's IDW interpolation of the
+    # good ones (10 neighbours, power 1)
+    good = np.isfinite(mesh)
+    if good.all():
+        return mesh
+    if not good.any():
+        raise ValueError("All boxes contain too many masked pixels")
 
-from astropy.stats import sigma_clipped_stats
+    interpolator = ShepardIDWInterpolator(np.argwhere(good), mesh[good])
+    grid = np.indices(mesh.shape).reshape(2, -1).T
+    return interpolator(grid, n_neighbors=10, power=1.0).reshape(mesh.shape)
 
 
+def _parallel_background_mesh(shape, source, box_size, filter_size, params):
+    """
+    Background and RMS meshes computed row of boxes by row of boxes in a
+    process pool, following Background2D's defaults (3 sigma clipping with
+    10 iterations, boxes with more than 10% masked pixels excluded and
+    interpolated, median filtering of the mesh). `source` is the (path,
+    HDU index) the workers read their rows from.
+    """
+    sigma = params.get("sigma", 3.0)
+    maxiters = params.get("maxiters", 10)
+    exclude_percentile = params.get("exclude_percentile", 10.0)
+    threshold = exclude_percentile / 100 * box_size**2
+    if exclude_percentile == 100:
+        # Completely masked boxes are always excluded
+        threshold -= 1
+
+    n_rows = -(-shape[0] // box_size)
+    n_cols = -(-shape[1] // box_size)
+    jobs = [
+        (source, row, box_size, n_cols, sigma, maxiters, threshold)
+        for row in range(n_rows)
+    ]
+
+    results = parallel_map(
+        _mesh_strip_stats,
+        jobs,
+        max_workers=params.get("max_workers"),
+        executor="process",
+    )
+
+    # Both meshes share the excluded boxes, as in Background2D
+    bkg_mesh = np.array([res[0] for res in results])
+    rms_mesh = np.array([res[1] for res in results])
+    rms_mesh[~np.isfinite(bkg_mesh)] = np.nan
+
+    meshes = []
+    for mesh in (bkg_mesh, rms_mesh):
+        mesh = _fill_bad_boxes(mesh)
+        if filter_size > 1:
+            mesh = ndimage.generic_filter(
+                mesh, np.nanmedian, size=filter_size, mode="constant", cval=np.nan
+            )
+        meshes.append(mesh)
+
+    return meshes
+
+
+@instrumented
 @calcfunction
-def subtract_background(image: FitsData, background: ArrayData):
+def subtract_background(image: FitsData, background: ArrayData, options: Dict = None):
 
     """
     Subtract a background map from a FITS image while preserving headers and metadata.
+
+    options:
+        Optional Dict with key 'output' (dtype/compression of the written file)
     """
+    opts = options.get_dict() if options is not None else {}
+
     img = image.get_ccddata()
     header = img.header.copy()
 
-    bkg = np.asarray(background.get_array("background"), dtype=img.data.dtype)
+    # Integer frames, e.g. uint16 raw data, are subtracted in floating point
+    dtype = np.result_type(img.data.dtype, np.float32)
+    bkg = np.asarray(background_map(background), dtype=dtype)
 
     if img.data.shape != bkg.shape:
         raise ValueError("Image and background shape mismatch")
-    
+
     new_data = img.data - bkg
 
-    with tempfile.TemporaryDirectory() as tmpdir:
-        path = os.path.join(tmpdir, "background_subtracted.fits")
+    hdu = fits.PrimaryHDU(data=new_data, header=header)
+
+    return _write_hdulist_to_fitsdata(
+        fits.HDUList([hdu]),
+        extra_attrs={"background_subtracted": True},
+        output=opts.get("output"),
+        filename="background_subtracted.fits",
+    )
+
 
-        hdu = fits.PrimaryHDU(data=new_data, header=header)
-        hdu.writeto(path, overwrite=True)
+def _sample_pixels(data, sampling, sample_size, seed=0):
+    ny, nx = data.shape
+    if sampling == "stride":
+        stride = max(1, int(np.sqrt(data.size / sample_size)))
+        return np.asarray(data[::stride, ::stride], dtype=float).ravel()
+    if sampling == "random":
+        rng = np.random.default_rng(seed)
+        flat = np.sort(
+            rng.choice(data.size, min(sample_size, data.size), replace=False)
+        )
+        iy, ix = np.unravel_index(flat, (ny, nx))
+        return np.asarray(data[iy, ix], dtype=float)
+    raise ValueError(f"Unknown sampling: {sampling}")
+
+
+def _clipped_errors(std, n):
+    # Standard errors of the clipped statistics for n Gaussian samples
+    n = max(int(n), 2)
+    return {
+        "mean_err": float(std / np.sqrt(n)),
+        "median_err": float(1.2533 * std / np.sqrt(n)),
+        "std_err": float(std / np.sqrt(2 * (n - 1))),
+    }
 
-        node = FitsData(file=path)
-        node.base.attributes.set("background_subtracted", True)
 
-    return node
+def _sampled_background(data, sampling, sample_size, sigma, maxiters, seed):
+    sample = _sample_pixels(data, sampling, sample_size, seed)
+    sample = sample[np.isfinite(sample)]
+    clipped = sigma_clip(sample, sigma=sigma, maxiters=maxiters, masked=True)
+    kept = clipped.compressed()
 
+    mean, median, std = kept.mean(), np.median(kept), kept.std()
+    result = {"mean": float(mean), "median": float(median), "std": float(std)}
+    result.update(_clipped_errors(std, kept.size))
+    result["n_pixels"] = int(kept.size)
+    return result
+
+
+def _histogram_background(data, bins, sample_size, sigma, maxiters, seed):
+    """
+    Clipped statistics of every pixel from one histogram pass.
+
+    A strided sample sets the histogram range; the clipping iterations then
+    run on the binned counts only. Bin width adds a resolution error of
+    width / sqrt(12) to the reported errors.
+    """
+    rough = _sampled_background(data, "stride", sample_size, sigma, maxiters, seed)
+    half_width = (sigma + 2) * max(rough["std"], np.finfo(float).tiny)
+    edges = np.linspace(
+        rough["median"] - half_width, rough["median"] + half_width, bins + 1
+    )
+
+    counts = np.zeros(bins)
+    step = max(1, int(4e6 // data.shape[1]))
+    for start in range(0, data.shape[0], step):
+        counts += np.histogram(data[start : start + step], bins=edges)[0]
+
+    centers = 0.5 * (edges[1:] + edges[:-1])
+    keep = np.ones(bins, dtype=bool)
+    for _ in range(maxiters):
+        weights = counts * keep
+        n = weights.sum()
+        mean = (weights * centers).sum() / n
+        std = np.sqrt((weights * (centers - mean) ** 2).sum() / n)
+        # Cumulative counts are reached at the upper edge of each bin
+        cumulative = np.concatenate([[0], np.cumsum(weights)])
+        median = np.interp(n / 2, cumulative, edges)
+
+        new_keep = np.abs(centers - median) <= sigma * std
+        if (new_keep == keep).all():
+            break
+        keep = new_keep
+
+    resolution = (edges[1] - edges[0]) / np.sqrt(12)
+    result = {"mean": float(mean), "median": float(median), "std": float(std)}
+    for key, value in _clipped_errors(std, n).items():
+        result[key] = float(np.hypot(value, resolution))
+    result["n_pixels"] = int(n)
+    return result
+
+
+def _approximate_background(data, params):
+    """
+    Quick-look global background from a pixel sample or a histogram.
+
+    Returns mean/median/std with their standard errors.
+    """
+    sigma = params.get("sigma", 3.0)
+    maxiters = params.get("maxiters", 5)
+    sampling = params.get("sampling", "stride")
+    sample_size = int(params.get("sample_size", 100_000))
+    seed = params.get("seed", 0)
+
+    if sampling == "histogram":
+        return _histogram_background(
+            data, int(params.get("bins", 1024)), sample_size, sigma, maxiters, seed
+        )
+    return _sampled_background(data, sampling, sample_size, sigma, maxiters, seed)
+
+
+@instrumented
 @calcfunction
 def global_background_cf(
     image: FitsData,
@@ -53,20 +302,32 @@ def global_background_cf(
         Dict with keys:
             - sigma (float)
             - maxiters (int)
+            - mode: "exact" (default) or "approximate" for quick-look
+            - sampling: "stride" (default), "random" or "histogram"
+            - sample_size: pixels used by the sampled estimates (default 1e5)
+            - bins: histogram bins (default 1024)
+            - seed: random sampling seed
+
+    The approximate mode also returns 'mean_err', 'median_err', 'std_err'
+    and the number of pixels used; accuracy scales with sample_size/bins.
     """
 
     params = parameters.get_dict()
     sigma = params.get("sigma", 3.0)
     maxiters = params.get("maxiters", 5)
+    mode = params.get("mode", "exact")
+
+    if mode == "approximate":
+        with image.memmap_array() as data:
+            result = _approximate_background(data, params)
+        # Unit from the stored BUNIT, as get_ccddata would resolve it
+        result["unit"] = str(u.Unit(image.base.attributes.get("unit", "adu")))
+        return Dict(dict=result)
 
     ccd = image.get_ccddata()
     data = ccd.data
 
-    mean, median, std = sigma_clipped_stats(
-        data,
-        sigma=sigma,
-        maxiters=maxiters
-    )
+    mean, median, std = sigma_clipped_stats(data, sigma=sigma, maxiters=maxiters)
 
     result = {
         "mean": float(mean),
@@ -77,6 +338,70 @@ def global_background_cf(
 
     return Dict(dict=result)
 
+
+def _background_2d(data, params, source=None):
+    """
+    Background and RMS of one image as (arrays, attributes) for ArrayData.
+
+    The parallel mode reads the image in its workers from `source`, the
+    (path, HDU index) of the file `data` is mapped from.
+    """
+    box_size = params.get("box_size", 50)
+    filter_size = params.get("filter_size", 3)
+    mode = params.get("mode", "background2d")
+    store = params.get("store", "full")
+    shape = data.shape
+
+    if mode == "parallel":
+        bkg_mesh, rms_mesh = _parallel_background_mesh(
+            shape, source, box_size, filter_size, params
+        )
+        bkg_full = rms_full = None
+    elif mode == "background2d":
+        with phase("photutils_background"):
+            bkg = Background2D(
+                data,
+                box_size,
+                filter_size=filter_size,
+                bkg_estimator=MedianBackground(),
+            )
+        bkg_mesh, rms_mesh = bkg.background_mesh, bkg.background_rms_mesh
+        bkg_full, rms_full = bkg.background, bkg.background_rms
+    else:
+        raise ValueError(f"Unknown background mode: {mode}")
+
+    if store == "mesh":
+        arrays = {
+            "background_mesh": np.asarray(bkg_mesh, dtype=float),
+            "background_rms_mesh": np.asarray(rms_mesh, dtype=float),
+        }
+        attributes = {
+            "box_size": box_size,
+            "image_shape": list(shape),
+            "interpolation_order": 3,
+        }
+        return arrays, attributes
+
+    if store == "full":
+        if bkg_full is None:
+            bkg_full = mesh_to_map(bkg_mesh, box_size, shape)
+            rms_full = mesh_to_map(rms_mesh, box_size, shape)
+        return {"background": bkg_full, "background_rms": rms_full}, {}
+
+    raise ValueError(f"Unknown background store: {store}")
+
+
+def _background_node(arrays, attributes):
+    # Store background map in ArrayData
+    bkg_node = ArrayData()
+    for name, array in arrays.items():
+        bkg_node.set_array(name, array)
+    for key, value in attributes.items():
+        bkg_node.base.attributes.set(key, value)
+    return bkg_node
+
+
+@instrumented
 @calcfunction
 def background_2d_cf(
     image: FitsData,
@@ -89,25 +414,66 @@ def background_2d_cf(
         Dict with keys:
             - box_size (int)
             - filter_size (int)
+            - mode: "background2d" (default) or "parallel", which computes
+              the box statistics in a process pool
+            - sigma, maxiters, exclude_percentile, max_workers: parallel mode
+            - store: "full" (default) stores 'background'/'background_rms',
+              "mesh" only the low-resolution 'background_mesh' and
+              'background_rms_mesh'; use background_map() to rebuild them
     """
 
     params = parameters.get_dict()
-    box_size = params.get("box_size", 50)
-    filter_size = params.get("filter_size", 3)
+    if params.get("mode") == "parallel":
+        with image.as_path() as path:
+            source = (path, image.image_hdu)
+            with memmap_hdu(*source) as data:
+                arrays, attributes = _background_2d(data, params, source)
+    else:
+        with image.memmap_array() as data:
+            arrays, attributes = _background_2d(data, params)
 
-    ccd = image.get_ccddata()
-    data = ccd.data
+    return _background_node(arrays, attributes)
 
-    bkg = Background2D(
-        data,
-        box_size,
-        filter_size=filter_size,
-        bkg_estimator=MedianBackground()
-    )
 
-    # Store background map in ArrayData
-    bkg_node = ArrayData()
-    bkg_node.set_array("background", bkg.background)
-    bkg_node.set_array("background_rms", bkg.background_rms)
+def _background_chip(job):
+    # One chip of a mosaic, read in its worker process; no nested pool
+    path, hdu_index, params = job
+    with memmap_hdu(path, hdu_index) as data:
+        return _background_2d(
+            data, {**params, "max_workers": 1}, source=(path, hdu_index)
+        )
+
+
+@instrumented
+@calcfunction
+def background_2d_mef_cf(image: FitsData, parameters: Dict):
+    """
+    2D background of every chip of a multi-extension image in parallel.
+
+    parameters:
+        As background_2d_cf, plus max_workers: number of chips processed at
+        once in a process pool (default: all cores).
+
+    Returns one ArrayData per chip in a namespace keyed by the chip EXTNAME
+    (see utils.chip_label), each with the 'hdu_index' and 'extname'
+    attributes.
+    """
+    params = parameters.get_dict()
+    extensions = image.image_extensions()
+
+    with image.as_path() as path:
+        results = parallel_map(
+            _background_chip,
+            [(path, ext["index"], params) for ext in extensions],
+            max_workers=params.get("max_workers"),
+            executor="process",
+        )
+
+    outputs = {}
+    for ext, (arrays, attributes) in zip(extensions, results):
+        attributes.update(hdu_index=ext["index"], extname=ext["extname"])
+        outputs[chip_label(ext["extname"], ext["index"])] = _background_node(
+            arrays, attributes
+        )
 
-    return bkg_node
\ No newline at end of file
+    return outputs
@@ -0,0 +1,57 @@
+from aiida.engine import calcfunction
+from aiida.orm import Dict
+
+import numpy as np
+
+from aiida_photometry.instrumentation import instrumented
+from aiida_photometry.utils import photometry_to_table
+
+
+def _photometry_summary(node):
+    table = photometry_to_table(node)
+    summary = {"n_sources": len(table)}
+
+    if "aperture_sum" in table.colnames and len(table):
+        column = table["aperture_sum"]
+        flux = np.asarray(getattr(column, "value", column))
+        summary["median_aperture_sum"] = float(np.nanmedian(flux))
+
+    return summary
+
+
+@instrumented
+@calcfunction
+def summarize_photometry_cf(status: Dict, **photometry) -> Dict:
+    """
+    Collect the photometry of a batch of images into one summary.
+
+    status:
+        Dict mapping every image label to the exit status of its pipeline
+        (None if it did not finish).
+
+    photometry:
+        Photometry results (Dict or ArrayData) of the successful images,
+        keyed by image label.
+
+    Returns a Dict with the image counts, per-image 'n_sources' and
+    'median_aperture_sum', and the exit status of the failed images.
+    """
+    statuses = status.get_dict()
+
+    images = {label: _photometry_summary(node) for label, node in photometry.items()}
+    failed = {
+        label: exit_status
+        for label, exit_status in statuses.items()
+        if label not in photometry
+    }
+
+    return Dict(
+        dict={
+            "n_images": len(statuses),
+            "n_succeeded": len(images),
+            "n_failed": len(failed),
+            "n_sources": int(sum(s["n_sources"] for s in images.values())),
+            "images": images,
+            "failed": failed,
+        }
+    )
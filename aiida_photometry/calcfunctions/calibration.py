@@ -4,9 +4,20 @@ from aiida.orm import Dict
 import ccdproc
 import numpy as np
 from astropy import units as u
+from astropy.io import fits
+from astropy.nddata import CCDData, StdDevUncertainty
+
+from aiida_photometry.data.fits_data import FitsData, open_fits, read_section
+from aiida_photometry.instrumentation import instrumented, phase
+from aiida_photometry.utils import (
+    _write_ccd_to_fitsdata,
+    _write_chips_to_fitsdata,
+    parallel_map,
+)
+
+# Default memory budget (bytes) of the streaming combine
+STREAMING_MEM_LIMIT = 1e9
 
-from aiida_photometry.data.fits_data import FitsData
-from aiida_photometry.utils import _write_ccd_to_fitsdata
 
 def _validate_same_shape(ccd_list):
     shapes = [ccd.data.shape for ccd in ccd_list]
@@ -14,18 +25,181 @@ def _validate_same_shape(ccd_list):
         raise ValueError(f"Shape mismatch in input frames: {shapes}")
 
 
+def _read_ccd_rows(node, rows):
+    """
+    Read a band of rows of a FitsData frame (and of its MASK extension, if
+    any) as CCDData, without decoding the rest of the image.
+    """
+    with phase("fits_decode"), node.open(mode="rb") as handle:
+        with open_fits(handle) as hdul:
+            data = read_section(hdul[node.image_hdu], (rows, slice(None)))
+            mask = None
+            if "MASK" in hdul:
+                mask = read_section(hdul["MASK"], (rows, slice(None))).astype(bool)
+
+    return CCDData(
+        data,
+        unit=node.base.attributes.get("unit", "adu"),
+        meta=dict(node.header),
+        mask=mask,
+    )
+
+
+def _row_chunks(shape, n_frames, mem_limit, sigma_clip):
+    # Peak memory per stacked pixel: the float64 stack, its mask and the
+    # combiner's working copies (the same estimate ccdproc.combine uses)
+    bytes_per_pixel = 8 * n_frames * (4 if sigma_clip else 3)
+    rows = max(1, int(mem_limit // (bytes_per_pixel * shape[1])))
+
+    for start in range(0, shape[0], rows):
+        yield slice(start, min(start + rows, shape[0]))
+
+
+def _banded_median(read_band, bands, max_values, n_bins=1024):
+    """
+    Median of an image read a band of rows at a time, equal to np.median.
+
+    ``read_band(rows)`` returns the values of a band. Histograms of the
+    bands narrow down the range of the middle values until at most
+    ``max_values`` of them are left, which are then collected and
+    partitioned. Only one band and those values are held in memory.
+    """
+    n, lo, hi = 0, np.inf, -np.inf
+    for rows in bands:
+        values = read_band(rows)
+        if np.isnan(values).any():
+            return np.nan
+        n += values.size
+        lo, hi = min(lo, values.min()), max(hi, values.max())
+
+    def select(rank, lo, hi):
+        # The value of the given rank (0-based), known to lie in [lo, hi]
+        while lo < hi:
+            edges = np.linspace(lo, hi, n_bins + 1)
+            below = 0
+            counts = np.zeros(n_bins, dtype=np.int64)
+            for rows in bands:
+                values = read_band(rows)
+                below += np.count_nonzero(values < lo)
+                inside = values[(values >= lo) & (values <= hi)]
+                index = np.searchsorted(edges, inside, side="right") - 1
+                counts += np.bincount(
+                    np.clip(index, 0, n_bins - 1), minlength=n_bins
+                )
+
+            if counts.sum() <= max_values:
+                inside = np.concatenate(
+                    [v[(v >= lo) & (v <= hi)] for v in map(read_band, bands)]
+                )
+                return np.partition(inside, rank - below)[rank - below]
+
+            b = np.searchsorted(below + np.cumsum(counts), rank, side="right")
+            if (edges[b], edges[b + 1]) == (lo, hi):
+                # Only a few representable values left in the range: they
+                # are ties, settled by counting the lowest one
+                equal = sum(np.count_nonzero(read_band(rows) == lo) for rows in bands)
+                if below + equal > rank:
+                    return lo
+                lo = np.nextafter(lo, np.inf)
+            else:
+                lo, hi = edges[b], edges[b + 1]
+        return lo
+
+    middle = sorted({(n - 1) // 2, n // 2})
+    return np.mean([select(rank, lo, hi) for rank in middle])
+
+
+def _combine_ccds(ccds, method, sigma_clip, params):
+    # Mirrors the per-tile work of ccdproc.combine
+    with phase("ccdproc_combine"):
+        combiner = ccdproc.Combiner(ccds)
+
+        if sigma_clip:
+            combiner.sigma_clipping(
+                low_thresh=params.get("sigma_clip_low_thresh", 3),
+                high_thresh=params.get("sigma_clip_high_thresh", 3),
+                func=np.ma.mean,
+                dev_func=np.ma.std,
+            )
+
+        if method == "median":
+            return combiner.median_combine()
+        if method == "average":
+            return combiner.average_combine()
+        if method == "sum":
+            return combiner.sum_combine()
+    raise ValueError(f"Unknown combine method: {method}")
+
+
+def _streaming_combine(frames, method, sigma_clip, params, preprocess=None):
+    """
+    Out-of-core replacement for ccdproc.combine.
+
+    Only a band of rows of every frame is held in memory at a time, sized to
+    the ``mem_limit`` parameter (bytes). ``preprocess(ccds, rows)`` may
+    calibrate the band of each frame before it is combined.
+    """
+    frames = list(frames)
+    shapes = [tuple(f.base.attributes.get("shape", ())) for f in frames]
+    if len(set(shapes)) != 1 or len(shapes[0]) != 2:
+        raise ValueError(f"Shape mismatch in input frames: {shapes}")
+    shape = shapes[0]
+
+    mem_limit = params.get("mem_limit", STREAMING_MEM_LIMIT)
+
+    data = np.empty(shape, dtype=float)
+    uncertainty = np.empty(shape, dtype=float)
+    mask = np.zeros(shape, dtype=bool)
+    unit = None
+
+    for rows in _row_chunks(shape, len(frames), mem_limit, sigma_clip):
+        ccds = [_read_ccd_rows(f, rows) for f in frames]
+        if preprocess is not None:
+            ccds = preprocess(ccds, rows)
+
+        combined = _combine_ccds(ccds, method, sigma_clip, params)
+        data[rows] = combined.data
+        uncertainty[rows] = combined.uncertainty.array
+        if combined.mask is not None:
+            mask[rows] = combined.mask
+        unit = combined.unit
+
+    with frames[0].open(mode="rb") as handle:
+        header = fits.getheader(handle, frames[0].image_hdu)
+    header["NCOMBINE"] = len(frames)
+
+    return CCDData(
+        data,
+        unit=unit,
+        meta=header,
+        mask=mask,
+        uncertainty=StdDevUncertainty(uncertainty),
+    )
+
+
+def _streaming_mode(params):
+    return params.get("combine_mode", "in_memory") == "streaming"
+
+
+@instrumented
 @calcfunction
 def create_master_bias(parameters, **frames):
     """
     Combine bias frames into master bias.
+
+    Set ``combine_mode`` to "streaming" to combine the stack in bands of rows
+    within ``mem_limit`` bytes instead of loading every frame.
     """
     params = parameters.get_dict()
     method = params.get("combine_method", "median")
     sigma_clip = params.get("sigma_clip", True)
 
-    master = ccdproc.combine(
-        [f.get_ccddata() for f in frames.values()], method=method, sigma_clip=sigma_clip
-    )
+    if _streaming_mode(params):
+        master = _streaming_combine(frames.values(), method, sigma_clip, params)
+    else:
+        ccds = [f.get_ccddata() for f in frames.values()]
+        with phase("ccdproc_combine"):
+            master = ccdproc.combine(ccds, method=method, sigma_clip=sigma_clip)
     master.meta["CALTYPE"] = "MASTER_BIAS"
 
     return _write_ccd_to_fitsdata(
@@ -35,9 +209,11 @@ def create_master_bias(parameters, **frames):
             "master_type": "bias",
             "combine_method": method,
         },
+        output=params.get("output"),
     )
 
 
+@instrumented
 @calcfunction
 def create_master_dark(master_bias: FitsData = None, parameters: Dict = None, **frames):
     """
@@ -46,18 +222,32 @@ def create_master_dark(master_bias: FitsData = None, parameters: Dict = None, **
     params = parameters.get_dict()
     method = params.get("combine_method", "median")
     subtract_bias_flag = params.get("subtract_bias", True)
+    use_bias = subtract_bias_flag and master_bias is not None
 
-    # Substract Bias if subtract_bias = True
-    bias_ccd = master_bias.get_ccddata()
-    calibrated = [
-        ccdproc.subtract_bias(f.get_ccddata(), bias_ccd)
-        if subtract_bias_flag and master_bias is not None
-        else f.get_ccddata()
-        for f in frames.values()
-    ]
+    if _streaming_mode(params):
+
+        def subtract_bias(ccds, rows):
+            if not use_bias:
+                return ccds
+            bias_rows = _read_ccd_rows(master_bias, rows)
+            return [ccdproc.subtract_bias(ccd, bias_rows) for ccd in ccds]
 
-    # Combine Darks
-    master = ccdproc.combine(calibrated, method=method)
+        master = _streaming_combine(
+            frames.values(), method, False, params, preprocess=subtract_bias
+        )
+    else:
+        # Substract Bias if subtract_bias = True
+        bias_ccd = master_bias.get_ccddata() if use_bias else None
+        calibrated = [
+            ccdproc.subtract_bias(f.get_ccddata(), bias_ccd)
+            if use_bias
+            else f.get_ccddata()
+            for f in frames.values()
+        ]
+
+        # Combine Darks
+        with phase("ccdproc_combine"):
+            master = ccdproc.combine(calibrated, method=method)
     master.meta["CALTYPE"] = "MASTER_DARK"
 
     return _write_ccd_to_fitsdata(
@@ -68,40 +258,54 @@ def create_master_dark(master_bias: FitsData = None, parameters: Dict = None, **
             "combine_method": method,
             "bias_subtracted": subtract_bias_flag
         },
+        output=params.get("output"),
     )
 
 
+@instrumented
 @calcfunction
 def create_master_flat(
-    master_bias: FitsData, master_dark: FitsData, parameters: Dict, **frames
+    master_bias: FitsData,
+    master_dark: FitsData = None,
+    parameters: Dict = None,
+    **frames,
 ):
     """
     Create master flat (per filter).
+
+    Without a master dark the flats are only bias-subtracted.
     """
     params = parameters.get_dict()
     method = params.get("combine_method", "median")
 
-    bias_ccd = master_bias.get_ccddata()
-    dark_ccd = master_dark.get_ccddata()
+    if _streaming_mode(params):
+        master = _streaming_flat_combine(
+            master_bias, master_dark, frames.values(), method, params
+        )
+    else:
+        bias_ccd = master_bias.get_ccddata()
+        dark_ccd = master_dark.get_ccddata() if master_dark is not None else None
 
-    calibrated = []
+        calibrated = []
 
-    for f in frames.values():
-        flat_ccd = f.get_ccddata()
+        for f in frames.values():
+            flat_ccd = f.get_ccddata()
 
-        flat_sub = ccdproc.subtract_bias(flat_ccd, bias_ccd)
-        flat_sub = ccdproc.subtract_dark(
-            flat_sub, dark_ccd, exposure_time="EXPTIME", exposure_unit=u.second
-        )
+            flat_sub = ccdproc.subtract_bias(flat_ccd, bias_ccd)
+            if dark_ccd is not None:
+                flat_sub = ccdproc.subtract_dark(
+                    flat_sub, dark_ccd, exposure_time="EXPTIME", exposure_unit=u.second
+                )
 
-        # Normalize by median
-        norm_value = np.median(flat_sub.data)
-        flat_norm = flat_sub.divide(norm_value)
+            # Normalize by median
+            norm_value = np.median(flat_sub.data)
+            flat_norm = flat_sub.divide(norm_value)
 
-        calibrated.append(flat_norm)
+            calibrated.append(flat_norm)
 
-    # Combine Flats
-    master = ccdproc.combine(calibrated, method=method)
+        # Combine Flats
+        with phase("ccdproc_combine"):
+            master = ccdproc.combine(calibrated, method=method)
     master.meta["CALTYPE"] = "MASTER_FLAT"
 
     return _write_ccd_to_fitsdata(
@@ -111,9 +315,58 @@ def create_master_flat(
             "master_type": "flat",
             "combine_method": method,
         },
+        output=params.get("output"),
+    )
+
+
+def _streaming_flat_combine(master_bias, master_dark, frames, method, params):
+    frames = list(frames)
+    shape = tuple(frames[0].base.attributes.get("shape", ()))
+
+    def calibrate(ccds, bias, dark):
+        calibrated = [ccdproc.subtract_bias(ccd, bias) for ccd in ccds]
+        if dark is None:
+            return calibrated
+        return [
+            ccdproc.subtract_dark(
+                ccd, dark, exposure_time="EXPTIME", exposure_unit=u.second
+            )
+            for ccd in calibrated
+        ]
+
+    def read_dark(rows):
+        return _read_ccd_rows(master_dark, rows) if master_dark is not None else None
+
+    # The normalisation needs the median of each calibrated flat, which is
+    # found one frame at a time, in bands of the flat, bias and dark, before
+    # the stack is combined in bands
+    mem_limit = params.get("mem_limit", STREAMING_MEM_LIMIT)
+    bands = list(_row_chunks(shape, 3, mem_limit, False))
+    max_values = (bands[0].stop - bands[0].start) * shape[1]
+
+    def norm(frame):
+        def read_band(rows):
+            (flat_sub,) = calibrate(
+                [_read_ccd_rows(frame, rows)],
+                _read_ccd_rows(master_bias, rows),
+                read_dark(rows),
+            )
+            return np.asarray(flat_sub.data, dtype=float).ravel()
+
+        return _banded_median(read_band, bands, max_values)
+
+    norms = [norm(f) for f in frames]
+
+    def calibrate_and_normalize(ccds, rows):
+        calibrated = calibrate(ccds, _read_ccd_rows(master_bias, rows), read_dark(rows))
+        return [ccd.divide(norm) for ccd, norm in zip(calibrated, norms)]
+
+    return _streaming_combine(
+        frames, method, False, params, preprocess=calibrate_and_normalize
     )
 
 
+@instrumented
 @calcfunction
 def subtract_bias_cf(image: FitsData, master_bias: FitsData) -> FitsData:
     """
@@ -125,6 +378,7 @@ def subtract_bias_cf(image: FitsData, master_bias: FitsData) -> FitsData:
         extra_attrs = {"calibration": "bias_subtracted"},
     )
 
+@instrumented
 @calcfunction
 def flat_correct_cf(image: FitsData, master_flat: FitsData) -> FitsData:
     """
@@ -137,35 +391,292 @@ def flat_correct_cf(image: FitsData, master_flat: FitsData) -> FitsData:
     )
 
 
+def _calibrate_ccd(sci, bias, dark, flat, params):
+    """
+    Bias, dark and flat correct one frame; missing masters are skipped.
+
+    ``engine`` selects the ccdproc chain (default) or the fused kernel.
+    """
+    with phase("calibrate"):
+        if params.get("engine", "ccdproc") == "fused":
+            return _fused_calibrate(sci, bias, dark, flat, params)
+        return _ccdproc_calibrate(sci, bias, dark, flat, params)
+
+
+def _ccdproc_calibrate(sci, bias, dark, flat, params):
+    if bias is not None:
+        sci = ccdproc.subtract_bias(sci, bias)
+
+    if dark is not None:
+        sci = ccdproc.subtract_dark(
+            sci,
+            dark,
+            exposure_time="EXPTIME",
+            exposure_unit=u.second,
+            scale=params.get("scale_dark", False),
+        )
+
+    if flat is not None:
+        sci = ccdproc.flat_correct(sci, flat)
+
+    sci.meta["CALIBRATED"] = True
+    return sci
+
+
+def _fused_calibrate(sci, bias, dark, flat, params):
+    """
+    Single-pass equivalent of the ccdproc calibration chain.
+
+    Computes ``(sci - bias - dark * scale) / (flat / mean(flat))`` in place on
+    one output buffer of the requested ``dtype``, a band of ``band_rows`` rows
+    at a time, with the same operation order as ccdproc so float64 results are
+    identical. Uncertainty and mask planes are propagated like NDData
+    arithmetic does, unless ``lean`` is set, in which case they are dropped.
+    Masters with non standard-deviation uncertainties use the ccdproc chain.
+    """
+    lean = params.get("lean", False)
+    masters = [m for m in (bias, dark, flat) if m is not None]
+
+    for ccd in masters:
+        if ccd is not flat and ccd.unit != sci.unit:
+            raise ValueError(f"Unit mismatch: {ccd.unit} != {sci.unit}")
+
+    uncertain = [sci] + masters
+    if not lean and any(
+        c.uncertainty is not None and not isinstance(c.uncertainty, StdDevUncertainty)
+        for c in uncertain
+    ):
+        return _ccdproc_calibrate(sci, bias, dark, flat, params)
+
+    def sigma(ccd):
+        if lean or ccd is None or ccd.uncertainty is None:
+            return None
+        return ccd.uncertainty.array
+
+    ratio = 1.0
+    if dark is not None and params.get("scale_dark", False):
+        ratio = sci.header["EXPTIME"] / dark.header["EXPTIME"]
+
+    flat_mean = flat.data.mean() if flat is not None else None
+    propagate = not lean and any(sigma(c) is not None for c in uncertain)
+
+    out = np.array(sci.data, dtype=params.get("dtype", "float64"))
+    out_sigma = np.zeros(out.shape) if propagate else None
+
+    band = max(1, int(params.get("band_rows", 256)))
+    for start in range(0, out.shape[0], band):
+        rows = slice(start, start + band)
+        block = out[rows]
+
+        if bias is not None:
+            block -= bias.data[rows]
+        if dark is not None:
+            block -= dark.data[rows] if ratio == 1.0 else dark.data[rows] * ratio
+
+        if propagate:
+            # Independent errors of the numerator add in quadrature
+            var = np.zeros(block.shape)
+            for ccd, scale in ((sci, 1.0), (bias, 1.0), (dark, abs(ratio))):
+                if sigma(ccd) is not None:
+                    var += (sigma(ccd)[rows] * scale) ** 2
+            out_sigma[rows] = np.sqrt(var)
+
+        if flat is not None:
+            flat_normed = flat.data[rows] / flat_mean
+            block /= flat_normed
+
+            if propagate:
+                flat_sigma = sigma(flat)
+                rel = 0.0
+                if flat_sigma is not None:
+                    rel = (block * (flat_sigma[rows] / flat_mean) / flat_normed) ** 2
+                out_sigma[rows] = np.sqrt((out_sigma[rows] / flat_normed) ** 2 + rel)
+
+    mask = None
+    if not lean:
+        for ccd in uncertain:
+            if ccd.mask is not None:
+                mask = ccd.mask.copy() if mask is None else mask | ccd.mask
+
+    meta = sci.meta.copy()
+    meta["CALIBRATED"] = True
+    meta["CALENGIN"] = "fused"
+
+    return CCDData(
+        out,
+        unit=sci.unit,
+        meta=meta,
+        mask=mask,
+        uncertainty=None if out_sigma is None else StdDevUncertainty(out_sigma),
+    )
+
+
+@instrumented
 @calcfunction
 def calibrate_science(
     science: FitsData,
     master_bias: FitsData,
-    master_dark: FitsData,
-    master_flat: FitsData,
-    parameters: Dict,
+    master_dark: FitsData = None,
+    master_flat: FitsData = None,
+    parameters: Dict = None,
 ):
     """
     Apply full CCD calibration to a science frame.
+
+    parameters:
+        Optional Dict with keys:
+            - scale_dark (bool): scale the dark by the EXPTIME ratio
+            - engine (str): "ccdproc" (default) or "fused"
+            - lean (bool): fused engine only, drop uncertainty and mask planes
+            - dtype (str): fused engine only, output dtype (default float64)
+            - output (dict): dtype/compression of the written file, see
+              utils._write_hdulist_to_fitsdata
     """
+    params = parameters.get_dict() if parameters is not None else {}
 
     bias = master_bias.get_ccddata()
-    dark = master_dark.get_ccddata()
-    flat = master_flat.get_ccddata()
+    dark = master_dark.get_ccddata() if master_dark is not None else None
+    flat = master_flat.get_ccddata() if master_flat is not None else None
 
-    sci = science.get_ccddata()
+    sci = _calibrate_ccd(science.get_ccddata(), bias, dark, flat, params)
 
-    # Bias subtraction
-    sci = ccdproc.subtract_bias(sci, bias)
+    node = _write_ccd_to_fitsdata(
+        sci, extra_attrs={"is_calibrated": True}, output=params.get("output")
+    )
 
-    # Dark subtraction
-    sci = ccdproc.subtract_dark(sci, dark)
+    return node
 
-    # Flat correction
-    sci = ccdproc.flat_correct(sci, flat)
 
-    sci.meta["CALIBRATED"] = True
+@instrumented
+@calcfunction
+def calibrate_science_batch(
+    master_bias: FitsData,
+    master_dark: FitsData = None,
+    master_flat: FitsData = None,
+    parameters: Dict = None,
+    **frames,
+):
+    """
+    Calibrate many science frames against the same masters.
 
-    node = _write_ccd_to_fitsdata(sci, extra_attrs={"is_calibrated": True})
+    The masters are decoded once. Frames are calibrated in waves of
+    ``max_workers`` (default 4) threads and written before the next wave
+    starts, so memory stays bounded for nights with hundreds of exposures.
 
-    return node
+    Returns one calibrated FitsData per input frame, under the same label.
+    """
+    params = parameters.get_dict() if parameters is not None else {}
+    max_workers = params.get("max_workers", 4)
+
+    bias = master_bias.get_ccddata()
+    dark = master_dark.get_ccddata() if master_dark is not None else None
+    flat = master_flat.get_ccddata() if master_flat is not None else None
+
+    def calibrate(sci):
+        return _calibrate_ccd(sci, bias, dark, flat, params)
+
+    labels = list(frames)
+    wave_size = max(1, max_workers)
+    outputs = {}
+
+    for start in range(0, len(labels), wave_size):
+        # The repository is read in the calling thread only: the AiiDA
+        # storage session is not shared with worker threads
+        wave = labels[start : start + wave_size]
+        science = [frames[label].get_ccddata() for label in wave]
+        calibrated = parallel_map(calibrate, science, max_workers=max_workers)
+        del science
+
+        # Nodes are created in the calling thread only
+        for label, sci in zip(wave, calibrated):
+            outputs[label] = _write_ccd_to_fitsdata(
+                sci, extra_attrs={"is_calibrated": True}, output=params.get("output")
+            )
+
+    return outputs
+
+
+def _matching_hdu(master, extname, position):
+    """
+    HDU of a master for one science chip: the same EXTNAME, else the chip at
+    the same position. Single-image masters apply to every chip.
+    """
+    if not master.is_mef:
+        return master.image_hdu
+    for ext in master.extensions:
+        if ext["extname"] == extname:
+            return ext["index"]
+    return master.extensions[position]["index"]
+
+
+@instrumented
+@calcfunction
+def calibrate_science_mef(
+    science: FitsData,
+    master_bias: FitsData,
+    master_dark: FitsData = None,
+    master_flat: FitsData = None,
+    parameters: Dict = None,
+):
+    """
+    Calibrate every chip of a multi-extension science frame in parallel.
+
+    Masters may be multi-extension files matched chip by chip (by EXTNAME,
+    else by position) or single images applied to all chips.
+
+    parameters:
+        As calibrate_science, plus max_workers: chips calibrated at once
+        (threads, default 4).
+
+    Returns one multi-extension FitsData with a calibrated image extension
+    per chip, in the order and with the EXTNAMEs of the input.
+    """
+    params = parameters.get_dict() if parameters is not None else {}
+    extensions = science.image_extensions()
+
+    masters = (master_bias, master_dark, master_flat)
+    # Single-image masters apply to every chip, so they are decoded only once
+    shared = [
+        master.get_ccddata(master.image_hdu)
+        if master is not None and not master.is_mef
+        else None
+        for master in masters
+    ]
+
+    def read_master(master, decoded, ext, position):
+        if master is None or decoded is not None:
+            return decoded
+        return master.get_ccddata(_matching_hdu(master, ext["extname"], position))
+
+    def read_chip(position):
+        ext = extensions[position]
+        return (science.get_ccddata(ext["index"]),) + tuple(
+            read_master(master, decoded, ext, position)
+            for master, decoded in zip(masters, shared)
+        )
+
+    def calibrate(job):
+        return _calibrate_ccd(*job, params)
+
+    max_workers = params.get("max_workers", 4)
+    wave_size = max(1, max_workers)
+    calibrated = []
+
+    for start in range(0, len(extensions), wave_size):
+        # The repository is read in the calling thread only: the AiiDA
+        # storage session is not shared with worker threads
+        wave = range(start, min(start + wave_size, len(extensions)))
+        jobs = [read_chip(position) for position in wave]
+        calibrated.extend(parallel_map(calibrate, jobs, max_workers=max_workers))
+
+    chips = []
+    for ext, ccd in zip(extensions, calibrated):
+        hdu = ccd.to_hdu(hdu_mask=None, hdu_uncertainty=None)[0]
+        chips.append((ext["extname"] or None, hdu.data, hdu.header))
+
+    return _write_chips_to_fitsdata(
+        chips,
+        primary_header=fits.Header(list(science.header.items())),
+        extra_attrs={"is_calibrated": True},
+        output=params.get("output"),
+    )
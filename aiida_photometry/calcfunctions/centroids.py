@@ -1,5 +1,6 @@
 from aiida.engine import calcfunction
 from aiida.orm import Dict, ArrayData
+import warnings
 import numpy as np
 from photutils import DAOStarFinder
 
@@ -11,7 +12,14 @@ from photutils.centroids import (
     centroid_sources,
 )
 
-from aiida_photometry.data.fits_data import FitsData
+from aiida_photometry.data.fits_data import FitsData, memmap_hdu
+from aiida_photometry.instrumentation import instrumented, phase
+from aiida_photometry.utils import (
+    chip_label,
+    gather_stamps,
+    parallel_map,
+    tile_layout,
+)
 
 
 def _centroid_to_dict(x, y):
@@ -23,6 +31,141 @@ def _centroid_to_dict(x, y):
     )
 
 
+def _stamp_com(stamps):
+    # Centre of mass of every stamp; pixels outside the image are NaN
+    weights = np.nan_to_num(stamps, nan=0.0)
+    index = np.arange(stamps.shape[-1])
+
+    total = weights.sum(axis=(1, 2))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        xc = (weights.sum(axis=1) * index).sum(axis=1) / total
+        yc = (weights.sum(axis=2) * index).sum(axis=1) / total
+
+    return xc, yc, total > 0
+
+
+def _stamp_quadratic(stamps, fit_boxsize=5):
+    """
+    Vectorised photutils.centroids.centroid_quadratic on a stack of stamps.
+
+    A 2D quadratic is fitted to the fit_boxsize x fit_boxsize pixels around
+    each stamp's peak. All fits share one design matrix, so every stamp is
+    solved with a single matrix product.
+    """
+    n_stamps, size, _ = stamps.shape
+    fit_boxsize = min(fit_boxsize, size)
+
+    filled = np.where(np.isfinite(stamps), stamps, -np.inf).reshape(n_stamps, -1)
+    ypeak, xpeak = np.unravel_index(filled.argmax(axis=1), (size, size))
+
+    # Fit box around the peak, shifted to stay inside the stamp
+    half = fit_boxsize // 2
+    x0 = np.clip(xpeak - half, 0, size - fit_boxsize)
+    y0 = np.clip(ypeak - half, 0, size - fit_boxsize)
+    offsets = np.arange(fit_boxsize)
+    rows = (y0[:, None] + offsets)[:, :, None]
+    cols = (x0[:, None] + offsets)[:, None, :]
+    values = stamps[np.arange(n_stamps)[:, None, None], rows, cols]
+    values = values.reshape(n_stamps, -1)
+
+    yy, xx = np.mgrid[0:fit_boxsize, 0:fit_boxsize]
+    xx, yy = xx.ravel(), yy.ravel()
+    design = np.column_stack([np.ones_like(xx), xx, yy, xx**2, xx * yy, yy**2])
+    coeffs = np.nan_to_num(values) @ np.linalg.pinv(design).T
+
+    _, c10, c01, c20, c11, c02 = coeffs.T
+    det = 4 * c20 * c02 - c11**2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        xm = (c11 * c01 - 2 * c02 * c10) / det
+        ym = (c11 * c10 - 2 * c20 * c01) / det
+
+    converged = (
+        np.isfinite(values).all(axis=1)
+        & (det > 0)
+        & (c20 < 0)
+        & (xm >= 0)
+        & (xm <= fit_boxsize - 1)
+        & (ym >= 0)
+        & (ym <= fit_boxsize - 1)
+    )
+
+    return x0 + xm, y0 + ym, converged
+
+
+def _fit_gaussian_stamps(job):
+    """
+    Gaussian centroids of a chunk of stamps; runs in a worker process.
+
+    photutils does not return the fitter status, but its fitter warns when
+    the fit may not have converged (e.g. the evaluation limit was reached);
+    such fits are flagged.
+    """
+    method, stamps = job
+    centroid_func = centroid_1dg if method == "1dg" else centroid_2dg
+
+    xc = np.full(len(stamps), np.nan)
+    yc = np.full(len(stamps), np.nan)
+    converged = np.zeros(len(stamps), dtype=bool)
+    for i, stamp in enumerate(stamps):
+        mask = ~np.isfinite(stamp)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            try:
+                xc[i], yc[i] = centroid_func(np.where(mask, 0.0, stamp), mask=mask)
+            except (ValueError, RuntimeError):
+                continue
+        converged[i] = not any(
+            "fit may be unsuccessful" in str(warning.message) for warning in caught
+        )
+
+    return xc, yc, converged
+
+
+def _batched_centroids(data, x, y, method, box_size, max_workers, fit_boxsize):
+    """
+    Refine many positions from box_size x box_size stamps around each one.
+
+    Returns refined (x, y) and a convergence flag. Sources whose fit did not
+    converge, or moved outside their stamp, keep their input position.
+    """
+    half = box_size // 2
+    ix = np.round(x).astype(int)
+    iy = np.round(y).astype(int)
+    stamps = gather_stamps(data, ix, iy, half)
+
+    if method == "com":
+        xc, yc, converged = _stamp_com(stamps)
+    elif method == "quadratic":
+        xc, yc, converged = _stamp_quadratic(stamps, fit_boxsize)
+    elif method in ("1dg", "2dg"):
+        n_chunks = max(1, 4 * (max_workers or 1))
+        chunks = np.array_split(stamps, n_chunks)
+        results = parallel_map(
+            _fit_gaussian_stamps,
+            [(method, chunk) for chunk in chunks if len(chunk)],
+            max_workers=max_workers,
+            executor="process",
+        )
+        xc, yc, converged = (np.concatenate([r[i] for r in results]) for i in range(3))
+    else:
+        raise ValueError(f"Unknown centroid method: {method}")
+
+    converged &= (
+        np.isfinite(xc)
+        & np.isfinite(yc)
+        & (xc >= 0)
+        & (xc <= box_size - 1)
+        & (yc >= 0)
+        & (yc <= box_size - 1)
+    )
+
+    xcen = np.where(converged, ix - half + xc, x)
+    ycen = np.where(converged, iy - half + yc, y)
+
+    return xcen, ycen, converged
+
+
+@instrumented
 @calcfunction
 def centroid_com_cf(
     image: FitsData,
@@ -43,6 +186,7 @@ def centroid_com_cf(
     return _centroid_to_dict(x, y)
 
 
+@instrumented
 @calcfunction
 def centroid_quadratic_cf(
     image: FitsData,
@@ -63,6 +207,7 @@ def centroid_quadratic_cf(
     return _centroid_to_dict(x, y)
 
 
+@instrumented
 @calcfunction
 def centroid_1dg_cf(
     image: FitsData,
@@ -83,6 +228,7 @@ def centroid_1dg_cf(
     return _centroid_to_dict(x, y)
 
 
+@instrumented
 @calcfunction
 def centroid_2dg_cf(
     image: FitsData,
@@ -103,6 +249,7 @@ def centroid_2dg_cf(
     return _centroid_to_dict(x, y)
 
 
+@instrumented
 @calcfunction
 def centroid_sources_cf(
     image: FitsData, positions: ArrayData, options: Dict
@@ -110,17 +257,19 @@ def centroid_sources_cf(
     """
     Refine given source positions using centroid_sources.
     """
-    ccd = image.get_ccddata()
-    img_array = ccd.data
     xpos = np.array(positions.get_array("x"), dtype=float)
     ypos = np.array(positions.get_array("y"), dtype=float)
     kwargs = options.get_dict()
 
-    xcen, ycen = centroid_sources(img_array, xpos, ypos, **kwargs)
+    # centroid_sources works on per-source cutouts, so a memory-mapped image
+    # only pulls the pixels around each source from disk
+    with image.memmap_array() as img_array:
+        with phase("photutils_centroid"):
+            xcen, ycen = centroid_sources(img_array, xpos, ypos, **kwargs)
+
+    xcen = np.array(xcen, dtype=float)
+    ycen = np.array(ycen, dtype=float)
 
-    xcen = np.array(xcen, dtype=float)[:10]
-    ycen = np.array(ycen, dtype=float)[:10]
-    
     # Clean NaNs/Infs
     xcen = np.nan_to_num(xcen, nan=-1.0, posinf=-1.0, neginf=-1.0)
     ycen = np.nan_to_num(ycen, nan=-1.0, posinf=-1.0, neginf=-1.0)
@@ -132,34 +281,193 @@ def centroid_sources_cf(
     return result
 
 
+def _find_sources(data, threshold, fwhm):
+    daofinder = DAOStarFinder(threshold=threshold, fwhm=fwhm, exclude_border=True)
+    with phase("photutils_detect"):
+        sources_table = daofinder(data)
+
+    if sources_table is None or len(sources_table) == 0:
+        return np.array([], dtype=float), np.array([], dtype=float)
+
+    xpos = getattr(sources_table["xcentroid"], "value", sources_table["xcentroid"])
+    ypos = getattr(sources_table["ycentroid"], "value", sources_table["ycentroid"])
+    return np.array(xpos, dtype=float), np.array(ypos, dtype=float)
+
+
+def _catalog_order(x, y):
+    # Row, then column, of the nearest pixel; stable for sources sharing one
+    return np.lexsort((np.floor(x + 0.5), np.floor(y + 0.5)))
+
+
+def _detect_tile(job):
+    """
+    Run the finder on one padded tile; runs in a worker process.
+
+    The tile is sliced from the memory-mapped file in the worker, so only
+    one tile per worker is held in memory. Only sources whose nearest pixel
+    lies in the tile core are kept, so every source of the overlap zones is
+    reported by exactly one tile.
+    """
+    path, hdu_index, core, padded, threshold, fwhm = job
+    cy0, cy1, cx0, cx1 = core
+    py0, py1, px0, px1 = padded
+
+    with memmap_hdu(path, hdu_index) as data:
+        x, y = _find_sources(data[py0:py1, px0:px1], threshold, fwhm)
+    x += px0
+    y += py0
+
+    ix = np.floor(x + 0.5)
+    iy = np.floor(y + 0.5)
+    owned = (ix >= cx0) & (ix < cx1) & (iy >= cy0) & (iy < cy1)
+    return x[owned], y[owned]
+
+
+@instrumented
 @calcfunction
 def detect_sources_cf(image: FitsData, options: Dict) -> ArrayData:
     """
     Detect sources in an image using DAOStarFinder.
 
+    options:
+        Dict with keys:
+            - threshold, fwhm: DAOStarFinder parameters
+            - tile_size: run the finder on tiles of this size in a process
+              pool instead of a single pass over the frame
+            - tile_overlap: margin around each tile (default max(16, 4*fwhm));
+              must cover the finder kernel for the catalog to match the
+              single-pass one
+            - max_workers: processes for the tiled mode (default: all cores)
+
+    Sources are ordered by row, then column, of their nearest pixel, so
+    tiled and single-pass catalogs list the same sources in the same order.
+
     Returns ArrayData with 'x' and 'y'.
     """
-    ccd = image.get_ccddata()
-    img_array = ccd.data
     kwargs = options.get_dict()
 
     threshold = kwargs.get("threshold", 3.0)
     fwhm = kwargs.get("fwhm", 3.0)
-    daofinder = DAOStarFinder(threshold=threshold, fwhm=fwhm, exclude_border = True)
+    tile_size = kwargs.get("tile_size")
 
-    sources_table = daofinder(img_array)
-
-    if sources_table is None or len(sources_table) == 0:
-        xpos = np.array([], dtype=float)
-        ypos = np.array([], dtype=float)
+    if not tile_size:
+        with image.memmap_array() as img_array:
+            xpos, ypos = _find_sources(img_array, threshold, fwhm)
     else:
-        xpos = getattr(sources_table["xcentroid"], "value", sources_table["xcentroid"])
-        ypos = getattr(sources_table["ycentroid"], "value", sources_table["ycentroid"])
-        xpos = np.array(xpos, dtype=float)
-        ypos = np.array(ypos, dtype=float)
+        overlap = int(kwargs.get("tile_overlap", max(16, int(4 * fwhm))))
+        shape = image.base.attributes.get("shape")
+        with image.as_path() as path:
+            jobs = [
+                (path, image.image_hdu, core, padded, threshold, fwhm)
+                for core, padded in tile_layout(shape, int(tile_size), overlap)
+            ]
+            results = parallel_map(
+                _detect_tile,
+                jobs,
+                max_workers=kwargs.get("max_workers"),
+                executor="process",
+            )
+        xpos = np.concatenate([x for x, _ in results])
+        ypos = np.concatenate([y for _, y in results])
+
+    order = _catalog_order(xpos, ypos)
+    xpos, ypos = xpos[order], ypos[order]
 
     result = ArrayData()
     result.set_array("x", xpos)
     result.set_array("y", ypos)
 
     return result
+
+
+@instrumented
+@calcfunction
+def centroid_batch_cf(
+    image: FitsData, positions: ArrayData, options: Dict
+) -> ArrayData:
+    """
+    Refine thousands of source positions at once.
+
+    options:
+        Dict with keys:
+            - method: "com" (default), "quadratic", "1dg" or "2dg"
+            - box_size: odd cutout size around each source (default 11)
+            - fit_boxsize: quadratic fit box (default 5)
+            - max_workers: processes for the Gaussian fits (default: all cores)
+
+    Centre of mass and quadratic centroids are computed for all cutouts in
+    one vectorised step; Gaussian fits are spread over a process pool.
+
+    Returns ArrayData with 'x', 'y' for every input position and a boolean
+    'converged' flag; unconverged sources keep their input position.
+    """
+    params = options.get_dict()
+    method = params.get("method", "com")
+    box_size = int(params.get("box_size", 11)) | 1
+    fit_boxsize = int(params.get("fit_boxsize", 5))
+    max_workers = params.get("max_workers", None)
+
+    xpos = np.array(positions.get_array("x"), dtype=float)
+    ypos = np.array(positions.get_array("y"), dtype=float)
+
+    with image.memmap_array() as data:
+        xcen, ycen, converged = _batched_centroids(
+            data, xpos, ypos, method, box_size, max_workers, fit_boxsize
+        )
+
+    result = ArrayData()
+    result.set_array("x", xcen)
+    result.set_array("y", ycen)
+    result.set_array("converged", converged)
+    return result
+
+
+def _detect_chip(job):
+    # One chip of a mosaic, read in its worker process
+    path, hdu_index, threshold, fwhm = job
+    with memmap_hdu(path, hdu_index) as data:
+        return _find_sources(data, threshold, fwhm)
+
+
+@instrumented
+@calcfunction
+def detect_sources_mef_cf(image: FitsData, options: Dict) -> ArrayData:
+    """
+    Detect sources on every chip of a multi-extension image in parallel.
+
+    options:
+        threshold, fwhm as detect_sources_cf, plus max_workers: chips
+        searched at once in a process pool (default: all cores).
+
+    Returns one ArrayData for all chips with 'x', 'y' in chip pixel
+    coordinates and 'chip', the position of each source's chip in the
+    'chips' (labels) and 'hdu_indices' attributes.
+    """
+    kwargs = options.get_dict()
+    threshold = kwargs.get("threshold", 3.0)
+    fwhm = kwargs.get("fwhm", 3.0)
+    extensions = image.image_extensions()
+
+    with image.as_path() as path:
+        results = parallel_map(
+            _detect_chip,
+            [(path, ext["index"], threshold, fwhm) for ext in extensions],
+            max_workers=kwargs.get("max_workers"),
+            executor="process",
+        )
+
+    result = ArrayData()
+    result.set_array("x", np.concatenate([x for x, _ in results]))
+    result.set_array("y", np.concatenate([y for _, y in results]))
+    result.set_array(
+        "chip",
+        np.concatenate(
+            [np.full(len(x), i, dtype=int) for i, (x, _) in enumerate(results)]
+        ),
+    )
+    result.base.attributes.set(
+        "chips", [chip_label(ext["extname"], ext["index"]) for ext in extensions]
+    )
+    result.base.attributes.set("hdu_indices", [ext["index"] for ext in extensions])
+
+    return result
@@ -0,0 +1,151 @@
+from aiida.engine import calcfunction
+from aiida.orm import ArrayData, Dict
+
+import ccdproc
+import numpy as np
+from astropy.nddata import CCDData
+
+from aiida_photometry.data.fits_data import FitsData, memmap_hdu
+from aiida_photometry.instrumentation import instrumented, phase
+from aiida_photometry.utils import (
+    _write_ccd_to_fitsdata,
+    parallel_map,
+    tile_layout,
+)
+
+LACOSMIC_KEYS = (
+    "sigclip",
+    "sigfrac",
+    "objlim",
+    "satlevel",
+    "niter",
+    "sepmed",
+    "cleantype",
+    "fsmode",
+    "psfmodel",
+    "psffwhm",
+    "psfsize",
+)
+
+
+def _lacosmic(data, kwargs):
+    # L.A.Cosmic computes in float32: only its values of the masked pixels
+    # are used, so the other pixels keep the precision of the input
+    with phase("lacosmic"):
+        cleaned, mask = ccdproc.cosmicray_lacosmic(data, gain_apply=False, **kwargs)
+    return np.asarray(cleaned), np.asarray(mask, dtype=bool)
+
+
+def _lacosmic_tile(job):
+    """
+    Clean one padded tile and return the mask and replacement values of its
+    core; runs in a worker process, which reads the tile from the file.
+    """
+    source, core, padded, kwargs = job
+    cy0, cy1, cx0, cx1 = core
+    py0, py1, px0, px1 = padded
+
+    with memmap_hdu(*source) as data:
+        cleaned, mask = _lacosmic(np.array(data[py0:py1, px0:px1]), kwargs)
+
+    inner = (slice(cy0 - py0, cy1 - py0), slice(cx0 - px0, cx1 - px0))
+    return mask[inner], cleaned[inner][mask[inner]]
+
+
+def _tiled_lacosmic(source, shape, kwargs, tile_size, overlap, max_workers):
+    """
+    L.A.Cosmic on overlapping tiles in a process pool.
+
+    Workers read their tile from `source`, the (path, HDU index) of the
+    image. The result for a pixel only depends on a neighbourhood that grows
+    by a few pixels per iteration. When the overlap covers that reach for
+    all iterations, the core of each tile matches a single pass over the
+    frame.
+
+    Returns (core, mask, replacement values) of every tile.
+    """
+    tiles = tile_layout(shape, tile_size, overlap)
+    jobs = [(source, core, padded, kwargs) for core, padded in tiles]
+    results = parallel_map(
+        _lacosmic_tile, jobs, max_workers=max_workers, executor="process"
+    )
+    return [(core, mask, values) for (core, _), (mask, values) in zip(tiles, results)]
+
+
+@instrumented
+@calcfunction
+def cosmicray_lacosmic_cf(image: FitsData, options: Dict = None):
+    """
+    Remove cosmic rays with L.A.Cosmic (ccdproc.cosmicray_lacosmic).
+
+    options:
+        Optional Dict with keys:
+            - gain, readnoise: default to the GAIN/RDNOISE header values
+              (1.0 and 6.5 if missing); the data is not gain corrected
+            - sigclip, sigfrac, objlim, satlevel, niter, ...: passed on
+            - tile_size: clean tiles of this size in a process pool
+              (default 1024, 0 for a single pass)
+            - tile_overlap: margin around each tile (default 8 * niter)
+            - max_workers: processes for the tiles (default: all cores)
+            - output: dtype/compression of the written file
+
+    Returns 'cleaned', the cleaned image with the cosmic rays added to its
+    mask, and 'cr_mask', an ArrayData with the uint8 array 'mask' (1 for
+    cosmic-ray pixels) and the 'n_pixels' attribute.
+    """
+    params = options.get_dict() if options is not None else {}
+    header = image.header
+
+    kwargs = {key: params[key] for key in LACOSMIC_KEYS if key in params}
+    kwargs["gain"] = params.get("gain", header.get("GAIN", 1.0))
+    kwargs["readnoise"] = params.get("readnoise", header.get("RDNOISE", 6.5))
+    niter = kwargs.get("niter", 4)
+
+    ccd = image.get_ccddata()
+    # Unmasked pixels keep the input values; integer data becomes float
+    dtype = np.result_type(ccd.data.dtype, np.float32)
+    if ccd.data.dtype == dtype and ccd.data.flags.writeable:
+        cleaned = ccd.data
+    else:
+        cleaned = np.array(ccd.data, dtype=dtype)
+
+    tile_size = params.get("tile_size", 1024)
+    if tile_size and max(ccd.shape) > tile_size:
+        cr_mask = np.zeros(ccd.shape, dtype=bool)
+        with image.as_path() as path:
+            tiles = _tiled_lacosmic(
+                (path, image.image_hdu),
+                ccd.shape,
+                kwargs,
+                int(tile_size),
+                int(params.get("tile_overlap", 8 * niter)),
+                params.get("max_workers"),
+            )
+        for (cy0, cy1, cx0, cx1), mask, values in tiles:
+            cr_mask[cy0:cy1, cx0:cx1] = mask
+            cleaned[cy0:cy1, cx0:cx1][mask] = values
+    else:
+        values, cr_mask = _lacosmic(ccd.data, kwargs)
+        cleaned[cr_mask] = values[cr_mask]
+
+    mask = cr_mask if ccd.mask is None else (ccd.mask | cr_mask)
+    result = CCDData(
+        cleaned,
+        unit=ccd.unit,
+        meta=ccd.meta.copy(),
+        mask=mask,
+        uncertainty=ccd.uncertainty,
+    )
+    result.meta["CRCLEAN"] = "LACOSMIC"
+
+    cleaned_node = _write_ccd_to_fitsdata(
+        result,
+        extra_attrs={"cosmic_rays_removed": True},
+        output=params.get("output"),
+    )
+
+    mask_node = ArrayData()
+    mask_node.set_array("mask", cr_mask.astype(np.uint8))
+    mask_node.base.attributes.set("n_pixels", int(cr_mask.sum()))
+
+    return {"cleaned": cleaned_node, "cr_mask": mask_node}
@@ -0,0 +1,188 @@
+from aiida.engine import calcfunction
+from aiida.orm import ArrayData, Dict
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from aiida_photometry.instrumentation import instrumented, phase
+
+
+def _positions(node):
+    x = np.asarray(node.get_array("x"), dtype=float)
+    y = np.asarray(node.get_array("y"), dtype=float)
+    return np.column_stack([x, y])
+
+
+def _nearest_matches(ref_points, tree, offset, tolerance, workers, k=4):
+    """
+    One-to-one nearest-neighbour matches within `tolerance`.
+
+    Returns, per reference source, the index of its match in the tree (-1
+    if none) and the separation (NaN if none). The `k` nearest catalog
+    sources of every reference source are candidates, and pairs are
+    assigned greedily from the closest: a reference source whose nearest
+    catalog source went to a closer reference source is matched to its next
+    free candidate.
+    """
+    separation, index = tree.query(
+        ref_points + offset,
+        k=max(1, k),
+        distance_upper_bound=tolerance,
+        workers=workers,
+    )
+    separation = separation.reshape(len(ref_points), -1)
+    index = index.reshape(len(ref_points), -1)
+
+    rows, columns = np.nonzero(np.isfinite(separation))
+    order = np.argsort(separation[rows, columns], kind="stable")
+    rows, columns = rows[order], columns[order]
+
+    matched_index = np.full(len(ref_points), -1, dtype=np.int64)
+    matched_separation = np.full(len(ref_points), np.nan)
+    taken = np.zeros(tree.n, dtype=bool)
+    for row, column in zip(rows.tolist(), columns.tolist()):
+        candidate = index[row, column]
+        if matched_index[row] >= 0 or taken[candidate]:
+            continue
+        taken[candidate] = True
+        matched_index[row] = candidate
+        matched_separation[row] = separation[row, column]
+
+    return matched_index, matched_separation
+
+
+def _vote_offset(ref_points, tree, search_radius, bin_size):
+    """
+    Most common displacement between reference and catalog sources.
+
+    All pairs closer than `search_radius` are histogrammed; the peak of the
+    2D histogram is the offset of the frame, with true pairs adding up in
+    one bin and chance pairs spread over all of them.
+    """
+    pairs = cKDTree(ref_points).sparse_distance_matrix(
+        tree, search_radius, output_type="ndarray"
+    )
+    if len(pairs) == 0:
+        return np.zeros(2)
+
+    delta = tree.data[pairs["j"]] - ref_points[pairs["i"]]
+    n_bins = max(1, int(np.ceil(2 * search_radius / bin_size)))
+    edges = np.linspace(-search_radius, search_radius, n_bins + 1)
+    counts, _, _ = np.histogram2d(delta[:, 0], delta[:, 1], bins=(edges, edges))
+
+    peak_x, peak_y = np.unravel_index(np.argmax(counts), counts.shape)
+    centre = (edges[:-1] + edges[1:]) / 2
+    return np.array([centre[peak_x], centre[peak_y]])
+
+
+def _fit_offset(ref_points, tree, start, params, workers):
+    """
+    Per-frame translation: histogram vote, then the median displacement of
+    the matched pairs, iterated with the matching tolerance.
+    """
+    tolerance = params.get("tolerance", 1.0)
+    offset = np.asarray(start, dtype=float)
+    search_radius = params.get("search_radius", 20.0)
+    if search_radius > 0:
+        offset = offset + _vote_offset(
+            ref_points + offset, tree, search_radius, max(tolerance, 0.5)
+        )
+
+    for _ in range(params.get("offset_iterations", 3)):
+        index, _ = _nearest_matches(ref_points, tree, offset, 2 * tolerance, workers)
+        matched = index >= 0
+        if matched.sum() < params.get("min_matches", 3):
+            break
+        offset = np.median(tree.data[index[matched]] - ref_points[matched], axis=0)
+
+    return offset
+
+
+@instrumented
+@calcfunction
+def crossmatch_sources_cf(
+    reference: ArrayData,
+    options: Dict = None,
+    offsets: ArrayData = None,
+    **catalogs,
+) -> ArrayData:
+    """
+    Match source lists of many frames against a reference source list.
+
+    Each catalog is indexed with a KD-tree and queried once for all
+    reference sources, so a match costs O(log N) instead of a scan of the
+    catalog. Matches are one to one and assigned greedily from the closest
+    pair: a catalog source claimed by several reference sources is kept by
+    the nearest, and the others fall back to their next candidate.
+
+    reference, catalogs:
+        ArrayData with arrays 'x' and 'y', e.g. outputs of
+        SourceDetectionWorkChain.
+
+    offsets:
+        Optional output of register_frames_cf; the offset of every catalog
+        with the same label is applied before matching.
+
+    options:
+        Optional Dict with keys:
+            - tolerance: maximum separation in pixels (default 1.0)
+            - candidates: nearest catalog sources considered per reference
+              source (default 4)
+            - fit_offset: fit a translation per catalog first (default
+              False), by a histogram vote of the displacements of all pairs
+              closer than 'search_radius' (default 20, 0 to skip the vote)
+              refined by the median of the matched pairs
+            - offset_iterations, min_matches: refinement passes (default 3)
+              and matches needed to update the offset (default 3)
+            - workers: threads of the KD-tree queries (default 1, -1 for
+              all cores)
+
+    Returns ArrayData with 'index' and 'separation' (catalogs x reference
+    sources; -1 and NaN where unmatched, separations after the offset), the
+    applied offsets 'dx' and 'dy', 'n_matched' and the 'catalog' labels.
+    A source at (x, y) in the reference is expected at (x + dx, y + dy).
+    """
+    params = options.get_dict() if options is not None else {}
+    tolerance = params.get("tolerance", 1.0)
+    workers = params.get("workers", 1)
+    candidates = params.get("candidates", 4)
+
+    ref_points = _positions(reference)
+    labels = list(catalogs)
+
+    start = {}
+    if offsets is not None:
+        known = offsets.base.attributes.get("labels", [])
+        dx, dy = offsets.get_array("dx"), offsets.get_array("dy")
+        start = {label: (dx[i], dy[i]) for i, label in enumerate(known)}
+
+    index = np.full((len(labels), len(ref_points)), -1, dtype=np.int64)
+    separation = np.full(index.shape, np.nan)
+    applied = np.zeros((len(labels), 2))
+
+    with phase("crossmatch"):
+        for row, label in enumerate(labels):
+            points = _positions(catalogs[label])
+            if len(points) == 0 or len(ref_points) == 0:
+                continue
+
+            tree = cKDTree(points)
+            offset = np.asarray(start.get(label, (0.0, 0.0)), dtype=float)
+            if params.get("fit_offset", False):
+                offset = _fit_offset(ref_points, tree, offset, params, workers)
+
+            index[row], separation[row] = _nearest_matches(
+                ref_points, tree, offset, tolerance, workers, candidates
+            )
+            applied[row] = offset
+
+    matches = ArrayData()
+    matches.set_array("index", index)
+    matches.set_array("separation", separation)
+    matches.set_array("dx", applied[:, 0])
+    matches.set_array("dy", applied[:, 1])
+    matches.set_array("n_matched", (index >= 0).sum(axis=1))
+    matches.set_array("catalog", np.array(labels, dtype=str))
+    matches.base.attributes.set("tolerance", tolerance)
+
+    return matches
@@ -0,0 +1,552 @@
+from aiida.engine import calcfunction
+from aiida.orm import ArrayData, Dict
+
+import numpy as np
+from astropy.stats import gaussian_fwhm_to_sigma
+from astropy.table import QTable
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+from scipy.special import erf
+
+from aiida_photometry.calcfunctions.aperture import _photometry_output, _split_options
+from aiida_photometry.data.fits_data import FitsData
+from aiida_photometry.instrumentation import instrumented, phase
+from aiida_photometry.utils import gather_stamps, parallel_map
+
+# Isolated stars fitted in one vectorised batch
+ISOLATED_BATCH = 4096
+
+# Groups sent to a worker process at once
+GROUP_CHUNK = 256
+
+# Largest blend fitted as one system; larger groups are split
+MAX_GROUP_SIZE = 25
+
+# Factor applied to the grouping separation at each split of a blend
+GROUP_SPLIT_FACTOR = 0.8
+
+# Rebuilds of the empirical PSF from stars fitted with the previous model
+EMPIRICAL_ITERATIONS = 1
+
+# Keys of the 'psf' Dict and the supported models
+PSF_KEYS = ("model", "fwhm", "fit_shape", "size", "n_stars")
+PSF_MODELS = ("gaussian", "empirical")
+
+# Fitted columns, in the order _fit_psf returns them
+FIT_COLUMNS = (
+    "x_fit",
+    "y_fit",
+    "flux_fit",
+    "x_err",
+    "y_err",
+    "flux_err",
+    "local_bkg",
+    "reduced_chi2",
+    "converged",
+)
+
+
+def _odd(value):
+    value = int(np.ceil(value))
+    return value if value % 2 else value + 1
+
+
+def _psf_groups(x, y, separation, max_size=None):
+    """
+    Label stars whose fit boxes overlap: a KD-tree finds all pairs closer
+    than `separation` (Chebyshev distance), connected components join them.
+
+    Groups of more than `max_size` stars, which percolate through crowded
+    cores, are split by grouping their members again with a tighter
+    separation, so no simultaneous fit grows beyond max_size stars. Below a
+    separation of one pixel the members are split in chunks along x.
+    """
+    n = len(x)
+    if n == 0:
+        return np.zeros(0, dtype=int)
+
+    pairs = cKDTree(np.column_stack([x, y])).query_pairs(
+        separation, p=np.inf, output_type="ndarray"
+    )
+    graph = coo_matrix(
+        (np.ones(len(pairs), dtype=bool), (pairs[:, 0], pairs[:, 1])), shape=(n, n)
+    )
+    n_groups, labels = connected_components(graph, directed=False)
+    if max_size is None:
+        return labels
+
+    sizes = np.bincount(labels)
+    for label in np.flatnonzero(sizes > max_size):
+        members = np.flatnonzero(labels == label)
+        if separation * GROUP_SPLIT_FACTOR >= 1.0:
+            sub = _psf_groups(
+                x[members], y[members], separation * GROUP_SPLIT_FACTOR, max_size
+            )
+        else:
+            sub = np.empty(len(members), dtype=int)
+            sub[np.argsort(x[members], kind="stable")] = (
+                np.arange(len(members)) // max_size
+            )
+        labels[members] = n_groups + sub
+        n_groups += sub.max() + 1
+
+    # Consecutive labels in order of first appearance
+    _, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=int)
+    rank[np.argsort(first, kind="stable")] = np.arange(len(first))
+    return rank[inverse]
+
+
+def _gaussian_profile(model, dx, dy):
+    """
+    Pixel-integrated circular Gaussian and its derivatives with respect to
+    the star position, at offsets (dx, dy) of the pixel centres.
+    """
+    scale = np.sqrt(2.0) * model["sigma"]
+    norm = 1.0 / (np.sqrt(2.0 * np.pi) * model["sigma"])
+
+    def axis(d):
+        upper, lower = (d + 0.5) / scale, (d - 0.5) / scale
+        value = 0.5 * (erf(upper) - erf(lower))
+        derivative = -norm * (np.exp(-(upper**2)) - np.exp(-(lower**2)))
+        return value, derivative
+
+    gx, dgx = axis(dx)
+    gy, dgy = axis(dy)
+    return gx * gy, dgx * gy, gx * dgy
+
+
+def _empirical_profile(model, dx, dy):
+    # Cubic spline interpolation of the PSF image and of its gradients,
+    # whose spline coefficients were computed once
+    coords = np.stack([dy.ravel() + model["center"], dx.ravel() + model["center"]])
+
+    def sample(coeffs):
+        values = ndimage.map_coordinates(
+            coeffs, coords, order=3, mode="constant", cval=0.0, prefilter=False
+        )
+        return values.reshape(dx.shape)
+
+    return (
+        sample(model["coeffs"]),
+        -sample(model["grad_x"]),
+        -sample(model["grad_y"]),
+    )
+
+
+def _psf_profile(model, dx, dy):
+    if model["kind"] == "gaussian":
+        return _gaussian_profile(model, dx, dy)
+    return _empirical_profile(model, dx, dy)
+
+
+def _stacked_model(stamps, shifts, flux):
+    # Median of the stamps, shifted onto the stamp centre and normalised
+    centred = [
+        ndimage.shift(stamp, shift, order=3, mode="nearest") / total
+        for stamp, shift, total in zip(stamps, shifts, flux)
+    ]
+    psf = np.clip(np.median(centred, axis=0), 0.0, None)
+    psf /= psf.sum()
+    grad_y, grad_x = np.gradient(psf)
+
+    return {
+        "kind": "empirical",
+        "center": len(psf) // 2,
+        "image": psf,
+        "coeffs": ndimage.spline_filter(psf, order=3),
+        "grad_x": ndimage.spline_filter(grad_x, order=3),
+        "grad_y": ndimage.spline_filter(grad_y, order=3),
+    }
+
+
+def _empirical_model(data, x, y, size, n_stars, fwhm, half, maxiters, tol):
+    """
+    Median of the normalised, re-centred stamps of the brightest isolated
+    stars; their neighbours lie further away than the stamp size.
+
+    As in photutils' EPSFBuilder, the stamps are centred on fitted rather
+    than input positions: first on a Gaussian fit of the given FWHM, then,
+    EMPIRICAL_ITERATIONS times, on a fit with the model built so far. The
+    fitted fluxes normalise the stamps.
+    """
+    points = np.column_stack([x, y])
+    if len(points) > 1:
+        distance, _ = cKDTree(points).query(points, k=2)
+        isolated = distance[:, 1] > size
+    else:
+        isolated = np.ones(len(points), dtype=bool)
+
+    ix, iy = np.round(x).astype(int), np.round(y).astype(int)
+    stamps = gather_stamps(data, ix[isolated], iy[isolated], size // 2)
+    complete = np.isfinite(stamps).all(axis=(1, 2))
+    stamps = stamps[complete]
+    if len(stamps) == 0:
+        raise ValueError("No isolated stars to build an empirical PSF from")
+
+    border = np.concatenate(
+        [stamps[:, 0], stamps[:, -1], stamps[:, 1:-1, 0], stamps[:, 1:-1, -1]],
+        axis=1,
+    )
+    stamps = stamps - np.median(border, axis=1)[:, None, None]
+    brightest = np.argsort(stamps.sum(axis=(1, 2)))[::-1][:n_stars]
+    stamps = stamps[brightest]
+    stars = np.flatnonzero(isolated)[complete][brightest]
+    ix, iy = ix[stars], iy[stars]
+
+    model = {"kind": "gaussian", "sigma": fwhm * gaussian_fwhm_to_sigma}
+    fx, fy = x[stars], y[stars]
+    for _ in range(EMPIRICAL_ITERATIONS + 1):
+        fitted = _fit_isolated(data, fx, fy, half, model, True, maxiters, tol)
+        fx, fy, flux = (values[:, 0] for values in fitted[:3])
+        usable = flux > 0
+        model = _stacked_model(
+            stamps[usable],
+            np.column_stack([iy - fy, ix - fx])[usable],
+            flux[usable],
+        )
+
+    return model
+
+
+def _fit_psf(xx, yy, values, weights, x, y, model, fit_positions, maxiters, tol):
+    """
+    Gauss-Newton fit of fluxes, positions and a constant background.
+
+    Fits B independent problems at once: xx, yy, values and weights are
+    (B, P) pixel coordinates, values and 0/1 weights, x and y the (B, K)
+    initial positions. The first iteration solves for the fluxes and the
+    background only, which is also the whole fit when the positions are
+    fixed.
+
+    As in DAOPHOT's ALLSTAR, position steps are clamped per star, and the
+    clamp shrinks to half the step whenever a step reverses the previous
+    one: faint stars otherwise oscillate around their minimum instead of
+    converging.
+
+    Returns the fitted x, y, flux, their errors, the background, the
+    reduced chi-square and the convergence flag, all (B, K) or (B,).
+    """
+    n_batch, n_stars = x.shape
+    maxiters = max(1, maxiters)
+    x, y = x.astype(float), y.astype(float)
+    flux = np.zeros((n_batch, n_stars))
+    background = np.zeros(n_batch)
+    values = np.where(weights > 0, values, 0.0)
+    converged = np.zeros(n_batch, dtype=bool)
+    # Largest position step per star, starting at a pixel
+    clamp_x, clamp_y = np.ones_like(x), np.ones_like(y)
+    last_x, last_y = np.zeros_like(x), np.zeros_like(y)
+
+    for iteration in range(maxiters + 1):
+        fit_xy = fit_positions and iteration > 0
+        profile, d_x, d_y = _psf_profile(
+            model, xx[:, :, None] - x[:, None, :], yy[:, :, None] - y[:, None, :]
+        )
+        columns = [profile]
+        if fit_xy:
+            columns += [flux[:, None, :] * d_x, flux[:, None, :] * d_y]
+        columns.append(np.ones(values.shape + (1,)))
+        jacobian = np.concatenate(columns, axis=2) * weights[:, :, None]
+
+        model_values = np.einsum("bpk,bk->bp", profile, flux) + background[:, None]
+        residual = (values - model_values) * weights
+        normal = np.einsum("bpm,bpn->bmn", jacobian, jacobian)
+        # A tiny ridge keeps stars without valid pixels solvable
+        diagonal = np.arange(normal.shape[1])
+        ridge = 1e-10 * normal[:, diagonal, diagonal].max(axis=1) + 1e-12
+        normal[:, diagonal, diagonal] += ridge[:, None]
+
+        # The final pass only evaluates the Jacobian for the errors
+        if iteration > 0 and (converged.all() or iteration == maxiters):
+            break
+
+        step = np.linalg.solve(
+            normal, np.einsum("bpm,bp->bm", jacobian, residual)[:, :, None]
+        )[:, :, 0]
+        flux += step[:, :n_stars]
+        background += step[:, -1]
+
+        if not fit_positions:
+            converged[:] = True
+        elif fit_xy:
+            step_x = step[:, n_stars : 2 * n_stars]
+            step_y = step[:, 2 * n_stars : 3 * n_stars]
+            flip_x, flip_y = step_x * last_x < 0, step_y * last_y < 0
+            clamp_x = np.where(flip_x, np.minimum(clamp_x, abs(step_x)) / 2, clamp_x)
+            clamp_y = np.where(flip_y, np.minimum(clamp_y, abs(step_y)) / 2, clamp_y)
+            step_x = np.clip(step_x, -clamp_x, clamp_x)
+            step_y = np.clip(step_y, -clamp_y, clamp_y)
+            last_x, last_y = step_x, step_y
+            x += np.where(converged[:, None], 0.0, step_x)
+            y += np.where(converged[:, None], 0.0, step_y)
+            converged |= np.maximum(abs(step_x), abs(step_y)).max(axis=1) < tol
+
+    n_params = normal.shape[1]
+    dof = np.maximum(weights.sum(axis=1) - n_params, 1)
+    chi2 = (residual**2).sum(axis=1) / dof
+    covariance = np.linalg.inv(normal) * chi2[:, None, None]
+    errors = np.sqrt(np.clip(covariance[:, diagonal, diagonal], 0.0, None))
+
+    flux_err = errors[:, :n_stars]
+    if n_params > n_stars + 1:
+        x_err = errors[:, n_stars : 2 * n_stars]
+        y_err = errors[:, 2 * n_stars : 3 * n_stars]
+    else:
+        x_err = y_err = np.zeros_like(flux_err)
+
+    return x, y, flux, x_err, y_err, flux_err, background, chi2, converged
+
+
+def _group_pixels(data, x, y, half):
+    """
+    Pixels within `half` of any member of a group, from its bounding box.
+    """
+    ny, nx = data.shape
+    ix, iy = np.round(x).astype(int), np.round(y).astype(int)
+    x0, x1 = max(ix.min() - half, 0), min(ix.max() + half + 1, nx)
+    y0, y1 = max(iy.min() - half, 0), min(iy.max() + half + 1, ny)
+
+    values = np.array(data[y0:y1, x0:x1], dtype=float)
+    yy, xx = np.mgrid[y0:y1, x0:x1]
+    near = np.zeros(values.shape, dtype=bool)
+    for cx, cy in zip(ix, iy):
+        near[
+            max(cy - half - y0, 0) : cy + half + 1 - y0,
+            max(cx - half - x0, 0) : cx + half + 1 - x0,
+        ] = True
+
+    keep = near & np.isfinite(values)
+    return xx[keep], yy[keep], values[keep]
+
+
+def _fit_groups(job):
+    """
+    Fit a chunk of blended groups, one simultaneous fit per group; runs in
+    a worker process.
+    """
+    groups, model, fit_positions, maxiters, tol = job
+    results = []
+    for xx, yy, values, x, y in groups:
+        fitted = _fit_psf(
+            xx[None],
+            yy[None],
+            values[None],
+            np.ones((1, len(values))),
+            x[None],
+            y[None],
+            model,
+            fit_positions,
+            maxiters,
+            tol,
+        )
+        results.append([value[0] for value in fitted])
+    return results
+
+
+def _fit_isolated(data, x, y, half, model, fit_positions, maxiters, tol):
+    """
+    Fit single stars in vectorised batches of square stamps.
+    """
+    size = 2 * half + 1
+    offsets = np.arange(-half, half + 1)
+    results = []
+
+    for start in range(0, len(x), ISOLATED_BATCH):
+        bx, by = x[start : start + ISOLATED_BATCH], y[start : start + ISOLATED_BATCH]
+        ix, iy = np.round(bx).astype(int), np.round(by).astype(int)
+
+        stamps = gather_stamps(data, ix, iy, half).reshape(len(bx), size * size)
+        xx = np.broadcast_to(
+            (ix[:, None] + offsets)[:, None, :], (len(bx), size, size)
+        ).reshape(len(bx), -1)
+        yy = np.broadcast_to(
+            (iy[:, None] + offsets)[:, :, None], (len(bx), size, size)
+        ).reshape(len(bx), -1)
+        weights = np.isfinite(stamps).astype(float)
+
+        results.append(
+            _fit_psf(
+                xx,
+                yy,
+                stamps,
+                weights,
+                bx[:, None],
+                by[:, None],
+                model,
+                fit_positions,
+                maxiters,
+                tol,
+            )
+        )
+
+    return [np.concatenate([r[i] for r in results]) for i in range(9)]
+
+
+def _psf_photometry(data, x, y, psf_params, options):
+    """
+    Group, fit and tabulate; returns (table, model).
+    """
+    unknown = set(psf_params) - set(PSF_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown PSF parameters: {sorted(unknown)}")
+
+    fwhm = psf_params.get("fwhm", 3.0)
+    fit_size = _odd(psf_params.get("fit_shape", 2 * fwhm + 1))
+    half = fit_size // 2
+    kind = psf_params.get("model", "gaussian")
+
+    fit_positions = options.get("fit_positions", True)
+    maxiters = options.get("maxiters", 10)
+    tol = options.get("tol", 1e-3)
+
+    if kind == "gaussian":
+        model = {"kind": "gaussian", "sigma": fwhm * gaussian_fwhm_to_sigma}
+    elif kind == "empirical":
+        model = _empirical_model(
+            data,
+            x,
+            y,
+            _odd(psf_params.get("size", 4 * fwhm + 1)),
+            psf_params.get("n_stars", 50),
+            fwhm,
+            half,
+            maxiters,
+            tol,
+        )
+    else:
+        raise ValueError(f"Unknown PSF model: {kind}")
+
+    if len(x) == 0:
+        raise ValueError("No positions to fit")
+
+    with phase("psf_grouping"):
+        group = _psf_groups(
+            x,
+            y,
+            options.get("group_separation", fit_size),
+            options.get("max_group_size", MAX_GROUP_SIZE),
+        )
+        sizes = np.bincount(group)
+        group_size = sizes[group]
+
+    n = len(x)
+    columns = {name: np.full(n, np.nan) for name in FIT_COLUMNS}
+    columns["converged"] = np.zeros(n, dtype=bool)
+
+    def store(index, fitted):
+        # Per-group values (background, chi2, ...) broadcast to the members
+        for name, values in zip(FIT_COLUMNS, fitted):
+            columns[name][index] = values
+
+    with phase("psf_fit"):
+        single = np.flatnonzero(group_size == 1)
+        if len(single):
+            fitted = _fit_isolated(
+                data, x[single], y[single], half, model, fit_positions, maxiters, tol
+            )
+            store(single, [values.reshape(len(single)) for values in fitted])
+
+        # Blended groups: members are fitted together, groups in parallel
+        members = np.argsort(group, kind="stable")
+        bounds = np.cumsum(np.concatenate([[0], sizes]))
+        blended = [
+            members[bounds[g] : bounds[g + 1]] for g in np.flatnonzero(sizes > 1)
+        ]
+        groups = [
+            _group_pixels(data, x[index], y[index], half) + (x[index], y[index])
+            for index in blended
+        ]
+        jobs = [
+            (groups[start : start + GROUP_CHUNK], model, fit_positions, maxiters, tol)
+            for start in range(0, len(groups), GROUP_CHUNK)
+        ]
+        chunks = parallel_map(
+            _fit_groups,
+            jobs,
+            max_workers=options.get("max_workers"),
+            executor="process",
+        )
+        results = [result for chunk in chunks for result in chunk]
+        for index, fitted in zip(blended, results):
+            store(index, fitted)
+
+    table = QTable()
+    table["id"] = np.arange(1, n + 1)
+    table["group_id"] = group + 1
+    table["group_size"] = group_size
+    table["x_init"] = x
+    table["y_init"] = y
+    for name in FIT_COLUMNS:
+        table[name] = columns[name]
+
+    return table, model
+
+
+@instrumented
+@calcfunction
+def psf_photometry_cf(
+    image: FitsData,
+    positions: ArrayData,
+    psf: Dict,
+    options: Dict,
+):
+    """
+    PSF-fitting photometry for crowded fields.
+
+    Stars whose fit boxes overlap are grouped (KD-tree pairs and connected
+    components) and fitted simultaneously. Isolated stars are fitted in
+    vectorised batches and blended groups in a process pool. Blends larger
+    than max_group_size are split, which bounds the cost of every fit, so
+    the run time grows close to linearly with the number of sources.
+
+    positions:
+        ArrayData with arrays 'x', 'y', e.g. from SourceDetectionWorkChain
+
+    psf:
+        Dict with keys:
+            - model: "gaussian" (default) or "empirical", built from the
+              median of the brightest isolated stars of the image
+            - fwhm: Gaussian FWHM in pixels (default 3.0); also sets the
+              default sizes
+            - fit_shape: side of the fitted box (default 2 * fwhm + 1)
+            - size, n_stars: empirical PSF stamp size (default 4 * fwhm + 1)
+              and number of stars (default 50)
+
+    options:
+        - fit_positions: fit positions as well as fluxes (default True)
+        - maxiters, tol: Gauss-Newton iterations and position tolerance
+          in pixels (default 10 and 1e-3)
+        - group_separation: stars closer than this (pixels, along either
+          axis) are fitted together (default fit_shape)
+        - max_group_size: largest group fitted simultaneously (default 25);
+          larger groups are regrouped with a tighter separation, and stars
+          of different subgroups are fitted separately
+        - max_workers: processes for the blended groups (default: all cores)
+        - output_format: "dict" (default) or "array" (columnar ArrayData)
+
+    Columns: id, group_id, group_size, x_init, y_init, x_fit, y_fit,
+    flux_fit, x_err, y_err, flux_err, local_bkg (constant background of the
+    group), reduced_chi2 and converged. The ArrayData output also holds an
+    empirical PSF as the 'psf_image' array.
+    """
+    x = np.asarray(positions.get_array("x"), dtype=float)
+    y = np.asarray(positions.get_array("y"), dtype=float)
+
+    kwargs, output_format = _split_options(options)
+
+    with image.memmap_array() as data:
+        table, model = _psf_photometry(data, x, y, psf.get_dict(), kwargs)
+
+    node = _photometry_output(table, output_format)
+    if output_format == "dict":
+        node["psf_model"] = model["kind"]
+        return node
+
+    node.base.attributes.set("psf_model", model["kind"])
+    if model["kind"] == "empirical":
+        node.set_array("psf_image", model["image"])
+
+    return node
@@ -0,0 +1,441 @@
+import warnings
+from contextlib import ExitStack, contextmanager
+
+from aiida.engine import calcfunction
+from aiida.orm import ArrayData, Dict
+
+import numpy as np
+from astropy.io import fits
+from astropy.nddata import CCDData
+from astropy.stats import sigma_clip
+from scipy import ndimage
+
+from aiida_photometry.calcfunctions.calibration import STREAMING_MEM_LIMIT
+from aiida_photometry.data.fits_data import FitsData, open_fits
+from aiida_photometry.instrumentation import instrumented, phase
+from aiida_photometry.utils import (
+    _frame_order,
+    _write_hdulist_to_fitsdata,
+    parallel_map,
+)
+
+# Spline order and rows of context read around a band for each interpolation
+INTERPOLATION = {"nearest": (0, 1), "linear": (1, 2), "cubic": (3, 8)}
+
+STACK_METHODS = ("mean", "median", "sigma_clip")
+
+
+def _frame_shape(frames):
+    shapes = [tuple(f.base.attributes.get("shape", ())) for f in frames.values()]
+    if len(set(shapes)) != 1 or len(shapes[0]) != 2:
+        raise ValueError(f"Shape mismatch in input frames: {shapes}")
+    return shapes[0]
+
+
+def _binned(data, factor, band_rows=2048):
+    """
+    Block average of factor x factor pixels, read a band of rows at a time.
+    """
+    ny = data.shape[0] // factor * factor
+    nx = data.shape[1] // factor * factor
+    out = np.empty((ny // factor, nx // factor), dtype=np.float32)
+
+    band = factor * max(1, band_rows // factor)
+    for start in range(0, ny, band):
+        block = np.array(data[start : min(start + band, ny), :nx], dtype=np.float32)
+        rows = block.shape[0] // factor
+        out[start // factor : start // factor + rows] = block.reshape(
+            rows, factor, nx // factor, factor
+        ).mean(axis=(1, 3))
+    return out
+
+
+def _prepared(image):
+    # Sky-subtracted and tapered, so the edges of the periodic FFT do not
+    # dominate the correlation
+    finite = np.isfinite(image)
+    sky = np.median(image[finite]) if finite.any() else 0.0
+    image = np.where(finite, image - sky, 0.0)
+    window = np.outer(np.hanning(image.shape[0]), np.hanning(image.shape[1]))
+    return (image * window).astype(np.float32)
+
+
+def _correlation_offset(ref_fft, image, normalize):
+    """
+    Offset (dy, dx) of image relative to the reference and the peak height.
+
+    The peak of the cross-correlation is located to a fraction of a pixel
+    with a parabola through its neighbours along each axis.
+    """
+    cross = np.fft.rfft2(image) * np.conj(ref_fft)
+    if normalize:
+        cross /= np.maximum(np.abs(cross), 1e-20)
+    corr = np.fft.irfft2(cross, s=image.shape)
+
+    peak = np.unravel_index(np.argmax(corr), corr.shape)
+    offset = []
+    for axis, n in enumerate(corr.shape):
+        before, after = list(peak), list(peak)
+        before[axis] = (peak[axis] - 1) % n
+        after[axis] = (peak[axis] + 1) % n
+        c0, c1, c2 = corr[tuple(before)], corr[peak], corr[tuple(after)]
+
+        curvature = c0 - 2 * c1 + c2
+        shift = peak[axis] + (0.5 * (c0 - c2) / curvature if curvature < 0 else 0.0)
+        offset.append(shift - n if shift >= n / 2 else shift)
+
+    std = corr.std()
+    snr = float((corr[peak] - corr.mean()) / std) if std > 0 else 0.0
+    return offset[0], offset[1], snr
+
+
+def _refine_offset(ref, data, coarse, size, normalize):
+    """
+    Correct a coarse offset with a full-resolution correlation of a crop.
+    """
+    iy, ix = (int(round(value)) for value in coarse)
+    ny, nx = ref.shape
+    size = min(size, ny - abs(iy), nx - abs(ix))
+    if size < 16:
+        return coarse
+
+    # Centred crop of the reference whose shifted copy stays in the frame
+    y0 = int(np.clip((ny - size) // 2, max(0, -iy), min(ny, ny - iy) - size))
+    x0 = int(np.clip((nx - size) // 2, max(0, -ix), min(nx, nx - ix) - size))
+    ref_crop = np.array(ref[y0 : y0 + size, x0 : x0 + size], dtype=np.float32)
+    crop = np.array(
+        data[y0 + iy : y0 + iy + size, x0 + ix : x0 + ix + size],
+        dtype=np.float32,
+    )
+
+    dy, dx, _ = _correlation_offset(
+        np.fft.rfft2(_prepared(ref_crop)), _prepared(crop), normalize
+    )
+    return iy + dy, ix + dx
+
+
+@instrumented
+@calcfunction
+def register_frames_cf(options: Dict = None, **frames) -> ArrayData:
+    """
+    Translational offsets of frames relative to a reference frame.
+
+    Offsets come from the FFT cross-correlation of block-averaged copies of
+    the frames and are refined on a full-resolution crop. A star at (x, y)
+    in the reference is at (x + dx, y + dy) in a frame.
+
+    options:
+        Optional Dict with keys:
+            - reference: label of the reference frame (default: the first
+              by DATE-OBS)
+            - downsample: block size of the averaging (default 4)
+            - correlation: "phase" (default, whitened cross-power spectrum)
+              or "cross" (plain cross-correlation)
+            - refine_size: side of the full-resolution crop (default 512,
+              0 to keep the downsampled offsets)
+            - max_workers: frames registered at once (threads, default 4)
+
+    Returns an ArrayData with arrays 'dx', 'dy' and 'peak_snr' (correlation
+    peak height in standard deviations) in the order of the 'labels'
+    attribute, and the 'reference' attribute.
+    """
+    params = options.get_dict() if options is not None else {}
+    _frame_shape(frames)
+
+    labels = _frame_order(frames)
+    reference_label = params.get("reference", labels[0])
+    if reference_label not in frames:
+        raise ValueError(f"Unknown reference frame: {reference_label}")
+    reference = frames[reference_label]
+
+    factor = max(1, int(params.get("downsample", 4)))
+    refine_size = int(params.get("refine_size", 512))
+    correlation = params.get("correlation", "phase")
+    if correlation not in ("phase", "cross"):
+        raise ValueError(f"Unknown correlation: {correlation}")
+    normalize = correlation == "phase"
+
+    def register(job):
+        label, data = job
+        if label == reference_label:
+            return 0.0, 0.0, np.inf
+
+        with phase("registration"):
+            binned = _prepared(_binned(data, factor))
+            dy, dx, snr = _correlation_offset(ref_fft, binned, normalize)
+            coarse = (dy * factor, dx * factor)
+
+            if refine_size > 0:
+                refined = _refine_offset(ref, data, coarse, refine_size, normalize)
+                # A refinement further off than one block is a false peak
+                if max(abs(r - c) for r, c in zip(refined, coarse)) <= factor:
+                    coarse = refined
+        return coarse[0], coarse[1], snr
+
+    max_workers = max(1, params.get("max_workers", 4))
+    results = []
+
+    with reference.memmap_array() as ref:
+        ref_fft = np.fft.rfft2(_prepared(_binned(ref, factor)))
+
+        for start in range(0, len(labels), max_workers):
+            # Frames are opened in the calling thread: the AiiDA storage
+            # session is not shared with worker threads, which only read
+            # the mapped pages
+            wave = labels[start : start + max_workers]
+            with ExitStack() as stack:
+                jobs = [
+                    (label, stack.enter_context(frames[label].memmap_array()))
+                    for label in wave
+                ]
+                results.extend(parallel_map(register, jobs, max_workers=max_workers))
+
+    offsets = ArrayData()
+    offsets.set_array("dx", np.array([dx for _, dx, _ in results]))
+    offsets.set_array("dy", np.array([dy for dy, _, _ in results]))
+    offsets.set_array("peak_snr", np.array([snr for _, _, snr in results]))
+    offsets.base.attributes.set("labels", labels)
+    offsets.base.attributes.set("reference", reference_label)
+    offsets.base.attributes.set("downsample", factor)
+
+    return offsets
+
+
+@contextmanager
+def _frame_planes(node):
+    """
+    Yield the image and MASK (or None) of a frame, memory-mapped unless scaled.
+    """
+    with ExitStack() as stack:
+        with phase("fits_decode"):
+            handle = stack.enter_context(node.open(mode="rb"))
+            hdul = stack.enter_context(open_fits(handle))
+            # Touched here, so worker threads only read mapped or decoded pages
+            data = hdul[node.image_hdu].data
+            mask = hdul["MASK"].data if "MASK" in hdul else None
+        yield data, mask
+
+
+def _aligned_band(data, mask, rows, dx, dy, order, margin):
+    """
+    Rows of a frame resampled onto the reference grid.
+
+    aligned[y, x] = frame[y + dy, x + dx]. Only the source rows the band
+    maps to, plus `margin` rows of interpolation context, are read. Returns
+    float32 values and the validity of every pixel: inside the frame,
+    finite and not masked.
+    """
+    ny = data.shape[0]
+    start = int(np.floor(rows.start + dy)) - margin
+    stop = int(np.ceil(rows.stop - 1 + dy)) + margin + 1
+    source = np.arange(start, stop)
+    index = np.clip(source, 0, ny - 1)
+    lo, hi = index[0], index[-1] + 1
+
+    values = np.array(data[lo:hi], dtype=np.float32)[index - lo]
+    valid = ((source >= 0) & (source < ny))[:, None] & np.isfinite(values)
+    if mask is not None:
+        valid &= ~np.asarray(mask[lo:hi], dtype=bool)[index - lo]
+    if not valid.all():
+        # Masked pixels may hold finite outliers such as cosmic rays, which
+        # the spline prefilter would spread into their neighbours
+        values[~valid] = np.median(values[valid]) if valid.any() else 0
+
+    shift = (start - rows.start - dy, -dx)
+    n = rows.stop - rows.start
+    values = ndimage.shift(values, shift, order=order, mode="nearest")[:n]
+    # A pixel is valid when its whole interpolation stencil is. Shifting the
+    # invalid pixels with the linear kernel marks every pixel whose linear
+    # stencil holds one; the cubic stencil reaches one pixel further along
+    # every axis with a fractional shift. Everything outside the frame is
+    # invalid
+    invalid = (~valid).astype(np.float32)
+    if order == 3:
+        size = [3 if offset % 1 else 1 for offset in shift]
+        invalid = ndimage.maximum_filter(invalid, size=size, mode="constant", cval=1)
+    invalid = ndimage.shift(
+        invalid, shift, order=min(order, 1), mode="grid-constant", cval=1.0
+    )[:n]
+    return values, invalid == 0
+
+
+def _stack_bands(shape, n_held, method, mem_limit):
+    # Bytes per output pixel: the float32 values and bool validity of every
+    # aligned band held at once, the copies made by the median or clipping,
+    # and the float64 accumulators
+    copies = {"mean": 2, "median": 3, "sigma_clip": 4}[method]
+    bytes_per_pixel = 5 * n_held * copies + 24
+    rows = max(1, int(mem_limit // (bytes_per_pixel * shape[1])))
+
+    for start in range(0, shape[0], rows):
+        yield slice(start, min(start + rows, shape[0]))
+
+
+def _combine_band(values, valid, exptime, method, params):
+    """
+    Combine the aligned bands of all frames into (data, exposure).
+    """
+    if method == "sigma_clip":
+        clipped = sigma_clip(
+            np.ma.masked_array(values, ~valid),
+            sigma=params.get("sigma", 3.0),
+            maxiters=params.get("maxiters", 5),
+            axis=0,
+            masked=True,
+        )
+        valid = ~np.ma.getmaskarray(clipped)
+
+    if method == "median":
+        with warnings.catch_warnings():
+            # All-NaN slices are uncovered pixels, masked afterwards
+            warnings.simplefilter("ignore", RuntimeWarning)
+            data = np.nanmedian(np.where(valid, values, np.nan), axis=0)
+    else:
+        count = valid.sum(axis=0)
+        data = np.where(valid, values, 0.0).sum(axis=0, dtype=float)
+        data = np.where(count > 0, data / np.maximum(count, 1), np.nan)
+
+    return data, np.tensordot(exptime, valid, axes=1)
+
+
+def _stack(frames, dx, dy, exptime, method, order, margin, params):
+    """
+    Align and co-add frames a band of rows at a time.
+
+    The mean is accumulated over waves of ``max_workers`` frames, so its
+    memory does not grow with the number of frames; the median and the
+    sigma clipping need the aligned band of every frame at once.
+    """
+    shape = _frame_shape(frames)
+    labels = list(frames)
+    max_workers = max(1, params.get("max_workers", 4))
+    n_held = max_workers if method == "mean" else len(labels)
+    mem_limit = params.get("mem_limit", STREAMING_MEM_LIMIT)
+
+    data = np.empty(shape, dtype=float)
+    exposure = np.zeros(shape, dtype=np.float32)
+
+    with ExitStack() as stack:
+        planes = [stack.enter_context(_frame_planes(frames[lb])) for lb in labels]
+        jobs = list(zip(planes, dx, dy))
+
+        for rows in _stack_bands(shape, n_held, method, mem_limit):
+
+            def align(job):
+                (image, mask), x_offset, y_offset = job
+                return _aligned_band(
+                    image, mask, rows, x_offset, y_offset, order, margin
+                )
+
+            with phase("stacking"):
+                if method != "mean":
+                    aligned = parallel_map(align, jobs, max_workers=max_workers)
+                    values = np.stack([band for band, _ in aligned])
+                    valid = np.stack([ok for _, ok in aligned])
+                    del aligned
+                    data[rows], exposure[rows] = _combine_band(
+                        values, valid, exptime, method, params
+                    )
+                    continue
+
+                total = np.zeros((rows.stop - rows.start, shape[1]))
+                count = np.zeros(total.shape, dtype=np.int32)
+                for start in range(0, len(jobs), max_workers):
+                    wave = jobs[start : start + max_workers]
+                    aligned = parallel_map(align, wave, max_workers=max_workers)
+                    for (band, ok), t in zip(aligned, exptime[start:]):
+                        total += np.where(ok, band, 0.0)
+                        count += ok
+                        exposure[rows] += t * ok
+                data[rows] = np.where(count > 0, total / np.maximum(count, 1), np.nan)
+
+    return data, exposure
+
+
+def exposure_map(stacked):
+    """
+    Exposure map (seconds of exposure per pixel) of a stack_frames_cf output.
+    """
+    with stacked.open(mode="rb") as handle:
+        with fits.open(handle) as hdul:
+            return np.array(hdul["EXPMAP"].data)
+
+
+@instrumented
+@calcfunction
+def stack_frames_cf(offsets: ArrayData, options: Dict = None, **frames) -> FitsData:
+    """
+    Shift frames onto the reference grid and co-add them.
+
+    offsets:
+        Output of register_frames_cf for the same frames.
+
+    options:
+        Optional Dict with keys:
+            - method: "mean", "median" or "sigma_clip" (default)
+            - interpolation: "nearest", "linear" or "cubic" (default,
+              spline) resampling of the shifted frames
+            - sigma, maxiters: sigma clipping (default 3.0 and 5)
+            - mem_limit: bytes used for the aligned bands (default 1e9);
+              the frames are streamed a band of rows at a time
+            - max_workers: frames shifted at once (threads, default 4)
+            - output: dtype/compression of the written file
+
+    Pixels flagged in a frame's MASK extension, or shifted in from outside
+    it, are left out of that frame's contribution. Returns the stacked
+    image, masked where no frame covers it, with an 'EXPMAP' extension
+    holding the summed EXPTIME of the frames used at every pixel (frames
+    without EXPTIME count as one second); see ``exposure_map``.
+    """
+    params = options.get_dict() if options is not None else {}
+    method = params.get("method", "sigma_clip")
+    if method not in STACK_METHODS:
+        raise ValueError(f"Unknown stacking method: {method}")
+    interpolation = params.get("interpolation", "cubic")
+    if interpolation not in INTERPOLATION:
+        raise ValueError(f"Unknown interpolation: {interpolation}")
+    order, margin = INTERPOLATION[interpolation]
+
+    index = {label: i for i, label in enumerate(offsets.base.attributes.get("labels"))}
+    missing = sorted(set(frames) - set(index))
+    if missing:
+        raise ValueError(f"No offsets for frames: {missing}")
+
+    labels = list(frames)
+    rows = [index[label] for label in labels]
+    dx = offsets.get_array("dx")[rows]
+    dy = offsets.get_array("dy")[rows]
+    exptime = np.array(
+        [float(frames[label].header.get("EXPTIME") or 1.0) for label in labels]
+    )
+
+    data, exposure = _stack(frames, dx, dy, exptime, method, order, margin, params)
+
+    reference = frames.get(offsets.base.attributes.get("reference"), frames[labels[0]])
+    with reference.open(mode="rb") as handle:
+        header = fits.getheader(handle, reference.image_hdu)
+    header["NCOMBINE"] = len(labels)
+    header["STACKMTH"] = method
+    header["INTERP"] = interpolation
+    header["TOTEXP"] = float(exptime.sum())
+
+    stacked = CCDData(
+        data,
+        unit=reference.base.attributes.get("unit", "adu"),
+        meta=header,
+        mask=exposure == 0,
+    )
+    hdul = stacked.to_hdu(hdu_uncertainty=None)
+    hdul.append(fits.ImageHDU(exposure, name="EXPMAP"))
+    hdul["EXPMAP"].header["BUNIT"] = "s"
+
+    return _write_hdulist_to_fitsdata(
+        hdul,
+        extra_attrs={
+            "is_stacked": True,
+            "n_frames": len(labels),
+            "stack_method": method,
+        },
+        output=params.get("output"),
+        filename="stack.fits",
+    )
@@ -1,9 +1,24 @@
+import hashlib
+from contextlib import ExitStack, contextmanager
+
+import aiida
+import numpy as np
 from aiida.orm import SinglefileData
+from aiida.orm.nodes.caching import NodeCaching
 from astropy import units as u
 from astropy.io import fits
 from astropy.nddata import CCDData
 
+from aiida_photometry.data.image_cache import get_image_cache
+from aiida_photometry.instrumentation import phase
+
+# Extensions CCDData writes next to the image
+CCDDATA_PLANES = ("MASK", "UNCERT")
+# Planes that describe the image rather than being chips of a mosaic
+AUXILIARY_PLANES = CCDDATA_PLANES + ("EXPMAP",)
+
 IMPORTANT_HEADER_KEYS = [
+    "IMAGETYP",
     "EXPTIME",
     "FILTER",
     "DATE-OBS",
@@ -14,61 +29,505 @@ IMPORTANT_HEADER_KEYS = [
     "RDNOISE",
 ]
 
+# Keywords describing the layout of one HDU, never inherited from the primary
+STRUCTURAL_KEYS = (
+    "SIMPLE",
+    "XTENSION",
+    "BITPIX",
+    "EXTEND",
+    "PCOUNT",
+    "GCOUNT",
+    "EXTNAME",
+    "EXTVER",
+    "BSCALE",
+    "BZERO",
+    "CHECKSUM",
+    "DATASUM",
+    "INHERIT",
+    "COMMENT",
+    "HISTORY",
+    "",
+)
+
+
+def inherit_header(primary, extension):
+    """
+    Header of an extension completed with the primary header keywords.
+
+    Follows the FITS INHERIT convention: keywords of the primary HDU, such as
+    IMAGETYP, DATE-OBS or EXPTIME of a mosaic, apply to every extension and
+    values set in the extension win. Extensions with INHERIT = F are
+    returned unchanged.
+    """
+    header = extension.copy()
+    if not extension.get("INHERIT", True):
+        return header
+
+    for card in primary.cards:
+        key = card.keyword
+        if key in STRUCTURAL_KEYS or key.startswith("NAXIS") or key in header:
+            continue
+        header.append(card)
+    return header
+
+
+def hdu_header(hdul, index):
+    """
+    Header of HDU `index` of an HDUList, with the primary keywords inherited.
+    """
+    if index == 0:
+        return hdul[0].header
+    return inherit_header(hdul[0].header, hdul[index].header)
+
+
+def metadata_from_header(header):
+    """
+    Build the FitsData attributes (curated header, shape, unit) from a header.
+
+    Works on an astropy Header or any mapping of header cards. The shape is
+    taken from the NAXISn keywords, so no pixel data has to be decoded.
+    """
+    metadata = {
+        "fits_header": {
+            key: header[key] for key in IMPORTANT_HEADER_KEYS if key in header
+        }
+    }
+
+    # NAXIS1 is the fastest varying axis, numpy shapes are in reverse order
+    naxis = int(header.get("NAXIS", 0))
+    if naxis > 0:
+        metadata["shape"] = [int(header[f"NAXIS{i}"]) for i in range(naxis, 0, -1)]
+
+    if "BUNIT" in header:
+        metadata["unit"] = header["BUNIT"]
+
+    return metadata
+
+
+def image_hdu_index(hdul):
+    """
+    Index of the first image HDU holding data.
+
+    This is the primary HDU for plain files and the first extension for
+    tile-compressed files, whose primary HDU is empty.
+    """
+    for index, hdu in enumerate(hdul):
+        if hdu.is_image and hdu.header.get("NAXIS", 0) > 0:
+            return index
+    return 0
+
+
+def image_extensions(hdul):
+    """
+    Metadata of every image HDU holding data, e.g. the chips of a mosaic.
+
+    Mask and uncertainty planes written by CCDData and exposure maps of
+    stacks are not chips.
+    """
+    extensions = []
+    for index, hdu in enumerate(hdul):
+        if not hdu.is_image or hdu.header.get("NAXIS", 0) == 0:
+            continue
+        if hdu.name in AUXILIARY_PLANES:
+            continue
+
+        metadata = metadata_from_header(hdu_header(hdul, index))
+        extensions.append(
+            {
+                "index": index,
+                "extname": hdu.name,
+                "shape": metadata.get("shape", []),
+                "fits_header": metadata["fits_header"],
+            }
+        )
+    return extensions
+
+
+def metadata_from_hdulist(hdul):
+    """
+    Build the FitsData attributes from an (ideally lazily loaded) HDUList.
+
+    Multi-extension files additionally get an 'extensions' list with the
+    index, EXTNAME, shape and curated header of every chip. The curated
+    headers of extensions include the keywords of the primary header.
+    """
+    index = image_hdu_index(hdul)
+    metadata = metadata_from_header(hdu_header(hdul, index))
+    if index != 0:
+        metadata["image_hdu"] = index
+
+    extensions = image_extensions(hdul)
+    if len(extensions) > 1:
+        metadata["extensions"] = extensions
+    return metadata
+
+
+def read_section(hdu, section):
+    """
+    Read a section of an image HDU, decompressing only the tiles it needs.
+    """
+    try:
+        return np.array(hdu.section[section])
+    except AttributeError:
+        # Compressed HDUs only support sections in recent astropy versions
+        return np.array(hdu.data[section])
+
+
+def open_fits(source):
+    """
+    Open a FITS file read-only, memory-mapping the data where possible.
+
+    Scaled integer data (BZERO/BSCALE/BLANK) cannot be mapped: astropy
+    decodes it into a regular array instead. memmap is therefore left at its
+    default rather than forced, which would raise for such data.
+    """
+    return fits.open(source, mode="readonly")
+
+
+@contextmanager
+def memmap_hdu(source, hdu_index):
+    """
+    Yield a read-only, memory-mapped view of the data of one HDU.
+
+    source is a path or an open binary file; worker processes use the path
+    of a FitsData file (FitsData.as_path) to read their chip themselves.
+    """
+    with open_fits(source) as hdul:
+        data = hdul[hdu_index].data
+        if data is not None:
+            data = data.view()
+            data.flags.writeable = False
+        yield data
+
+
+class FitsDataCaching(NodeCaching):
+    """
+    Hash FitsData by content: aiida-core version, node type, file digest and
+    curated header.
+
+    The filename and attributes such as the ingestion source path are left
+    out, so nodes created from identical files hash equally and calcfunctions
+    taking them as input are reused from the cache.
+    """
+
+    def get_objects_to_hash(self):
+        node = self._node
+        return [
+            aiida.__version__,
+            node.class_node_type,
+            node.get_content_digest(),
+            node.header,
+        ]
+
+    # Name used by aiida-core versions before 2.6
+    _get_objects_to_hash = get_objects_to_hash
+
 
 class FitsData(SinglefileData):
     """
     AiiDA data type for FITS images with validated metadata extraction.
     """
 
-    def __init__(self, file=None, **kwargs):
+    _CLS_NODE_CACHING = FitsDataCaching
+
+    def __init__(self, file=None, metadata=None, **kwargs):
         super().__init__(file=file, **kwargs)
 
-        # Only extract metadata if file is provided and node is not stored
+        # Only extract metadata if file is provided and node is not stored.
+        # Bulk ingestion passes metadata parsed beforehand to skip re-reading.
         if file is not None and not self.is_stored:
-            self._validate_and_extract_metadata()
+            if metadata is None:
+                self._validate_and_extract_metadata()
+            else:
+                self._set_metadata(metadata)
 
     def _validate_and_extract_metadata(self):
         with self.open(mode="rb") as handle:
-            with fits.open(handle) as hdul:
-                header = hdul[0].header
+            with fits.open(handle, lazy_load_hdus=True) as hdul:
+                self._set_metadata(metadata_from_hdulist(hdul))
 
-                # Store curated metadata
-                curated = {
-                    key: header[key] for key in IMPORTANT_HEADER_KEYS if key in header
-                }
+    def _set_metadata(self, metadata):
+        for key, value in metadata.items():
+            self.base.attributes.set(key, value)
 
-                self.base.attributes.set("fits_header", curated)
+    @property
+    def header(self):
+        return self.base.attributes.get("fits_header", {})
 
-                # Store shape
-                if hdul[0].data is not None:
-                    self.base.attributes.set("shape", hdul[0].data.shape)
+    @property
+    def image_hdu(self):
+        """
+        Index of the HDU holding the image (non-zero for compressed files).
+        """
+        return self.base.attributes.get("image_hdu", 0)
 
-                # Store unit if present
-                if "BUNIT" in header:
-                    self.base.attributes.set("unit", header["BUNIT"])
+    @property
+    def extensions(self):
+        """
+        Per-chip metadata (index, extname, shape, fits_header) of
+        multi-extension files; empty for single images.
+        """
+        return self.base.attributes.get("extensions", [])
 
     @property
-    def header(self):
-        return self.base.attributes.get("fits_header", {})
+    def is_mef(self):
+        return len(self.extensions) > 1
+
+    def image_extensions(self):
+        """
+        Extensions to process: every chip of a multi-extension file, or the
+        single image HDU, in the format of the 'extensions' attribute.
+        """
+        if self.extensions:
+            return self.extensions
+        return [
+            {
+                "index": self.image_hdu,
+                "extname": "",
+                "shape": self.base.attributes.get("shape", []),
+                "fits_header": self.header,
+            }
+        ]
+
+    def extension_header(self, hdu_index=None):
+        """
+        Curated header of one extension, read from the node attributes.
+        """
+        hdu_index = self._resolve_hdu(hdu_index)
+        for ext in self.extensions:
+            if ext["index"] == hdu_index:
+                return ext["fits_header"]
+        return self.header
+
+    def _resolve_hdu(self, hdu_index):
+        # None is the image HDU; EXTNAMEs are looked up in the extension list
+        if hdu_index is None:
+            return self.image_hdu
+        if isinstance(hdu_index, str):
+            for ext in self.extensions:
+                if ext["extname"] == hdu_index.upper():
+                    return ext["index"]
+            raise KeyError(f"No extension named {hdu_index!r}")
+        return hdu_index
 
-    def get_ccddata(self, hdu_index=0, default_unit="adu"):
+    def get_ccddata(self, hdu_index=None, default_unit="adu"):
         """
         Return image as CCDData object from FITS file.
         Needed to use ccdproc tools.
+
+        If the image cache is enabled the decoded frame is shared between
+        calls and the returned CCDData holds read-only views of it.
         """
-        # try reading with header-defined unit first
-        try:
-            with self.open(mode="rb") as handle:
-                return CCDData.read(handle, hdu=hdu_index)
-        except ValueError:
-            # fallback if no BUNIT present
-            with self.open(mode="rb") as handle:
-                return CCDData.read(handle, hdu=hdu_index, unit=u.Unit(default_unit))
+        hdu_index = self._resolve_hdu(hdu_index)
+        cache = get_image_cache()
+        if cache is None:
+            return self._read_ccddata(hdu_index, default_unit)
+
+        key = self._cache_key("ccddata", hdu_index, default_unit)
+        ccd = cache.get(key)
+        if ccd is None:
+            ccd = self._read_ccddata(hdu_index, default_unit)
+            nbytes = _freeze_ccddata(ccd)
+            cache.put(key, ccd, nbytes)
+
+        return _ccddata_view(ccd)
+
+    def _read_ccddata(self, hdu_index, default_unit):
+        with phase("fits_decode"):
+            primary = None
+            if hdu_index != 0:
+                with self.open(mode="rb") as handle:
+                    primary = fits.getheader(handle, 0)
 
-    def get_array(self, hdu_index=0):
+            # try reading with header-defined unit first
+            try:
+                with self.open(mode="rb") as handle:
+                    ccd = CCDData.read(handle, hdu=hdu_index)
+            except ValueError:
+                # fallback if no BUNIT present
+                with self.open(mode="rb") as handle:
+                    ccd = CCDData.read(handle, hdu=hdu_index, unit=u.Unit(default_unit))
+
+        if primary is not None:
+            ccd.header = inherit_header(primary, ccd.header)
+        return ccd
+
+    def get_array(self, hdu_index=None):
         """
         Return raw numpy array from FITS file.
+
+        The array is a private copy, unless the image cache is enabled, in
+        which case a read-only view of the cached array is returned.
+        """
+        hdu_index = self._resolve_hdu(hdu_index)
+        cache = get_image_cache()
+        if cache is None:
+            return self._read_array(hdu_index)
+
+        key = self._cache_key("array", hdu_index)
+        data = cache.get(key)
+        if data is None:
+            data = self._read_array(hdu_index)
+            data.flags.writeable = False
+            cache.put(key, data, data.nbytes)
+
+        return data.view()
+
+    def _read_array(self, hdu_index):
+        with phase("fits_decode"):
+            with self.open(mode="rb") as f:
+                with fits.open(f) as hdul:
+                    return hdul[hdu_index].data.copy()
+
+    def get_content_digest(self):
+        """
+        Return the SHA-256 hex digest of the FITS file content.
+
+        Stored files are looked up in the repository, which already keeps
+        their SHA-256. Files of unstored nodes are read and hashed once; the
+        digest is kept on the node for the repository object it was
+        computed from, so replacing the file invalidates it.
+        """
+        key = self.base.repository.get_object(self.filename).key
+        if self.is_stored:
+            return self.backend.get_repository().get_object_hash(key)
+
+        memo = getattr(self, "_content_digest", None)
+        if memo is not None and memo[0] == key:
+            return memo[1]
+
+        digest = hashlib.sha256()
+        with phase("fits_digest"), self.open(mode="rb") as handle:
+            for chunk in iter(lambda: handle.read(1024**2), b""):
+                digest.update(chunk)
+        self._content_digest = (key, digest.hexdigest())
+        return self._content_digest[1]
+
+    def _cache_key(self, *parts):
+        # Stored nodes are immutable, so their UUID identifies the content
+        identity = self.uuid if self.is_stored else self.get_content_digest()
+        return (identity,) + parts
+
+    @contextmanager
+    def memmap_array(self, hdu_index=None):
+        """
+        Yield a read-only, memory-mapped view of the pixel data.
+
+        No copy is made: pages are only read from disk when they are accessed,
+        so indexing the array touches just the requested pixels. The array is
+        only valid inside the ``with`` block. Scaled integer data
+        (BZERO/BSCALE/BLANK), such as unsigned 16-bit raw frames, cannot be
+        mapped: it is read and scaled in full, and tile-compressed images are
+        decompressed.
+        """
+        hdu_index = self._resolve_hdu(hdu_index)
+        with ExitStack() as stack:
+            # Only opening and mapping is timed here; mapped pages are read
+            # later, by the code that touches them
+            with phase("fits_decode") as counters:
+                handle = stack.enter_context(self.open(mode="rb"))
+                data = stack.enter_context(memmap_hdu(handle, hdu_index))
+                counters["bytes_mapped"] = 0 if data is None else data.nbytes
+            yield data
+
+    def get_section(self, section=None, bbox=None, hdu_index=None):
         """
-        with self.open(mode="rb") as f:
-            with fits.open(f) as hdul:
-                return hdul[hdu_index].data.copy()
+        Return a cutout of the pixel data, reading only that part of the file.
+
+        section:
+            Tuple of slices in numpy (y, x) order.
+
+        bbox:
+            (ixmin, ixmax, iymin, iymax) pixel indices with exclusive upper
+            bounds, or a photutils BoundingBox. Clipped to the image.
+        """
+        if (section is None) == (bbox is None):
+            raise ValueError("Provide exactly one of 'section' or 'bbox'")
+
+        if bbox is not None:
+            section = self._bbox_to_section(bbox, hdu_index)
+
+        hdu_index = self._resolve_hdu(hdu_index)
+        with phase("fits_decode"), self.open(mode="rb") as handle:
+            with open_fits(handle) as hdul:
+                return read_section(hdul[hdu_index], section)
+
+    def get_cutout(self, x, y, size, hdu_index=None):
+        """
+        Return a square cutout centred on pixel position (x, y).
+
+        Returns (cutout, (ixmin, iymin)) where the offsets convert cutout pixel
+        coordinates back to image coordinates. Cutouts at the image edge are
+        truncated, not padded.
+        """
+        half = int(size) // 2
+        ix = int(round(x))
+        iy = int(round(y))
+        bbox = (ix - half, ix + half + 1, iy - half, iy + half + 1)
+        ixmin, _, iymin, _ = self._clip_bbox(bbox, hdu_index)
+
+        return self.get_section(bbox=bbox, hdu_index=hdu_index), (ixmin, iymin)
+
+    def extension_shape(self, hdu_index=None):
+        """
+        Shape of one extension from the node attributes, or None if unknown.
+        """
+        hdu_index = self._resolve_hdu(hdu_index)
+        for ext in self.extensions:
+            if ext["index"] == hdu_index:
+                return ext["shape"]
+        return self.base.attributes.get("shape", None)
+
+    def _clip_bbox(self, bbox, hdu_index=None):
+        if hasattr(bbox, "ixmin"):
+            bbox = (bbox.ixmin, bbox.ixmax, bbox.iymin, bbox.iymax)
+
+        ixmin, ixmax, iymin, iymax = (int(v) for v in bbox)
+        shape = self.extension_shape(hdu_index)
+        if not shape:
+            raise ValueError("FitsData has no image shape; cannot resolve bbox")
+        ny, nx = shape[-2:]
+
+        ixmin, ixmax = max(ixmin, 0), min(ixmax, nx)
+        iymin, iymax = max(iymin, 0), min(iymax, ny)
+        if ixmin >= ixmax or iymin >= iymax:
+            raise ValueError(f"Bounding box {bbox} does not overlap the image")
+
+        return ixmin, ixmax, iymin, iymax
+
+    def _bbox_to_section(self, bbox, hdu_index=None):
+        ixmin, ixmax, iymin, iymax = self._clip_bbox(bbox, hdu_index)
+        return (slice(iymin, iymax), slice(ixmin, ixmax))
+
+
+def _freeze_ccddata(ccd):
+    # Mark all planes read-only and return their total size in bytes
+    nbytes = 0
+    for array in (
+        ccd.data,
+        ccd.mask,
+        None if ccd.uncertainty is None else ccd.uncertainty.array,
+    ):
+        if array is not None:
+            array.flags.writeable = False
+            nbytes += array.nbytes
+    return nbytes
+
+
+def _ccddata_view(ccd):
+    # New CCDData sharing the (read-only) planes of a cached frame
+    uncertainty = None
+    if ccd.uncertainty is not None:
+        uncertainty = type(ccd.uncertainty)(
+            ccd.uncertainty.array.view(), unit=ccd.uncertainty.unit, copy=False
+        )
+
+    return CCDData(
+        ccd.data.view(),
+        unit=ccd.unit,
+        meta=ccd.meta.copy(),
+        mask=None if ccd.mask is None else ccd.mask.view(),
+        uncertainty=uncertainty,
+        wcs=ccd.wcs,
+        copy=False,
+    )
@@ -0,0 +1,106 @@
+"""
+Opt-in, size-bounded LRU cache of decoded FITS images.
+
+The cache is shared by all FitsData nodes of a process. It is disabled by
+default; enable it with ``enable_image_cache`` or, for daemon workers, by
+setting the ``AIIDA_PHOTOMETRY_IMAGE_CACHE_MB`` environment variable.
+Cached arrays are read-only, callers always receive views.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+ENV_CACHE_SIZE = "AIIDA_PHOTOMETRY_IMAGE_CACHE_MB"
+
+
+class ImageCache:
+    """
+    Thread-safe LRU mapping bounded by the total size of the cached arrays.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        # Items larger than the whole budget are never cached
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+
+            self._entries[key] = (value, nbytes)
+            self.current_bytes += nbytes
+
+            while self.current_bytes > self.max_bytes:
+                _, (_, size) = self._entries.popitem(last=False)
+                self.current_bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "current_bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+_cache = None
+
+
+def enable_image_cache(max_mb=1024):
+    """
+    Enable the process-wide image cache with a budget of ``max_mb`` megabytes.
+    """
+    global _cache
+    _cache = ImageCache(max_bytes=max_mb * 1024**2)
+    return _cache
+
+
+def disable_image_cache():
+    global _cache
+    _cache = None
+
+
+def get_image_cache():
+    """
+    Return the active ImageCache, or None if caching is disabled.
+    """
+    return _cache
+
+
+def image_cache_info():
+    """
+    Return hit/miss counters and memory usage of the cache, or None if disabled.
+    """
+    return None if _cache is None else _cache.info()
+
+
+if os.environ.get(ENV_CACHE_SIZE):
+    enable_image_cache(float(os.environ[ENV_CACHE_SIZE]))
@@ -0,0 +1,179 @@
+"""
+Bulk ingestion of observing-night directories into FitsData nodes.
+
+Headers are parsed in parallel without decoding any pixel data, nodes are
+stored and added to a group in one database transaction per batch, and
+frames are selected afterwards with a database query on the curated header
+attributes instead of rescanning the directory.
+"""
+import argparse
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from aiida import orm
+from aiida.manage import get_manager
+from astropy.io import fits
+
+from aiida_photometry.data.fits_data import FitsData, metadata_from_hdulist
+
+
+def _read_metadata(path):
+    # Only headers are read, pixel data is never touched
+    with fits.open(path, lazy_load_hdus=True) as hdul:
+        return metadata_from_hdulist(hdul)
+
+
+def ingest_directory(
+    directory,
+    pattern="*.fit*",
+    group_label=None,
+    max_workers=None,
+    batch_size=500,
+    recursive=False,
+):
+    """
+    Ingest all FITS files of a directory as stored FitsData nodes.
+
+    directory:
+        Directory containing the frames of a night.
+    pattern:
+        Glob pattern for the files to ingest.
+    group_label:
+        Optional group the nodes are added to. Files whose path is already
+        in the group are skipped, so an interrupted ingestion can be resumed.
+    max_workers:
+        Number of processes used to parse headers (default: all cores).
+    batch_size:
+        Number of nodes stored and added to the group in one database
+        transaction.
+
+    Returns the list of newly created nodes.
+    """
+    if recursive:
+        pattern = os.path.join("**", pattern)
+    paths = sorted(
+        os.path.abspath(path)
+        for path in glob.glob(os.path.join(directory, pattern), recursive=recursive)
+    )
+
+    group = None
+    if group_label is not None:
+        group, _ = orm.Group.collection.get_or_create(label=group_label)
+        existing = {
+            source
+            for (source,) in orm.QueryBuilder()
+            .append(orm.Group, filters={"id": group.pk}, tag="group")
+            .append(
+                FitsData,
+                with_group="group",
+                project="attributes.source_path",
+            )
+            .iterall()
+        }
+        paths = [path for path in paths if path not in existing]
+
+    if not paths:
+        return []
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        metadata = list(executor.map(_read_metadata, paths, chunksize=32))
+
+    storage = get_manager().get_profile_storage()
+    nodes = []
+    for start in range(0, len(paths), batch_size):
+        # One database transaction per batch: the nodes are flushed as they
+        # are stored and committed together with their group membership
+        with storage.transaction():
+            batch = []
+            for path, meta in zip(
+                paths[start : start + batch_size],
+                metadata[start : start + batch_size],
+            ):
+                node = FitsData(file=path, metadata=meta)
+                node.base.attributes.set("source_path", path)
+                batch.append(node.store())
+
+            if group is not None:
+                group.add_nodes(batch)
+        nodes.extend(batch)
+
+    return nodes
+
+
+def _match(value):
+    # Strings are matched case-insensitively, (min, max) tuples as a range
+    if isinstance(value, str):
+        return {"ilike": value}
+    if isinstance(value, (tuple, list)):
+        low, high = value
+        return {"and": [{">=": low}, {"<=": high}]}
+    return {"==": value}
+
+
+def query_frames(
+    imagetyp=None, filter_name=None, exptime=None, group_label=None, **header
+):
+    """
+    Select ingested frames by their curated header values.
+
+    The filters run in the database on the ``fits_header`` attribute, e.g.
+    ``query_frames(imagetyp="bias", group_label="night-2024-03-01")`` or
+    ``query_frames(imagetyp="flat", filter_name="V", exptime=(1, 10))``.
+    Additional header keywords can be passed as keyword arguments.
+
+    Returns a list of FitsData nodes ordered by creation.
+    """
+    criteria = dict(header)
+    if imagetyp is not None:
+        criteria["IMAGETYP"] = imagetyp
+    if filter_name is not None:
+        criteria["FILTER"] = filter_name
+    if exptime is not None:
+        criteria["EXPTIME"] = exptime
+
+    filters = {
+        f"attributes.fits_header.{key}": _match(value)
+        for key, value in criteria.items()
+    }
+
+    qb = orm.QueryBuilder()
+    if group_label is not None:
+        qb.append(orm.Group, filters={"label": group_label}, tag="group")
+        qb.append(FitsData, with_group="group", filters=filters, tag="frame")
+    else:
+        qb.append(FitsData, filters=filters, tag="frame")
+    qb.order_by({"frame": {"ctime": "asc"}})
+
+    return qb.all(flat=True)
+
+
+def main(argv=None):
+    from aiida import load_profile
+
+    parser = argparse.ArgumentParser(
+        description="Ingest a directory of FITS frames into FitsData nodes."
+    )
+    parser.add_argument("directory")
+    parser.add_argument("--group", dest="group_label", default=None)
+    parser.add_argument("--pattern", default="*.fit*")
+    parser.add_argument("--workers", dest="max_workers", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--recursive", action="store_true")
+    parser.add_argument("--profile", default=None)
+    args = parser.parse_args(argv)
+
+    load_profile(args.profile)
+    nodes = ingest_directory(
+        args.directory,
+        pattern=args.pattern,
+        group_label=args.group_label,
+        max_workers=args.max_workers,
+        batch_size=args.batch_size,
+        recursive=args.recursive,
+    )
+    print(f"Ingested {len(nodes)} frames")
+
+
+if __name__ == "__main__":
+    main()
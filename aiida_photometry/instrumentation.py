@@ -0,0 +1,234 @@
+"""
+Opt-in per-phase timing and resource instrumentation.
+
+Disabled by default; enable it with ``enable_instrumentation`` or, for
+daemon workers, by setting the ``AIIDA_PHOTOMETRY_INSTRUMENT`` environment
+variable. Calcfunctions decorated with ``instrumented`` then record, for
+every ``phase`` entered while they run (FITS decode, repository writes,
+ccdproc and photutils calls, ...), the wall time, CPU time, bytes
+read/written, major page faults and the growth of the process peak RSS, and
+store them in the 'instrumentation' extra of their output nodes.
+``aggregate_instrumentation`` sums them over a workflow.
+
+Phases of worker threads started through ``utils.parallel_map`` are
+included, so their wall times add up across threads; CPU time, I/O and
+memory counters are per process. Worker processes are not traced.
+
+Memory-mapped images are read lazily: the 'fits_decode' phase of
+``FitsData.memmap_array`` covers opening and mapping the file and reports
+'bytes_mapped', while the pages themselves are read by whichever phase
+touches them and show up there as major page faults, not as bytes read.
+"""
+import contextvars
+import functools
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+from aiida.common.links import LinkType
+from aiida.orm import CalcFunctionNode, Node
+
+ENV_INSTRUMENT = "AIIDA_PHOTOMETRY_INSTRUMENT"
+EXTRA_KEY = "instrumentation"
+
+# Phases that are I/O; the rest of a calcfunction's time is reported as compute
+IO_PHASES = ("fits_decode", "fits_digest", "fits_encode", "repository_write")
+
+_enabled = False
+_recorder = contextvars.ContextVar("aiida_photometry_recorder", default=None)
+
+
+def enable_instrumentation():
+    global _enabled
+    _enabled = True
+
+
+def disable_instrumentation():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def _io_counters():
+    # rchar/wchar count all read/write syscalls, including page-cache hits
+    try:
+        with open("/proc/self/io") as handle:
+            fields = dict(line.split(":") for line in handle)
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _sample():
+    read, written = _io_counters()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return (
+        time.perf_counter(),
+        time.process_time(),
+        read,
+        written,
+        usage.ru_majflt,
+        usage.ru_maxrss / 1024,
+    )
+
+
+class Recorder:
+    """
+    Thread-safe accumulator of phase measurements.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, start, end, counters=None):
+        """
+        Add one call of phase ``name`` from its start and end samples.
+
+        'peak_rss_growth_mb' is how much the process peak RSS (ru_maxrss, a
+        lifetime high-water mark) rose during the call: zero when the phase
+        stayed below an earlier peak. ``counters`` are summed as they are.
+        """
+        with self._lock:
+            entry = self.phases.setdefault(
+                name,
+                {
+                    "calls": 0,
+                    "wall_s": 0.0,
+                    "cpu_s": 0.0,
+                    "bytes_read": 0,
+                    "bytes_written": 0,
+                    "major_faults": 0,
+                    "peak_rss_growth_mb": 0.0,
+                },
+            )
+            entry["calls"] += 1
+            entry["wall_s"] += end[0] - start[0]
+            entry["cpu_s"] += end[1] - start[1]
+            entry["bytes_read"] += end[2] - start[2]
+            entry["bytes_written"] += end[3] - start[3]
+            entry["major_faults"] += end[4] - start[4]
+            entry["peak_rss_growth_mb"] += end[5] - start[5]
+            for key, value in (counters or {}).items():
+                entry[key] = entry.get(key, 0) + value
+
+    def summary(self):
+        with self._lock:
+            phases = {name: dict(entry) for name, entry in self.phases.items()}
+
+        total = phases.get("total")
+        if total is not None:
+            io_wall = sum(
+                phases[name]["wall_s"] for name in IO_PHASES if name in phases
+            )
+            phases["compute"] = {
+                "calls": 1,
+                "wall_s": max(total["wall_s"] - io_wall, 0.0),
+            }
+        return phases
+
+
+@contextmanager
+def phase(name):
+    """
+    Record the enclosed block as phase ``name`` of the running calcfunction.
+
+    Yields a dict in which the block may set additional counters of the
+    phase, e.g. ``bytes_mapped``. A no-op unless instrumentation is enabled
+    and a recorder is active.
+    """
+    recorder = _recorder.get() if _enabled else None
+    counters = {}
+    if recorder is None:
+        yield counters
+        return
+
+    start = _sample()
+    try:
+        yield counters
+    finally:
+        recorder.add(name, start, _sample(), counters)
+
+
+def _output_nodes(result):
+    if isinstance(result, Node):
+        return [result]
+    if isinstance(result, dict):
+        return [node for node in result.values() if isinstance(node, Node)]
+    return []
+
+
+def instrumented(func):
+    """
+    Record the phases of a calcfunction on its output nodes.
+
+    Apply above ``@calcfunction``: the measurement then also covers storing
+    the provenance and outputs, and the extras are set on stored nodes.
+    Attributes of the calcfunction (process_class, ...) are kept by
+    functools.wraps.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return func(*args, **kwargs)
+
+        recorder = Recorder()
+        token = _recorder.set(recorder)
+        try:
+            with phase("total"):
+                result = func(*args, **kwargs)
+        finally:
+            _recorder.reset(token)
+
+        record = {"function": func.__name__, "phases": recorder.summary()}
+        for node in _output_nodes(result):
+            node.base.extras.set(EXTRA_KEY, record)
+        return result
+
+    return wrapper
+
+
+def _merge(target, phases):
+    for name, entry in phases.items():
+        merged = target.setdefault(name, {})
+        for key, value in entry.items():
+            merged[key] = merged.get(key, 0) + value
+
+
+def aggregate_instrumentation(process_node):
+    """
+    Sum the instrumentation of all calcfunctions called by a workflow.
+
+    Works on any process node, e.g. a PhotometryPipelineWorkChain, and walks
+    all its called descendants. Returns a dict with the summed 'phases', the
+    same per 'function', and the number of instrumented 'calls'.
+    """
+    calcs = [
+        node
+        for node in [process_node, *process_node.called_descendants]
+        if isinstance(node, CalcFunctionNode)
+    ]
+
+    phases, by_function, calls = {}, {}, 0
+    for calc in calcs:
+        outputs = calc.base.links.get_outgoing(link_type=LinkType.CREATE).all_nodes()
+        records = [node.base.extras.get(EXTRA_KEY, None) for node in outputs]
+        record = next((r for r in records if r), None)
+        if record is None:
+            continue
+
+        calls += 1
+        _merge(phases, record["phases"])
+        _merge(by_function.setdefault(record["function"], {}), record["phases"])
+
+    return {"calls": calls, "phases": phases, "by_function": by_function}
+
+
+if os.environ.get(ENV_INSTRUMENT):
+    enable_instrumentation()
@@ -0,0 +1,221 @@
+"""
+Deterministic synthetic star fields and calibration frames.
+
+Every generator takes a seed, so the same arguments always give the same
+pixels. Used by the benchmarks to build inputs of any size without data
+files.
+"""
+import io
+
+import numpy as np
+from astropy.io import fits
+from astropy.time import Time
+from scipy.special import erf
+
+from aiida_photometry.data.fits_data import FitsData
+
+FWHM_TO_SIGMA = 1.0 / (2.0 * np.sqrt(2.0 * np.log(2.0)))
+
+
+def _shape(size):
+    return (size, size) if np.isscalar(size) else tuple(size)
+
+
+def star_catalog(size, density=1e-3, flux_range=(1e2, 1e5), border=10, seed=0):
+    """
+    Random star positions and fluxes.
+
+    density:
+        Stars per pixel.
+    flux_range:
+        Total fluxes are log-uniform in this range.
+
+    Returns a dict of 'x', 'y' and 'flux' arrays.
+    """
+    ny, nx = _shape(size)
+    rng = np.random.default_rng(seed)
+    n_stars = int(round(density * ny * nx))
+
+    log_low, log_high = np.log10(flux_range)
+    return {
+        "x": rng.uniform(border, nx - border, n_stars),
+        "y": rng.uniform(border, ny - border, n_stars),
+        "flux": 10 ** rng.uniform(log_low, log_high, n_stars),
+    }
+
+
+def _pixel_integral(offsets, sigma):
+    # Fraction of a unit 1D Gaussian falling in the pixels at these offsets
+    scale = np.sqrt(2.0) * sigma
+    return 0.5 * (erf((offsets + 0.5) / scale) - erf((offsets - 0.5) / scale))
+
+
+def render_stars(size, catalog, fwhm=3.0, chunk_size=10000):
+    """
+    Noise-free image of circular Gaussian stars.
+
+    Each pixel holds the integral of the profile over its area, as a detector
+    records it and as PSF fitting models it, not the profile at its centre.
+    """
+    shape = _shape(size)
+    sigma = fwhm * FWHM_TO_SIGMA
+    radius = int(np.ceil(4 * sigma))
+    offsets = np.arange(-radius, radius + 1)
+
+    image = np.zeros(shape)
+    x, y, flux = catalog["x"], catalog["y"], catalog["flux"]
+
+    for start in range(0, len(x), chunk_size):
+        cx = x[start : start + chunk_size]
+        cy = y[start : start + chunk_size]
+        cflux = flux[start : start + chunk_size]
+
+        cols = np.round(cx).astype(int)[:, None] + offsets
+        rows = np.round(cy).astype(int)[:, None] + offsets
+        gx = _pixel_integral(cols - cx[:, None], sigma)
+        gy = _pixel_integral(rows - cy[:, None], sigma)
+        stamps = cflux[:, None, None] * gy[:, :, None] * gx[:, None, :]
+
+        rows = np.broadcast_to(rows[:, :, None], stamps.shape)
+        cols = np.broadcast_to(cols[:, None, :], stamps.shape)
+        inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+        np.add.at(image, (rows[inside], cols[inside]), stamps[inside])
+
+    return image
+
+
+def star_field(
+    size=1024,
+    density=1e-3,
+    fwhm=3.0,
+    sky=100.0,
+    read_noise=5.0,
+    gain=1.0,
+    flux_range=(1e2, 1e5),
+    seed=0,
+    catalog=None,
+):
+    """
+    A calibrated-looking frame: stars on a flat sky with Poisson and read noise.
+
+    Returns (float32 data, catalog).
+    """
+    shape = _shape(size)
+    if catalog is None:
+        catalog = star_catalog(shape, density, flux_range, seed=seed)
+
+    rng = np.random.default_rng(seed + 1)
+    expected = sky + render_stars(shape, catalog, fwhm)
+    data = rng.poisson(expected * gain) / gain + rng.normal(0.0, read_noise, shape)
+
+    return data.astype(np.float32), catalog
+
+
+def science_header(exptime=60.0, date_obs="2024-01-01T00:00:00", gain=1.0):
+    """
+    Header of a synthetic science frame, with the keywords calibration needs.
+    """
+    header = fits.Header()
+    header["IMAGETYP"] = "light"
+    header["EXPTIME"] = exptime
+    header["DATE-OBS"] = date_obs
+    header["GAIN"] = gain
+    return header
+
+
+def star_field_series(
+    n_frames,
+    size=1024,
+    density=1e-3,
+    jitter=0.5,
+    cadence=60.0,
+    start="2024-01-01T00:00:00",
+    seed=0,
+    **kwargs,
+):
+    """
+    Frames of one field with pointing jitter and increasing DATE-OBS.
+
+    Returns (list of (data, header), reference catalog).
+    """
+    shape = _shape(size)
+    flux_range = kwargs.pop("flux_range", (1e2, 1e5))
+    catalog = star_catalog(shape, density, flux_range, seed=seed)
+    rng = np.random.default_rng(seed + 2)
+    t0 = Time(start, scale="utc")
+
+    frames = []
+    for i in range(n_frames):
+        dx, dy = rng.normal(0.0, jitter, 2)
+        shifted = dict(catalog, x=catalog["x"] + dx, y=catalog["y"] + dy)
+        data, _ = star_field(shape, seed=seed + 10 + i, catalog=shifted, **kwargs)
+
+        header = science_header(
+            cadence, (t0 + i * cadence / 86400.0).isot, kwargs.get("gain", 1.0)
+        )
+        frames.append((data, header))
+
+    return frames, catalog
+
+
+def calibration_frames(
+    kind,
+    n_frames,
+    size=1024,
+    bias_level=300.0,
+    read_noise=5.0,
+    dark_current=0.05,
+    exptime=None,
+    flat_level=20000.0,
+    seed=0,
+):
+    """
+    Raw 'bias', 'dark' or 'flat' frames with matching IMAGETYP and EXPTIME.
+
+    Darks accumulate dark_current (ADU/s/pixel) over exptime; flats show a
+    radial vignetting pattern. Returns a list of (data, header).
+    """
+    shape = _shape(size)
+    rng = np.random.default_rng(seed)
+
+    if exptime is None:
+        exptime = {"bias": 0.0, "dark": 60.0, "flat": 5.0}[kind]
+
+    signal = np.zeros(shape)
+    if kind == "dark":
+        signal += dark_current * exptime
+    elif kind == "flat":
+        yy, xx = np.indices(shape)
+        r2 = ((xx - shape[1] / 2) ** 2 + (yy - shape[0] / 2) ** 2) / max(shape) ** 2
+        signal += flat_level * (1.0 - 0.3 * r2)
+    elif kind != "bias":
+        raise ValueError(f"Unknown calibration frame type: {kind}")
+
+    frames = []
+    for _ in range(n_frames):
+        data = bias_level + rng.normal(0.0, read_noise, shape)
+        if kind != "bias":
+            data += rng.poisson(signal)
+
+        header = fits.Header()
+        header["IMAGETYP"] = kind
+        header["EXPTIME"] = exptime
+        frames.append((data.astype(np.float32), header))
+
+    return frames
+
+
+def to_fits_bytes(data, header=None):
+    """
+    Serialise an image and header to the bytes of a FITS file.
+    """
+    buffer = io.BytesIO()
+    fits.PrimaryHDU(data=data, header=header).writeto(buffer)
+    return buffer.getvalue()
+
+
+def to_fitsdata(data, header=None, filename="synthetic.fits"):
+    """
+    Unstored FitsData node of a synthetic image (needs a loaded profile).
+    """
+    return FitsData(file=io.BytesIO(to_fits_bytes(data, header)), filename=filename)
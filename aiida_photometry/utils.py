@@ -1,10 +1,17 @@
 import ccdproc
 import ast
+import re
 import numpy as np
 from aiida import orm
-import tempfile
 import os
+import threading
+import contextvars
+from astropy import units as u
+from astropy.io import fits
+from astropy.table import QTable
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from aiida_photometry.data.fits_data import FitsData
+from aiida_photometry.instrumentation import phase
 
 
 
@@ -16,6 +23,83 @@ def get_image_by_type(
     return im_collection.files_filtered(imagetyp=image_type, include_path=True)
 
 
+def parallel_map(func, items, max_workers=None, executor="thread"):
+    """
+    Apply `func` to every item in a worker pool and return the results in order.
+
+    executor:
+        "thread" (numpy, astropy and scipy release the GIL in their heavy
+        loops) or "process" (func and items must be picklable).
+
+    With max_workers <= 1 the items are processed serially in the caller.
+    """
+    items = list(items)
+    if len(items) <= 1 or (max_workers is not None and max_workers <= 1):
+        return [func(item) for item in items]
+
+    if executor == "thread":
+        pool_class = ThreadPoolExecutor
+    elif executor == "process":
+        pool_class = ProcessPoolExecutor
+    else:
+        raise ValueError(f"Unknown executor: {executor}")
+
+    with pool_class(max_workers=max_workers) as pool:
+        if executor == "process":
+            return list(pool.map(func, items))
+
+        # Threads run in a copy of the caller's context (instrumentation)
+        contexts = [contextvars.copy_context() for _ in items]
+        return list(pool.map(lambda ctx, item: ctx.run(func, item), contexts, items))
+
+
+def gather_stamps(data, ix, iy, half_size, fill_value=np.nan):
+    """
+    Gather square stamps around many integer pixel positions at once.
+
+    Returns a float array of shape (n, 2 * half_size + 1, 2 * half_size + 1)
+    where stamp[k, j, i] is data[iy[k] - half_size + j, ix[k] - half_size + i].
+    Pixels outside the image are set to `fill_value`. Only the stamp pixels
+    are read, so `data` may be a memory-mapped image.
+    """
+    ny, nx = data.shape
+    offsets = np.arange(-half_size, half_size + 1)
+    rows = np.asarray(iy, dtype=int)[:, None] + offsets
+    cols = np.asarray(ix, dtype=int)[:, None] + offsets
+
+    row_index = np.clip(rows, 0, ny - 1)[:, :, None]
+    col_index = np.clip(cols, 0, nx - 1)[:, None, :]
+    stamps = np.array(data[row_index, col_index], dtype=float)
+
+    row_inside = (rows >= 0) & (rows < ny)
+    col_inside = (cols >= 0) & (cols < nx)
+    stamps[~(row_inside[:, :, None] & col_inside[:, None, :])] = fill_value
+
+    return stamps
+
+
+def tile_layout(shape, tile_size, overlap):
+    """
+    Split an image into tiles: a core owned by the tile plus an overlap margin.
+
+    Returns (core, padded) slice pairs in (y0, y1, x0, x1) pixel bounds.
+    """
+    ny, nx = shape
+    tiles = []
+    for cy0 in range(0, ny, tile_size):
+        for cx0 in range(0, nx, tile_size):
+            cy1 = min(cy0 + tile_size, ny)
+            cx1 = min(cx0 + tile_size, nx)
+            padded = (
+                max(cy0 - overlap, 0),
+                min(cy1 + overlap, ny),
+                max(cx0 - overlap, 0),
+                min(cx1 + overlap, nx),
+            )
+            tiles.append(((cy0, cy1, cx0, cx1), padded))
+    return tiles
+
+
 def positions_from_string(pos_string):
     """
     Convert a string like '[(x1, y1), (x2, y2)]' into ArrayData.
@@ -36,15 +120,185 @@ def positions_from_string(pos_string):
 
     return array_positions
 
-def _write_ccd_to_fitsdata(ccd, extra_attrs=None):
-    with tempfile.TemporaryDirectory() as tmpdir:
-        path = os.path.join(tmpdir, "output.fits")
-        ccd.write(path, overwrite=True)
+def photometry_to_table(node):
+    """
+    Rebuild an astropy QTable from a photometry result.
+
+    Accepts both the columnar ArrayData and the Dict output of the
+    aperture photometry calcfunctions.
+    """
+    if isinstance(node, orm.ArrayData):
+        columns = node.base.attributes.get("columns", node.get_arraynames())
+        units = node.base.attributes.get("units", {})
+        data = {name: node.get_array(name) for name in columns}
+    else:
+        content = node.get_dict()
+        data = content["data"]
+        units = content.get("units", {})
+        columns = list(data)
+
+    table = QTable()
+    for name in columns:
+        values = np.asarray(data[name])
+        unit = units.get(name)
+        if unit in (None, "", "None"):
+            table[name] = values
+        else:
+            table[name] = values * u.Unit(unit)
+
+    return table
+
+
+def _encode_image_hdu(hdu, output):
+    # Apply the requested pixel type and tile compression to one image HDU
+    dtype = output.get("dtype")
+    compression = output.get("compression")
+    data, header = hdu.data, hdu.header.copy()
+
+    if dtype is not None and np.dtype(dtype).kind == "f":
+        data = data.astype(dtype)
+    elif dtype is not None:
+        # scale() below rescales the HDU data in place
+        data = data.copy()
+
+    if compression is not None:
+        encoded = fits.CompImageHDU(
+            data=data,
+            header=header,
+            name=hdu.name if hdu.name != "PRIMARY" else None,
+            compression_type=compression,
+            quantize_level=output.get("quantize_level", 16.0),
+        )
+    elif isinstance(hdu, fits.PrimaryHDU):
+        encoded = fits.PrimaryHDU(data=data, header=header)
+    else:
+        encoded = fits.ImageHDU(data=data, header=header, name=hdu.name)
+
+    # Integer output is stored with BSCALE/BZERO spanning the data range
+    if dtype is not None and np.dtype(dtype).kind in "iu":
+        encoded.scale(np.dtype(dtype).name, option="minmax")
+
+    return encoded
+
+
+def _encode_hdulist(hdul, output):
+    """
+    Re-encode the image HDUs of an HDUList according to `output`.
+
+    Only the science image is converted to `dtype`; mask and uncertainty
+    extensions keep their type. Compressed images cannot be primary HDUs,
+    so compression moves every image into an extension behind an empty
+    primary header, which FitsData detects when reading.
+    """
+    if not output.get("dtype") and not output.get("compression"):
+        return hdul
+
+    encoded = []
+    for index, hdu in enumerate(hdul):
+        if not hdu.is_image or hdu.data is None:
+            encoded.append(hdu)
+        elif index == 0:
+            encoded.append(_encode_image_hdu(hdu, output))
+        else:
+            # Extensions are compressed but keep their pixel type
+            encoded.append(_encode_image_hdu(hdu, {**output, "dtype": None}))
+
+    if output.get("compression") is not None:
+        encoded.insert(0, fits.PrimaryHDU())
+
+    return fits.HDUList(encoded)
+
+
+def _write_hdulist_to_fitsdata(
+    hdul, extra_attrs=None, output=None, filename="output.fits"
+):
+    """
+    Store an HDUList as a new FitsData node.
+
+    The file is encoded straight into the node repository through a pipe
+    fed by a writer thread, so it is written once and never held in memory
+    as a whole.
+
+    output:
+        Optional dict with keys:
+            - dtype: pixel type of the image, e.g. "float32", or an integer
+              type such as "int16" stored with BSCALE/BZERO
+            - compression: tile compression, e.g. "RICE_1" or "GZIP_1"
+            - quantize_level: quantisation of compressed floats (default 16)
+    """
+    encoded = _encode_hdulist(hdul, output or {})
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def write():
+        try:
+            with phase("fits_encode"), open(write_fd, "wb") as stream:
+                encoded.writeto(stream)
+        except BaseException as exc:
+            errors.append(exc)
+
+    # The writer runs in a copy of the caller's context (instrumentation)
+    writer = threading.Thread(target=contextvars.copy_context().run, args=(write,))
+    writer.start()
+    try:
+        with phase("repository_write"), open(read_fd, "rb") as stream:
+            node = FitsData(file=stream, filename=filename)
+    finally:
+        writer.join()
+        # An encoding error leaves the reader a truncated file; report it
+        # rather than the read error. A broken pipe means the reader failed.
+        if errors and not isinstance(errors[0], BrokenPipeError):
+            raise errors[0]
+
+    if extra_attrs:
+        for k, v in extra_attrs.items():
+            node.base.attributes.set(k, v)
+
+    return node
+
+
+def _frame_order(frames):
+    # Chronological by DATE-OBS; frames without it keep their order at the end
+    position = {label: i for i, label in enumerate(frames)}
+
+    def key(label):
+        date_obs = frames[label].header.get("DATE-OBS")
+        return (date_obs is None, date_obs or "", position[label])
+
+    return sorted(frames, key=key)
+
+
+def chip_label(extname, index):
+    """
+    Link label of a chip: its EXTNAME as an identifier, or 'hdu<index>'.
+    """
+    label = re.sub(r"\W+", "_", extname or "").strip("_").lower()
+    if not label or label == "primary" or label[0].isdigit():
+        return f"hdu{index}"
+    return label
+
+
+def _write_chips_to_fitsdata(
+    chips, primary_header=None, extra_attrs=None, output=None
+):
+    """
+    Store the chips of a mosaic as one multi-extension FitsData node.
+
+    chips:
+        List of (extname, data, header) written as image extensions behind
+        a data-less primary HDU. `output` applies to every chip.
+    """
+    hdus = [fits.PrimaryHDU(header=primary_header)]
+    for extname, data, header in chips:
+        hdu = fits.ImageHDU(data=data, header=header, name=extname)
+        hdus.append(_encode_image_hdu(hdu, output or {}))
 
-        node = FitsData(file=path)
+    return _write_hdulist_to_fitsdata(
+        fits.HDUList(hdus), extra_attrs=extra_attrs, filename="mosaic.fits"
+    )
 
-        if extra_attrs:
-            for k, v in extra_attrs.items():
-                node.base.attributes.set(k, v)
 
-        return node
+def _write_ccd_to_fitsdata(ccd, extra_attrs=None, output=None):
+    return _write_hdulist_to_fitsdata(
+        ccd.to_hdu(), extra_attrs=extra_attrs, output=output
+    )
@@ -8,8 +8,11 @@ from aiida_photometry.calcfunctions import (
     elliptical_aperture_photometry_cf,
     elliptical_annulus_photometry_cf,
     rectangular_aperture_photometry_cf,
-    rectangular_annulus_photometry_cf
+    rectangular_annulus_photometry_cf,
+    local_background_photometry_cf,
+    psf_photometry_cf,
 )
+from aiida_photometry.calcfunctions.psf import PSF_KEYS, PSF_MODELS
 
 APERTURE_DISPATCH = {
     "circular": circular_aperture_photometry_cf,
@@ -17,7 +20,9 @@ APERTURE_DISPATCH = {
     "elliptical": elliptical_aperture_photometry_cf,
     "elliptical_annulus": elliptical_annulus_photometry_cf,
     "rectangular":rectangular_aperture_photometry_cf,
-    "rectangular_annulus":rectangular_annulus_photometry_cf
+    "rectangular_annulus":rectangular_annulus_photometry_cf,
+    "local_background": local_background_photometry_cf,
+    "psf": psf_photometry_cf,
 }
 FitsData = DataFactory("fits.data")
 
@@ -47,8 +52,9 @@ class AperturePhotometryWorkChain(WorkChain):
         spec.input(
             "aperture",
             valid_type=orm.Dict,
-            default=lambda: orm.Dict(dict={"r": 2.0}),
-            help="Aperture geometry parameters",
+            required=False,
+            help="Aperture geometry parameters (default {'r': 2.0}), or the PSF "
+            "model for method 'psf' (default: Gaussian with the default FWHM)",
         )
 
         spec.input(
@@ -62,14 +68,17 @@ class AperturePhotometryWorkChain(WorkChain):
             "method",
             valid_type=orm.Str,
             default=lambda: orm.Str("circular"),
-            help="Photometry method: circular | circular_annulus | elliptical | elliptical_annulus",
+            help="Photometry method: circular | circular_annulus | elliptical | "
+            "elliptical_annulus | rectangular | rectangular_annulus | local_background "
+            "| psf",
         )
 
         # --- Outputs ---
         spec.output(
             "photometry",
-            valid_type=orm.Dict,
-            help="Aperture photometry results",
+            valid_type=(orm.Dict, orm.ArrayData),
+            help="Aperture photometry results (Dict, or columnar ArrayData "
+            "with photometry_options output_format='array')",
         )
 
         # --- Outline ---
@@ -86,6 +95,7 @@ class AperturePhotometryWorkChain(WorkChain):
             301, "ERROR_INVALID_POSITIONS", "Positions must contain 'x' and 'y'"
         )
         spec.exit_code(302, "ERROR_INVALID_APERTURE", "Invalid aperture parameters")
+        spec.exit_code(303, "ERROR_INVALID_PSF", "Unknown PSF parameters or model")
         spec.exit_code(310, "ERROR_UNKNOWN_METHOD", "Unknown photometry method")
 
     def validate_inputs(self):
@@ -101,11 +111,23 @@ class AperturePhotometryWorkChain(WorkChain):
         if method not in APERTURE_DISPATCH:
             return self.exit_codes.ERROR_UNKNOWN_METHOD
 
-        # Minimal aperture validation
-        aperture = self.inputs.aperture.get_dict()
-        if not aperture:
+        # Minimal aperture validation; the PSF model may be all defaults
+        aperture = self._aperture().get_dict()
+        if method == "psf":
+            if set(aperture) - set(PSF_KEYS):
+                return self.exit_codes.ERROR_INVALID_PSF
+            if aperture.get("model", "gaussian") not in PSF_MODELS:
+                return self.exit_codes.ERROR_INVALID_PSF
+        elif not aperture:
             return self.exit_codes.ERROR_INVALID_APERTURE
 
+    def _aperture(self):
+        if "aperture" in self.inputs:
+            return self.inputs.aperture
+        if self.inputs.method.value == "psf":
+            return orm.Dict(dict={})
+        return orm.Dict(dict={"r": 2.0})
+
     def prepare_image(self):
         # TODO
         image = self.inputs.image
@@ -118,7 +140,7 @@ class AperturePhotometryWorkChain(WorkChain):
         self.ctx.photometry = photometry_cf(
             self.ctx.image,
             self.inputs.positions,
-            self.inputs.aperture,
+            self._aperture(),
             self.inputs.photometry_options,
         )
 
@@ -0,0 +1,137 @@
+from aiida.engine import WorkChain, append_, while_
+from aiida import orm
+from aiida.plugins import DataFactory, WorkflowFactory
+
+from aiida_photometry.calcfunctions import summarize_photometry_cf
+
+FitsData = DataFactory("fits.data")
+PhotometryPipelineWC = WorkflowFactory("photometry.pipeline")
+
+
+class BatchPhotometryPipelineWorkChain(WorkChain):
+    """
+    Run the photometry pipeline on many images with a concurrency limit.
+
+    Per-image pipelines are submitted in waves of at most max_concurrent
+    workchains; the next wave starts once the previous one has finished.
+    """
+
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+
+        # --- Inputs ---
+        spec.input_namespace(
+            "images",
+            valid_type=FitsData,
+            dynamic=True,
+            help="Science images, one pipeline is run per image",
+        )
+
+        spec.expose_inputs(
+            PhotometryPipelineWC,
+            namespace="pipeline",
+            exclude=("image", "background_map"),
+        )
+
+        spec.input(
+            "max_concurrent",
+            valid_type=orm.Int,
+            default=lambda: orm.Int(10),
+            help="Maximum number of pipelines running at the same time",
+        )
+
+        # --- Outputs ---
+        spec.output_namespace(
+            "photometry",
+            valid_type=(orm.Dict, orm.ArrayData),
+            dynamic=True,
+            help="Photometry of every successful image, keyed by image label",
+        )
+
+        spec.output(
+            "summary",
+            valid_type=orm.Dict,
+            help="Counts, per-image source numbers and failed images",
+        )
+
+        # --- Outline ---
+        spec.outline(
+            cls.setup,
+            while_(cls.has_pending)(
+                cls.submit_wave,
+                cls.inspect_wave,
+            ),
+            cls.finalize,
+        )
+
+        # --- Exit codes ---
+        spec.exit_code(300, "ERROR_NO_IMAGES", "No images were provided")
+        spec.exit_code(
+            301, "ERROR_INVALID_CONCURRENCY", "max_concurrent must be at least 1"
+        )
+        spec.exit_code(
+            400, "ERROR_ALL_PIPELINES_FAILED", "None of the pipelines finished"
+        )
+
+    def setup(self):
+        if not self.inputs.images:
+            return self.exit_codes.ERROR_NO_IMAGES
+        if self.inputs.max_concurrent.value < 1:
+            return self.exit_codes.ERROR_INVALID_CONCURRENCY
+
+        self.ctx.pending = sorted(self.inputs.images)
+        self.ctx.labels = []
+        self.ctx.pipelines = []
+        self.ctx.status = {}
+        self.ctx.photometry = {}
+
+    def has_pending(self):
+        return bool(self.ctx.pending)
+
+    def submit_wave(self):
+        size = self.inputs.max_concurrent.value
+        wave, self.ctx.pending = self.ctx.pending[:size], self.ctx.pending[size:]
+
+        inputs = self.exposed_inputs(PhotometryPipelineWC, namespace="pipeline")
+        for label in wave:
+            future = self.submit(
+                PhotometryPipelineWC, image=self.inputs.images[label], **inputs
+            )
+            self.ctx.labels.append(label)
+            self.to_context(pipelines=append_(future))
+
+    def inspect_wave(self):
+        # Only the pipelines of the last wave have not been inspected yet
+        new = [
+            (label, node)
+            for label, node in zip(self.ctx.labels, self.ctx.pipelines)
+            if label not in self.ctx.status
+        ]
+        for label, node in new:
+            self.ctx.status[label] = node.exit_status
+            if node.is_finished_ok:
+                self.ctx.photometry[label] = node.outputs.aperture.photometry
+            else:
+                self.report(
+                    f"Pipeline<{node.pk}> for image '{label}' failed with exit "
+                    f"status {node.exit_status}"
+                )
+
+        n_failed = len(self.ctx.status) - len(self.ctx.photometry)
+        self.report(
+            f"{len(self.ctx.status)}/{len(self.inputs.images)} images processed, "
+            f"{n_failed} failed"
+        )
+
+    def finalize(self):
+        summary = summarize_photometry_cf(
+            status=orm.Dict(dict=self.ctx.status), **self.ctx.photometry
+        )
+
+        for label, node in self.ctx.photometry.items():
+            self.out(f"photometry.{label}", node)
+        self.out("summary", summary)
+
+        if not self.ctx.photometry:
+            return self.exit_codes.ERROR_ALL_PIPELINES_FAILED
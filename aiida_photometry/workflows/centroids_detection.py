@@ -2,7 +2,11 @@ from aiida.engine import WorkChain
 from aiida import orm
 from aiida.orm import ArrayData, Dict
 from aiida.plugins import DataFactory
-from aiida_photometry.calcfunctions import centroid_sources_cf, detect_sources_cf
+from aiida_photometry.calcfunctions import (
+    centroid_batch_cf,
+    centroid_sources_cf,
+    detect_sources_cf,
+)
 
 FitsData = DataFactory("fits.data")
 
@@ -37,6 +41,14 @@ class SourceDetectionWorkChain(WorkChain):
             help="Parameters for centroid_sources refinement",
         )
 
+        spec.input(
+            "refine_engine",
+            valid_type=orm.Str,
+            default=lambda: orm.Str("centroid_sources"),
+            help="'centroid_sources' or 'batch' (centroid_batch_cf, refine_params "
+            "are its options)",
+        )
+
         # --- Outputs ---
         spec.output("sources", valid_type=ArrayData, help="Refined source positions")
 
@@ -71,8 +83,13 @@ class SourceDetectionWorkChain(WorkChain):
 
     def refine_sources(self):
         """Refine the detected source positions using centroid_sources calcfunction."""
+        refine = (
+            centroid_batch_cf
+            if self.inputs.refine_engine.value == "batch"
+            else centroid_sources_cf
+        )
         try:
-            self.ctx.refined_positions = centroid_sources_cf(
+            self.ctx.refined_positions = refine(
                 image=self.ctx.image,
                 positions=self.ctx.positions,
                 options=self.inputs.refine_params,
@@ -1,11 +1,13 @@
 from aiida.engine import WorkChain
 from aiida.plugins import DataFactory
-from aiida.orm import Dict
+from aiida.orm import ArrayData, Dict
 from aiida_photometry.calcfunctions import (
     create_master_bias,
     create_master_dark,
     create_master_flat,
     calibrate_science,
+    calibrate_science_batch,
+    cosmicray_lacosmic_cf,
 )
 
 FitsData = DataFactory("fits.data")
@@ -16,7 +18,14 @@ class SimpleCalibrationWorkChain(WorkChain):
     @classmethod
     def define(cls, spec):
         super().define(spec)
-        spec.input("raw_science", valid_type=FitsData)
+        spec.input("raw_science", valid_type=FitsData, required=False)
+        spec.input_namespace(
+            "science_frames",
+            valid_type=FitsData,
+            dynamic=True,
+            required=False,
+            help="Science frames calibrated together against the same masters",
+        )
         spec.input_namespace("bias_frames", valid_type=FitsData, dynamic=True)
         spec.input_namespace(
             "dark_frames", valid_type=FitsData, dynamic=True, required=False
@@ -25,15 +34,36 @@ class SimpleCalibrationWorkChain(WorkChain):
             "flat_frames", valid_type=FitsData, dynamic=True, required=False
         )
         spec.input("parameters", valid_type=Dict)
+        spec.input(
+            "cosmic_ray_params",
+            valid_type=Dict,
+            required=False,
+            help="Options of cosmicray_lacosmic_cf; if given, calibrated science "
+            "frames are cleaned of cosmic rays",
+        )
         spec.outline(
             cls.create_master_bias_step,
             cls.create_master_dark_step,
-            cls.create_master_flat_step
+            cls.create_master_flat_step,
+            cls.calibrate_science_step,
+            cls.reject_cosmic_rays_step,
+            cls.finalize,
         )
         spec.output("master_bias", valid_type=FitsData)
-        spec.output("master_dark", valid_type=FitsData)
-        spec.output("master_flat", valid_type=FitsData)
-        spec.output("calibrated_science", valid_type=FitsData)
+        spec.output("master_dark", valid_type=FitsData, required=False)
+        spec.output("master_flat", valid_type=FitsData, required=False)
+        spec.output("calibrated_science", valid_type=FitsData, required=False)
+        spec.output_namespace(
+            "calibrated_frames", valid_type=FitsData, dynamic=True, required=False
+        )
+        spec.output_namespace(
+            "cosmic_ray_masks",
+            valid_type=ArrayData,
+            dynamic=True,
+            required=False,
+            help="uint8 cosmic-ray masks, under 'science' for raw_science and "
+            "the frame label for science_frames",
+        )
 
     def create_master_bias_step(self):
         bias_nodes = self.inputs.bias_frames
@@ -59,22 +89,61 @@ class SimpleCalibrationWorkChain(WorkChain):
             return
 
         flat_nodes = self.inputs.flat_frames
+        masters = {"master_bias": self.ctx.master_bias}
+        if "master_dark" in self.ctx:
+            masters["master_dark"] = self.ctx.master_dark
+
         master = create_master_flat(
-            master_bias = self.ctx.master_bias,
-            master_dark = self.ctx.master_dark,
-            parameters = self.inputs.parameters, 
-            **flat_nodes
+            parameters=self.inputs.parameters, **masters, **flat_nodes
         )
         self.ctx.master_flat = master
         self.out("master_flat", master)
 
     def calibrate_science_step(self):
-        calibrated = calibrate_science(
-            self.inputs.raw_science,
-            self.ctx.master_bias,
-            self.ctx.master_dark,
-            None,  # master flat, omitted for test
-            self.inputs.parameters,
-        )
-        self.ctx.calibrated_science = calibrated
-        self.out("calibrated_science", calibrated)
+        masters = {"master_bias": self.ctx.master_bias}
+        for key in ("master_dark", "master_flat"):
+            if key in self.ctx:
+                masters[key] = self.ctx[key]
+
+        if "raw_science" in self.inputs:
+            calibrated = calibrate_science(
+                self.inputs.raw_science,
+                parameters=self.inputs.parameters,
+                **masters,
+            )
+            self.ctx.calibrated_science = calibrated
+
+        if "science_frames" in self.inputs:
+            calibrated = calibrate_science_batch(
+                parameters=self.inputs.parameters,
+                **masters,
+                **self.inputs.science_frames,
+            )
+            self.ctx.calibrated_frames = dict(calibrated)
+
+    def reject_cosmic_rays_step(self):
+        if "cosmic_ray_params" not in self.inputs:
+            return
+
+        self.ctx.cosmic_ray_masks = {}
+        options = self.inputs.cosmic_ray_params
+
+        if "calibrated_science" in self.ctx:
+            result = cosmicray_lacosmic_cf(self.ctx.calibrated_science, options)
+            self.ctx.calibrated_science = result["cleaned"]
+            self.ctx.cosmic_ray_masks["science"] = result["cr_mask"]
+
+        for label, node in self.ctx.get("calibrated_frames", {}).items():
+            result = cosmicray_lacosmic_cf(node, options)
+            self.ctx.calibrated_frames[label] = result["cleaned"]
+            self.ctx.cosmic_ray_masks[label] = result["cr_mask"]
+
+    def finalize(self):
+        if "calibrated_science" in self.ctx:
+            self.out("calibrated_science", self.ctx.calibrated_science)
+
+        for label, node in self.ctx.get("calibrated_frames", {}).items():
+            self.out(f"calibrated_frames.{label}", node)
+
+        for label, node in self.ctx.get("cosmic_ray_masks", {}).items():
+            self.out(f"cosmic_ray_masks.{label}", node)
@@ -0,0 +1,90 @@
+from aiida.engine import WorkChain
+from aiida import orm
+from aiida.plugins import DataFactory
+
+from aiida_photometry.calcfunctions import forced_photometry_cf
+
+FitsData = DataFactory("fits.data")
+
+
+class LightCurveWorkChain(WorkChain):
+    """
+    Forced aperture photometry of a fixed list of positions over a time series.
+    """
+
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+
+        # --- Inputs ---
+        spec.input_namespace(
+            "frames",
+            valid_type=FitsData,
+            dynamic=True,
+            help="Frames of the time series, ordered by their DATE-OBS",
+        )
+
+        spec.input(
+            "positions",
+            valid_type=orm.ArrayData,
+            help="Reference source positions with arrays 'x' and 'y'",
+        )
+
+        spec.input(
+            "aperture",
+            valid_type=orm.Dict,
+            default=lambda: orm.Dict(dict={"r": 3.0}),
+            help="Aperture radius 'r', plus 'r_in'/'r_out' for local background",
+        )
+
+        spec.input(
+            "photometry_options",
+            valid_type=orm.Dict,
+            default=lambda: orm.Dict(dict={"max_workers": 4}),
+            help="Options of forced_photometry_cf; 'max_workers' bounds the "
+            "number of frames measured concurrently",
+        )
+
+        # --- Outputs ---
+        spec.output(
+            "light_curve",
+            valid_type=orm.ArrayData,
+            help="Flux and error arrays (frames x sources) with timestamps",
+        )
+
+        # --- Outline ---
+        spec.outline(
+            cls.validate_inputs,
+            cls.run_photometry,
+            cls.finalize,
+        )
+
+        # --- Exit codes ---
+        spec.exit_code(300, "ERROR_NO_FRAMES", "No frames were provided")
+        spec.exit_code(
+            301, "ERROR_INVALID_POSITIONS", "Positions must contain 'x' and 'y'"
+        )
+        spec.exit_code(302, "ERROR_INVALID_APERTURE", "Invalid aperture parameters")
+
+    def validate_inputs(self):
+        if not self.inputs.frames:
+            return self.exit_codes.ERROR_NO_FRAMES
+
+        positions = self.inputs.positions
+        for key in ("x", "y"):
+            if key not in positions.get_arraynames():
+                return self.exit_codes.ERROR_INVALID_POSITIONS
+
+        if "r" not in self.inputs.aperture.get_dict():
+            return self.exit_codes.ERROR_INVALID_APERTURE
+
+    def run_photometry(self):
+        self.ctx.light_curve = forced_photometry_cf(
+            positions=self.inputs.positions,
+            geometry=self.inputs.aperture,
+            options=self.inputs.photometry_options,
+            **self.inputs.frames,
+        )
+
+    def finalize(self):
+        self.out("light_curve", self.ctx.light_curve)
@@ -1,6 +1,6 @@
 from aiida.engine import WorkChain
 from aiida import orm
-from aiida.plugins import WorkflowFactory,DataFactory
+from aiida.plugins import WorkflowFactory, DataFactory
 from aiida_photometry.calcfunctions import subtract_background
 
 FitsData = DataFactory("fits.data")
@@ -22,7 +22,8 @@ class PhotometryPipelineWorkChain(WorkChain):
         spec.expose_inputs(
             BackgroundWC,
             namespace="background",
-            exclude=("image"),
+            exclude=("image",),
+            namespace_options={"required": False, "populate_defaults": False},
         )
 
         spec.expose_inputs(
@@ -47,12 +48,14 @@ class PhotometryPipelineWorkChain(WorkChain):
             "background_map",
             valid_type=orm.ArrayData,
             required=False,
-            help="Optional precomputed background image.",
+            help="Optional precomputed background image; replaces the "
+            "background inputs",
         )
 
         spec.expose_outputs(
             BackgroundWC,
             namespace="background",
+            namespace_options={"required": False},
         )
 
         spec.expose_outputs(
@@ -66,6 +69,7 @@ class PhotometryPipelineWorkChain(WorkChain):
         )
 
         spec.outline(
+            cls.validate_inputs,
             cls.run_background,
             cls.subtract_background,
             cls.run_source_detection,
@@ -73,26 +77,48 @@ class PhotometryPipelineWorkChain(WorkChain):
             cls.finalize,
         )
 
+        spec.exit_code(
+            300,
+            "ERROR_MISSING_BACKGROUND",
+            "Either background_map or the background inputs must be given",
+        )
+        spec.exit_code(
+            401, "ERROR_BACKGROUND_FAILED", "The background workchain failed"
+        )
+        spec.exit_code(
+            402, "ERROR_DETECTION_FAILED", "The source detection workchain failed"
+        )
+        spec.exit_code(
+            403, "ERROR_PHOTOMETRY_FAILED", "The aperture photometry workchain failed"
+        )
+
+    def validate_inputs(self):
+        if "background_map" not in self.inputs and not self.inputs.get("background"):
+            return self.exit_codes.ERROR_MISSING_BACKGROUND
+
     def run_background(self):
         if "background_map" in self.inputs:
-            self.ctx.background = self.inputs.background
+            self.ctx.background = self.inputs.background_map
             return
-        
+
         inputs = self.exposed_inputs(BackgroundWC, namespace="background")
         inputs["image"] = self.inputs.image
         future = self.submit(BackgroundWC, **inputs)
         return self.to_context(bkg=future)
-    
+
     def subtract_background(self):
         if "background_map" in self.inputs:
-            background = self.inputs.background
+            background = self.inputs.background_map
         else:
+            if not self.ctx.bkg.is_finished_ok:
+                return self.exit_codes.ERROR_BACKGROUND_FAILED
             background = self.ctx.bkg.outputs.background
 
         self.ctx.image_sub = subtract_background(
             self.inputs.image,
             background,
         )
+
     def run_source_detection(self):
         """Run the source detection workflow."""
         inputs = self.exposed_inputs(SourceDetectionWC, namespace="detection")
@@ -104,6 +130,9 @@ class PhotometryPipelineWorkChain(WorkChain):
 
     def run_aperture_photometry(self):
         """Run aperture photometry using detected source positions."""
+        if not self.ctx.source_detection.is_finished_ok:
+            return self.exit_codes.ERROR_DETECTION_FAILED
+
         inputs = self.exposed_inputs(AperturePhotometryWC, namespace="aperture")
 
         inputs["image"] = self.ctx.image_sub
@@ -113,6 +142,21 @@ class PhotometryPipelineWorkChain(WorkChain):
         return self.to_context(photometry=future)
 
     def finalize(self):
+        if not self.ctx.photometry.is_finished_ok:
+            return self.exit_codes.ERROR_PHOTOMETRY_FAILED
+
+        # No background workchain runs when a background_map is given
+        if "bkg" in self.ctx:
+            self.out_many(
+                self.exposed_outputs(self.ctx.bkg, BackgroundWC, namespace="background")
+            )
+        self.out_many(
+            self.exposed_outputs(
+                self.ctx.source_detection,
+                SourceDetectionWC,
+                namespace="detection",
+            )
+        )
         self.out_many(
             self.exposed_outputs(
                 self.ctx.photometry,
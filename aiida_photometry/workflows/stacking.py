@@ -0,0 +1,100 @@
+from aiida.engine import WorkChain
+from aiida import orm
+from aiida.plugins import DataFactory
+
+from aiida_photometry.calcfunctions import register_frames_cf, stack_frames_cf
+from aiida_photometry.calcfunctions.registration import STACK_METHODS
+
+FitsData = DataFactory("fits.data")
+
+
+class StackingWorkChain(WorkChain):
+    """
+    Register science frames on a reference frame and co-add them.
+    """
+
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+
+        # --- Inputs ---
+        spec.input_namespace(
+            "frames",
+            valid_type=FitsData,
+            dynamic=True,
+            help="Calibrated frames of one field, all with the same shape",
+        )
+
+        spec.input(
+            "registration_params",
+            valid_type=orm.Dict,
+            default=lambda: orm.Dict(dict={}),
+            help="Options of register_frames_cf (reference, downsample, ...)",
+        )
+
+        spec.input(
+            "stacking_params",
+            valid_type=orm.Dict,
+            default=lambda: orm.Dict(dict={}),
+            help="Options of stack_frames_cf (method, interpolation, "
+            "mem_limit, ...)",
+        )
+
+        # --- Outputs ---
+        spec.output(
+            "offsets",
+            valid_type=orm.ArrayData,
+            help="Per-frame offsets 'dx'/'dy' relative to the reference frame",
+        )
+
+        spec.output(
+            "stacked",
+            valid_type=FitsData,
+            help="Co-added image with an 'EXPMAP' exposure map extension",
+        )
+
+        # --- Outline ---
+        spec.outline(
+            cls.validate_inputs,
+            cls.register_frames,
+            cls.stack_frames,
+            cls.finalize,
+        )
+
+        # --- Exit codes ---
+        spec.exit_code(300, "ERROR_NO_FRAMES", "No frames were provided")
+        spec.exit_code(301, "ERROR_INVALID_STACKING_METHOD", "Unknown stacking method")
+        spec.exit_code(
+            302, "ERROR_SHAPE_MISMATCH", "Frames do not all have the same shape"
+        )
+
+    def validate_inputs(self):
+        if not self.inputs.frames:
+            return self.exit_codes.ERROR_NO_FRAMES
+
+        method = self.inputs.stacking_params.get_dict().get("method", "sigma_clip")
+        if method not in STACK_METHODS:
+            return self.exit_codes.ERROR_INVALID_STACKING_METHOD
+
+        shapes = {
+            tuple(frame.base.attributes.get("shape", ()))
+            for frame in self.inputs.frames.values()
+        }
+        if len(shapes) != 1:
+            return self.exit_codes.ERROR_SHAPE_MISMATCH
+
+    def register_frames(self):
+        self.ctx.offsets = register_frames_cf(
+            options=self.inputs.registration_params, **self.inputs.frames
+        )
+
+    def stack_frames(self):
+        self.ctx.stacked = stack_frames_cf(
+            offsets=self.ctx.offsets,
+            options=self.inputs.stacking_params,
+            **self.inputs.frames,
+        )
+
+    def finalize(self):
+        self.out("offsets", self.ctx.offsets)
+        self.out("stacked", self.ctx.stacked)
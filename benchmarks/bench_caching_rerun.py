@@ -0,0 +1,78 @@
+"""
+Rerun speedup of the background/detection/photometry calcfunctions with caching.
+
+Two FitsData nodes are created from identical bytes under different file
+names. The chain of calcfunctions runs on the first one with a cold cache
+and then on the second one; with content-based hashing every step of the
+second run must be a cache hit. Needs a configured AiiDA profile.
+
+    python benchmarks/bench_caching_rerun.py --size 2048 --sources 2000
+"""
+import argparse
+import io
+import time
+
+from aiida import load_profile, orm
+
+from aiida_photometry.caching import check_cacheable, enable_photometry_caching
+from aiida_photometry.calcfunctions import (
+    background_2d_cf,
+    circular_aperture_photometry_cf,
+    detect_sources_cf,
+    subtract_background,
+)
+from aiida_photometry.data.fits_data import FitsData
+from aiida_photometry.synthetic import star_field, to_fits_bytes
+
+
+def run_chain(image):
+    nodes = []
+    start = time.perf_counter()
+    background = background_2d_cf(image, orm.Dict({"box_size": 64}))
+    subtracted = subtract_background(image, background)
+    sources = detect_sources_cf(subtracted, orm.Dict({"threshold": 25.0, "fwhm": 3.0}))
+    photometry = circular_aperture_photometry_cf(
+        subtracted, sources, orm.Dict({"r": 4.0}), orm.Dict({})
+    )
+    elapsed = time.perf_counter() - start
+
+    for output in (background, subtracted, sources, photometry):
+        nodes.append(output.creator)
+    return elapsed, nodes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--size", type=int, default=2048)
+    parser.add_argument("--sources", type=int, default=2000)
+    parser.add_argument("--profile", default=None)
+    args = parser.parse_args()
+
+    load_profile(args.profile)
+
+    problems = check_cacheable()
+    if problems:
+        raise SystemExit(f"Calcfunctions that cannot be cached: {problems}")
+
+    data, _ = star_field(args.size, density=args.sources / args.size**2)
+    content = to_fits_bytes(data)
+    # Same bytes, different file names
+    first = FitsData(file=io.BytesIO(content), filename="night1_0001.fits").store()
+    second = FitsData(file=io.BytesIO(content), filename="copy_of_0001.fits").store()
+    if first.base.caching.get_hash() != second.base.caching.get_hash():
+        raise SystemExit("Identical files do not hash equally")
+
+    with enable_photometry_caching():
+        cold, _ = run_chain(first)
+        warm, nodes = run_chain(second)
+
+    cached = [node.base.caching.is_created_from_cache for node in nodes]
+    print(f"cold run: {cold:.3f} s")
+    print(f"rerun:    {warm:.3f} s ({cold / warm:.1f}x)")
+    print(f"cache hits: {sum(cached)}/{len(cached)}")
+    if not all(cached):
+        raise SystemExit("Rerun was not fully served from the cache")
+
+
+if __name__ == "__main__":
+    main()
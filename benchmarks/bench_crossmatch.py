@@ -0,0 +1,87 @@
+"""
+KD-tree cross-matching against a brute-force one-to-one search.
+
+Builds a reference catalog and shifted, jittered and incomplete copies of
+it, matches them with and without offset fitting and prints wall time, the
+fraction of correct matches and the recovered offsets. The brute-force
+search is only run up to --brute-max sources. No AiiDA profile is needed.
+
+    python benchmarks/bench_crossmatch.py --sources 1000 10000 100000
+"""
+import argparse
+import time
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from aiida_photometry.calcfunctions.crossmatch import _fit_offset, _nearest_matches
+from aiida_photometry.synthetic import star_catalog
+
+
+def perturbed(ref, offset, jitter, completeness, rng):
+    """
+    Catalog of a frame: kept sources shifted by offset, with position noise
+    and shuffled. Returns the points and the true reference index of each.
+    """
+    keep = np.flatnonzero(rng.random(len(ref)) < completeness)
+    keep = rng.permutation(keep)
+    points = ref[keep] + offset + rng.normal(0.0, jitter, (len(keep), 2))
+    return points, keep
+
+
+def brute_force(ref, points, offset, tolerance):
+    # All pairs within tolerance, assigned one to one from the closest
+    pairs = []
+    for i, source in enumerate(ref + offset):
+        distance = np.hypot(*(points - source).T)
+        pairs += [(distance[j], i, j) for j in np.flatnonzero(distance <= tolerance)]
+
+    index = np.full(len(ref), -1)
+    taken = np.zeros(len(points), dtype=bool)
+    for _, i, j in sorted(pairs):
+        if index[i] < 0 and not taken[j]:
+            index[i], taken[j] = j, True
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sources", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--size", type=int, default=4096)
+    parser.add_argument("--tolerance", type=float, default=1.0)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--completeness", type=float, default=0.9)
+    parser.add_argument("--brute-max", type=int, default=10000)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    true_offset = np.array([7.3, -4.1])
+
+    for n in args.sources:
+        catalog = star_catalog(args.size, density=n / args.size**2)
+        ref = np.column_stack([catalog["x"], catalog["y"]])
+        points, truth = perturbed(ref, true_offset, args.jitter, args.completeness, rng)
+        expected = np.full(len(ref), -1)
+        expected[truth] = np.arange(len(truth))
+
+        start = time.perf_counter()
+        tree = cKDTree(points)
+        offset = _fit_offset(ref, tree, (0.0, 0.0), {"tolerance": args.tolerance}, 1)
+        index, _ = _nearest_matches(ref, tree, offset, args.tolerance, 1)
+        elapsed = time.perf_counter() - start
+
+        line = (
+            f"{len(ref):>8} sources: kd-tree {elapsed:8.3f} s, "
+            f"correct {(index == expected).mean():.2%}, "
+            f"offset ({offset[0]:.3f}, {offset[1]:.3f})"
+        )
+        if len(ref) <= args.brute_max:
+            start = time.perf_counter()
+            brute = brute_force(ref, points, offset, args.tolerance)
+            line += f", brute force {time.perf_counter() - start:8.3f} s"
+            line += f" ({(brute == index).mean():.2%} identical)"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Speed against accuracy of the approximate global background estimators.
+
+Compares the exact sigma_clipped_stats result on a synthetic frame with the
+strided, random and histogram approximations for several sample sizes, and
+prints wall time, deviation from the exact values and the reported error.
+No AiiDA profile is needed.
+
+    python benchmarks/bench_global_background.py --size 8192 --sample-sizes 1e4 1e5 1e6
+"""
+import argparse
+import time
+
+from astropy.stats import sigma_clipped_stats
+
+from aiida_photometry.calcfunctions.background import _approximate_background
+from aiida_photometry.synthetic import star_field
+
+
+def run_exact(data):
+    start = time.perf_counter()
+    mean, median, std = sigma_clipped_stats(data, sigma=3.0, maxiters=5)
+    return {"mean": mean, "median": median, "std": std}, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--size", type=int, default=4096)
+    parser.add_argument("--sources", type=int, default=20000)
+    parser.add_argument(
+        "--sample-sizes", type=float, nargs="+", default=[1e4, 1e5, 1e6]
+    )
+    parser.add_argument("--bins", type=int, nargs="+", default=[256, 1024, 4096])
+    args = parser.parse_args()
+
+    # Stars give the clipping work to do
+    data, _ = star_field(args.size, density=args.sources / args.size**2, sky=1000.0)
+    exact, exact_time = run_exact(data)
+    print(
+        f"exact: {exact_time:.3f} s  median={exact['median']:.4f} "
+        f"std={exact['std']:.4f}"
+    )
+
+    configs = [
+        {"sampling": sampling, "sample_size": int(n)}
+        for sampling in ("stride", "random")
+        for n in args.sample_sizes
+    ]
+    configs += [{"sampling": "histogram", "bins": bins} for bins in args.bins]
+
+    print(
+        f"{'sampling':>10} {'n/bins':>8} {'time s':>8} {'speedup':>8} "
+        f"{'d median':>9} {'err':>8} {'d std':>8} {'err':>8}"
+    )
+    for params in configs:
+        start = time.perf_counter()
+        approx = _approximate_background(data, params)
+        elapsed = time.perf_counter() - start
+
+        size = params.get("sample_size", params.get("bins"))
+        print(
+            f"{params['sampling']:>10} {size:>8} {elapsed:>8.4f} "
+            f"{exact_time / elapsed:>8.1f} "
+            f"{abs(approx['median'] - exact['median']):>9.4f} "
+            f"{approx['median_err']:>8.4f} "
+            f"{abs(approx['std'] - exact['std']):>8.4f} {approx['std_err']:>8.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Accuracy and speed of register_frames_cf and stack_frames_cf.
+
+Renders frames of one synthetic field with known offsets, registers them
+and prints the offset errors, then stacks them with each method and prints
+wall time and the background noise of the stack relative to one frame.
+Needs a configured AiiDA profile.
+
+    python benchmarks/bench_registration.py --size 4096 --frames 10 --max-offset 40
+"""
+import argparse
+import time
+
+import numpy as np
+from aiida import load_profile, orm
+from aiida.manage.caching import disable_caching
+
+from aiida_photometry.calcfunctions import register_frames_cf, stack_frames_cf
+from aiida_photometry.calcfunctions.registration import exposure_map
+from aiida_photometry.synthetic import star_catalog, star_field, to_fitsdata
+
+
+def shifted_frames(size, n_frames, max_offset, density, seed=0):
+    """
+    FitsData frames of one field and the true (dx, dy) of every frame.
+    """
+    rng = np.random.default_rng(seed)
+    catalog = star_catalog(size, density, border=int(max_offset) + 10, seed=seed)
+    offsets = rng.uniform(-max_offset, max_offset, (n_frames, 2))
+    offsets[0] = 0.0
+
+    frames = {}
+    for i, (dx, dy) in enumerate(offsets):
+        shifted = dict(catalog, x=catalog["x"] + dx, y=catalog["y"] + dy)
+        data, _ = star_field(size, seed=seed + 10 + i, catalog=shifted)
+        frames[f"frame_{i:03d}"] = to_fitsdata(data, filename=f"frame_{i}.fits")
+    return frames, offsets
+
+
+def background_noise(data):
+    finite = data[np.isfinite(data)]
+    median = np.median(finite)
+    return 1.4826 * np.median(np.abs(finite - median))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--size", type=int, default=2048)
+    parser.add_argument("--frames", type=int, default=8)
+    parser.add_argument("--max-offset", type=float, default=20.0)
+    parser.add_argument("--density", type=float, default=5e-4)
+    parser.add_argument("--downsample", type=int, default=4)
+    parser.add_argument("--mem-limit", type=float, default=2e8)
+    parser.add_argument("--profile", default=None)
+    args = parser.parse_args()
+
+    load_profile(args.profile)
+    frames, truth = shifted_frames(
+        args.size, args.frames, args.max_offset, args.density
+    )
+
+    with disable_caching():
+        start = time.perf_counter()
+        offsets = register_frames_cf(
+            options=orm.Dict(dict={"downsample": args.downsample}), **frames
+        )
+        elapsed = time.perf_counter() - start
+
+        labels = offsets.base.attributes.get("labels")
+        order = [int(label.split("_")[1]) for label in labels]
+        reference = truth[order[0]]
+        error_x = offsets.get_array("dx") - (truth[order, 0] - reference[0])
+        error_y = offsets.get_array("dy") - (truth[order, 1] - reference[1])
+        print(
+            f"registration: {elapsed:.2f} s for {args.frames} frames, "
+            f"max error {np.abs(np.concatenate([error_x, error_y])).max():.3f} px, "
+            f"rms {np.sqrt(np.mean(error_x**2 + error_y**2)):.3f} px"
+        )
+
+        reference_frame = frames[offsets.base.attributes.get("reference")]
+        single = background_noise(reference_frame.get_array())
+        for method in ("mean", "median", "sigma_clip"):
+            options = {"method": method, "mem_limit": args.mem_limit}
+            start = time.perf_counter()
+            stacked = stack_frames_cf(offsets, orm.Dict(dict=options), **frames)
+            elapsed = time.perf_counter() - start
+
+            noise = background_noise(stacked.get_array())
+            print(
+                f"{method:>10}: {elapsed:.2f} s, noise {noise / single:.3f} of one "
+                f"frame (ideal {1 / np.sqrt(args.frames):.3f}), "
+                f"max exposure {exposure_map(stacked).max():.0f} s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+"""
+Time and memory profile of the calcfunctions and workchains at several scales.
+
+Inputs are generated with aiida_photometry.synthetic, so runs are
+reproducible. Each case records wall time, CPU time and the peak traced
+allocation of the calling process (numpy buffers included, worker processes
+not); results are written as JSON. With --compare, cases slower than --threshold times a
+previous result file are listed. Needs a configured AiiDA profile.
+
+    python benchmarks/run_suite.py --scales small medium --output results.json
+    python benchmarks/run_suite.py --scales small --compare results.json
+"""
+import argparse
+import datetime
+import fnmatch
+import gc
+import json
+import os
+import platform
+import time
+import tracemalloc
+
+import astropy
+import numpy as np
+import photutils
+from aiida import load_profile, orm
+from aiida.engine import run
+from aiida.manage.caching import disable_caching
+from aiida.plugins import WorkflowFactory
+
+from aiida_photometry import calcfunctions as cf
+from aiida_photometry.synthetic import (
+    calibration_frames,
+    star_field,
+    science_header,
+    star_field_series,
+    to_fitsdata,
+)
+
+SCALES = {
+    "small": {"size": 512, "frames": 5, "density": 1e-3},
+    "medium": {"size": 2048, "frames": 10, "density": 5e-4},
+    "large": {"size": 4096, "frames": 20, "density": 5e-4},
+}
+
+
+def profile(func, trace_memory=True):
+    """
+    Run func() and return (result, metrics).
+    """
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = func()
+    metrics = {
+        "wall_s": time.perf_counter() - wall,
+        "cpu_s": time.process_time() - cpu,
+    }
+
+    if trace_memory:
+        metrics["peak_alloc_mb"] = tracemalloc.get_traced_memory()[1] / 1024**2
+        tracemalloc.stop()
+
+    return result, metrics
+
+
+def stored_frames(frames, prefix):
+    return {
+        f"{prefix}_{i}": to_fitsdata(data, header, f"{prefix}_{i}.fits").store()
+        for i, (data, header) in enumerate(frames)
+    }
+
+
+def build_inputs(scale):
+    """
+    Stored input nodes of one scale.
+    """
+    size, n_frames, density = (SCALES[scale][k] for k in ("size", "frames", "density"))
+
+    science, catalog = star_field(size, density=density, seed=1)
+    series, _ = star_field_series(n_frames, size, density=density, seed=1)
+
+    positions = orm.ArrayData()
+    positions.set_array("x", catalog["x"])
+    positions.set_array("y", catalog["y"])
+
+    def masters(kind, seed):
+        return stored_frames(calibration_frames(kind, n_frames, size, seed=seed), kind)
+
+    return {
+        "bias": masters("bias", 2),
+        "dark": masters("dark", 3),
+        "flat": masters("flat", 4),
+        "science": to_fitsdata(science, science_header(), "science.fits").store(),
+        "series": stored_frames(series, "frame"),
+        "positions": positions.store(),
+    }
+
+
+def calcfunction_cases(inp):
+    """
+    (name, callable) pairs; callables receive the dict of earlier results.
+    """
+    empty = orm.Dict(dict={})
+    params = orm.Dict(dict={"combine_method": "median"})
+    image, positions = inp["science"], inp["positions"]
+
+    def apertures(name, function, geometry):
+        return (
+            name,
+            lambda res: function(image, positions, orm.Dict(dict=geometry), empty),
+        )
+
+    return [
+        (
+            "create_master_bias",
+            lambda res: cf.create_master_bias(params, **inp["bias"]),
+        ),
+        (
+            "create_master_bias_streaming",
+            lambda res: cf.create_master_bias(
+                orm.Dict(dict={"combine_mode": "streaming"}), **inp["bias"]
+            ),
+        ),
+        (
+            "create_master_dark",
+            lambda res: cf.create_master_dark(
+                res["create_master_bias"], params, **inp["dark"]
+            ),
+        ),
+        (
+            "create_master_flat",
+            lambda res: cf.create_master_flat(
+                res["create_master_bias"],
+                res["create_master_dark"],
+                params,
+                **inp["flat"],
+            ),
+        ),
+        (
+            "calibrate_science",
+            lambda res: cf.calibrate_science(
+                image,
+                res["create_master_bias"],
+                res["create_master_dark"],
+                res["create_master_flat"],
+            ),
+        ),
+        (
+            "cosmicray_lacosmic_cf",
+            lambda res: cf.cosmicray_lacosmic_cf(
+                image, orm.Dict(dict={"tile_size": 512})
+            ),
+        ),
+        ("global_background_cf", lambda res: cf.global_background_cf(image, empty)),
+        (
+            "global_background_cf_approximate",
+            lambda res: cf.global_background_cf(
+                image, orm.Dict(dict={"mode": "approximate"})
+            ),
+        ),
+        ("background_2d_cf", lambda res: cf.background_2d_cf(image, empty)),
+        (
+            "background_2d_cf_parallel",
+            lambda res: cf.background_2d_cf(image, orm.Dict(dict={"mode": "parallel"})),
+        ),
+        (
+            "subtract_background",
+            lambda res: cf.subtract_background(image, res["background_2d_cf"]),
+        ),
+        (
+            "detect_sources_cf",
+            lambda res: cf.detect_sources_cf(
+                image, orm.Dict(dict={"threshold": 50.0, "fwhm": 3.0})
+            ),
+        ),
+        (
+            "crossmatch_sources_cf",
+            lambda res: cf.crossmatch_sources_cf(
+                positions,
+                orm.Dict(dict={"fit_offset": True}),
+                detected=res["detect_sources_cf"],
+            ),
+        ),
+        (
+            "centroid_sources_cf",
+            lambda res: cf.centroid_sources_cf(image, positions, empty),
+        ),
+        (
+            "centroid_batch_cf",
+            lambda res: cf.centroid_batch_cf(image, positions, empty),
+        ),
+        (
+            "register_frames_cf",
+            lambda res: cf.register_frames_cf(options=empty, **inp["series"]),
+        ),
+        (
+            "stack_frames_cf",
+            lambda res: cf.stack_frames_cf(
+                res["register_frames_cf"], empty, **inp["series"]
+            ),
+        ),
+        apertures("circular_aperture", cf.circular_aperture_photometry_cf, {"r": 4.0}),
+        apertures(
+            "circular_annulus",
+            cf.circular_annulus_photometry_cf,
+            {"r_in": 6.0, "r_out": 9.0},
+        ),
+        apertures(
+            "elliptical_aperture",
+            cf.elliptical_aperture_photometry_cf,
+            {"a": 5.0, "b": 3.0, "theta": 0.5},
+        ),
+        apertures(
+            "elliptical_annulus",
+            cf.elliptical_annulus_photometry_cf,
+            {"a_in": 6.0, "a_out": 9.0, "b_in": 4.0, "b_out": 6.0, "theta": 0.5},
+        ),
+        apertures(
+            "rectangular_aperture",
+            cf.rectangular_aperture_photometry_cf,
+            {"w": 8.0, "h": 6.0, "theta": 0.0},
+        ),
+        apertures(
+            "rectangular_annulus",
+            cf.rectangular_annulus_photometry_cf,
+            {"w_in": 10.0, "w_out": 16.0, "h_in": 8.0, "h_out": 14.0, "theta": 0.0},
+        ),
+        apertures(
+            "local_background",
+            cf.local_background_photometry_cf,
+            {"r": 4.0, "r_in": 6.0, "r_out": 9.0},
+        ),
+        (
+            "psf_photometry_cf",
+            lambda res: cf.psf_photometry_cf(
+                image, positions, orm.Dict(dict={"fwhm": 3.0}), empty
+            ),
+        ),
+        (
+            "forced_photometry_cf",
+            lambda res: cf.forced_photometry_cf(
+                positions,
+                orm.Dict(dict={"r": 4.0}),
+                orm.Dict(dict={"max_workers": 4}),
+                **inp["series"],
+            ),
+        ),
+    ]
+
+
+def workchain_cases(inp):
+    image, positions = inp["science"], inp["positions"]
+    return [
+        (
+            "SimpleCalibrationWorkChain",
+            lambda res: run(
+                WorkflowFactory("images.reduction"),
+                bias_frames=inp["bias"],
+                dark_frames=inp["dark"],
+                flat_frames=inp["flat"],
+                science_frames=inp["series"],
+                parameters=orm.Dict(dict={}),
+            ),
+        ),
+        (
+            "BackgroundWorkChain",
+            lambda res: run(
+                WorkflowFactory("background.estimation"),
+                image=image,
+                method=orm.Str("background_2d"),
+                parameters=orm.Dict(dict={}),
+            ),
+        ),
+        (
+            "SourceDetectionWorkChain",
+            lambda res: run(
+                WorkflowFactory("centroid.detection"),
+                image=image,
+                detection_params=orm.Dict(dict={"threshold": 50.0, "fwhm": 3.0}),
+            ),
+        ),
+        (
+            "AperturePhotometryWorkChain",
+            lambda res: run(
+                WorkflowFactory("aperture.photometry"), image=image, positions=positions
+            ),
+        ),
+        (
+            "PhotometryPipelineWorkChain",
+            lambda res: run(
+                WorkflowFactory("photometry.pipeline"),
+                image=image,
+                background={
+                    "method": orm.Str("background_2d"),
+                    "parameters": orm.Dict(dict={}),
+                },
+                detection={
+                    "detection_params": orm.Dict(dict={"threshold": 50.0, "fwhm": 3.0})
+                },
+            ),
+        ),
+        (
+            "StackingWorkChain",
+            lambda res: run(
+                WorkflowFactory("photometry.stacking"), frames=inp["series"]
+            ),
+        ),
+        (
+            "LightCurveWorkChain",
+            lambda res: run(
+                WorkflowFactory("photometry.light_curve"),
+                frames=inp["series"],
+                positions=positions,
+            ),
+        ),
+    ]
+
+
+def run_scale(scale, pattern, trace_memory):
+    inputs, setup = profile(lambda: build_inputs(scale), trace_memory=False)
+    print(f"[{scale}] inputs built in {setup['wall_s']:.1f} s")
+
+    cases = [("calcfunction", case) for case in calcfunction_cases(inputs)]
+    cases += [("workchain", case) for case in workchain_cases(inputs)]
+
+    results, records = {}, []
+    for kind, (name, func) in cases:
+        if not fnmatch.fnmatch(name, pattern):
+            continue
+        try:
+            results[name], metrics = profile(lambda: func(results), trace_memory)
+            status = "ok"
+        except Exception as exc:  # Keep going, a failing case is a result too
+            metrics, status = {}, f"error: {exc!r}"
+
+        record = {"name": name, "kind": kind, "scale": scale, **SCALES[scale]}
+        record.update(metrics, status=status)
+        records.append(record)
+        print(
+            f"[{scale}] {name:<36} {metrics.get('wall_s', float('nan')):>8.3f} s "
+            f"{metrics.get('peak_alloc_mb', float('nan')):>9.1f} MB  {status}"
+        )
+
+    return records
+
+
+def environment():
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "astropy": astropy.__version__,
+        "photutils": photutils.__version__,
+    }
+
+
+def compare(records, reference_path, threshold):
+    with open(reference_path) as handle:
+        reference = {
+            (r["name"], r["scale"]): r
+            for r in json.load(handle)["results"]
+            if r.get("status") == "ok"
+        }
+
+    regressions = []
+    for record in records:
+        old = reference.get((record["name"], record["scale"]))
+        if old is None or record.get("status") != "ok":
+            continue
+        ratio = record["wall_s"] / old["wall_s"]
+        if ratio > threshold:
+            regressions.append((record["scale"], record["name"], ratio))
+
+    for scale, name, ratio in regressions:
+        print(f"REGRESSION [{scale}] {name}: {ratio:.2f}x slower")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scales", nargs="+", default=["small"], choices=SCALES)
+    parser.add_argument("--only", default="*", help="fnmatch pattern of case names")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", default=None, help="previous result file")
+    parser.add_argument("--threshold", type=float, default=1.2)
+    parser.add_argument(
+        "--no-trace-memory",
+        action="store_true",
+        help="skip tracemalloc, which slows down Python-heavy cases",
+    )
+    parser.add_argument("--profile", default=None)
+    args = parser.parse_args()
+
+    load_profile(args.profile)
+
+    records = []
+    # Cached results would measure the database, not the code
+    with disable_caching():
+        for scale in args.scales:
+            records.extend(run_scale(scale, args.only, not args.no_trace_memory))
+
+    with open(args.output, "w") as handle:
+        json.dump({"environment": environment(), "results": records}, handle, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare and compare(records, args.compare, args.threshold):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+import pytest
+
+from aiida_photometry.synthetic import star_field, to_fitsdata
+
+pytest_plugins = ["aiida.tools.pytest_fixtures"]
+
+
+@pytest.fixture
+def star_image(aiida_profile):
+    """
+    Stored FitsData of a small synthetic star field and its catalog.
+    """
+    data, catalog = star_field(128, density=1e-3, sky=100.0, seed=3)
+    return to_fitsdata(data, filename="science.fits").store(), catalog
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+from aiida import orm
+from astropy.stats import SigmaClip
+from photutils.aperture import (
+    ApertureStats,
+    CircularAnnulus,
+    CircularAperture,
+    aperture_photometry,
+)
+
+from aiida_photometry.calcfunctions import circular_aperture_photometry_cf
+from aiida_photometry.calcfunctions.aperture import (
+    MASK_PHASE_STEPS,
+    _annulus_statistics,
+    _cached_circular_photometry,
+)
+from aiida_photometry.synthetic import star_field
+
+
+def positions(n, size, seed, steps=None):
+    # Including sources whose aperture crosses the image edge
+    rng = np.random.default_rng(seed)
+    x, y = rng.uniform(-2, size + 1, (2, n))
+    if steps is not None:
+        x, y = np.round(x * steps) / steps, np.round(y * steps) / steps
+    return x, y
+
+
+@pytest.mark.parametrize("r", [0.7, 3.0, 5.5])
+def test_cached_engine_matches_photutils(r):
+    data, _ = star_field(64, density=2e-3, sky=100.0, seed=1)
+    # On the grid of mask phases the cached masks are the exact masks
+    x, y = positions(200, 64, seed=2, steps=MASK_PHASE_STEPS)
+
+    expected = aperture_photometry(data, CircularAperture(np.c_[x, y], r=r))
+    table = _cached_circular_photometry(data, x, y, [{"r": r}], False, {})
+
+    np.testing.assert_allclose(
+        table["aperture_sum"], expected["aperture_sum"], rtol=1e-12, atol=1e-9
+    )
+    np.testing.assert_array_equal(table["xcenter"].value, x)
+
+
+def test_cached_engine_phase_rounding_error():
+    data, _ = star_field(64, density=2e-3, sky=100.0, seed=3)
+    x, y = positions(200, 64, seed=4)
+    r = [{"r": 2.0}, {"r": 4.0}]
+
+    expected = [
+        aperture_photometry(data, CircularAperture(np.c_[x, y], **g))["aperture_sum"]
+        for g in r
+    ]
+    table = _cached_circular_photometry(data, x, y, r, True, {})
+
+    # Positions are rounded by at most half a phase step
+    np.testing.assert_allclose(
+        table["aperture_sum"], np.column_stack(expected), rtol=2e-2
+    )
+
+
+def test_cached_engine_calcfunction(star_image):
+    image, catalog = star_image
+    sources = orm.ArrayData()
+    sources.set_array("x", np.round(np.asarray(catalog["x"]) * 64) / 64)
+    sources.set_array("y", np.round(np.asarray(catalog["y"]) * 64) / 64)
+
+    results = [
+        circular_aperture_photometry_cf(
+            image,
+            sources,
+            orm.Dict({"r": 3.0}),
+            orm.Dict({"engine": engine, "output_format": "array"}),
+        )
+        for engine in ("photutils", "cached")
+    ]
+
+    photutils, cached = (node.get_array("aperture_sum") for node in results)
+    np.testing.assert_allclose(cached, photutils, rtol=1e-12)
+
+
+@pytest.mark.parametrize("chunk_size", [7, 4096])
+def test_annulus_statistics_match_photutils(chunk_size):
+    data, _ = star_field(64, density=2e-3, sky=100.0, seed=5)
+    x, y = positions(50, 64, seed=6)
+    annulus = CircularAnnulus(np.c_[x, y], r_in=4.0, r_out=7.5)
+
+    expected = ApertureStats(data, annulus, sigma_clip=SigmaClip(sigma=3.0, maxiters=5))
+    median, std, npix = _annulus_statistics(data, x, y, 4.0, 7.5, 3.0, 5, chunk_size)
+
+    np.testing.assert_allclose(median, expected.median, rtol=1e-12)
+    np.testing.assert_allclose(std, expected.std, rtol=1e-12)
+    np.testing.assert_array_equal(npix, expected.center_aper_area.value)
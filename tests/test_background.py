@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+from aiida import orm
+from photutils.background import Background2D, MedianBackground
+
+from aiida_photometry.calcfunctions import (
+    background_2d_cf,
+    global_background_cf,
+    subtract_background,
+)
+from aiida_photometry.calcfunctions.background import background_map
+from aiida_photometry.synthetic import star_field, to_fitsdata
+
+
+@pytest.mark.parametrize("masked", [False, True])
+def test_parallel_background_matches_background2d(aiida_profile, masked):
+    # 150 is not a multiple of the box size, so edge boxes are padded
+    data, _ = star_field(150, density=2e-3, sky=100.0, seed=5)
+    data = data.astype(float)
+    if masked:
+        # Excluded boxes, filled by interpolation
+        data[40:80, 20:70] = np.nan
+
+    image = to_fitsdata(data).store()
+    parameters = {"box_size": 25, "filter_size": 3, "max_workers": 2}
+    result = background_2d_cf(image, orm.Dict({**parameters, "mode": "parallel"}))
+
+    expected = Background2D(data, 25, filter_size=3, bkg_estimator=MedianBackground())
+    np.testing.assert_allclose(
+        result.get_array("background"), expected.background, rtol=1e-10
+    )
+    np.testing.assert_allclose(
+        result.get_array("background_rms"), expected.background_rms, rtol=1e-10
+    )
+
+
+@pytest.mark.parametrize("mode", ["background2d", "parallel"])
+def test_mesh_store_rebuilds_full_map(aiida_profile, mode):
+    # uint16 raw frames are stored as int16 with BZERO = 32768
+    data, _ = star_field(150, density=2e-3, sky=1000.0, seed=6)
+    data = np.round(data).astype(np.uint16)
+    image = to_fitsdata(data).store()
+    parameters = {"box_size": 25, "filter_size": 3, "max_workers": 2, "mode": mode}
+
+    full = background_2d_cf(image, orm.Dict(parameters))
+    mesh = background_2d_cf(image, orm.Dict({**parameters, "store": "mesh"}))
+
+    assert "background" not in mesh.get_arraynames()
+    for name in ("background", "background_rms"):
+        np.testing.assert_allclose(
+            background_map(mesh, name), full.get_array(name), rtol=1e-10
+        )
+
+    expected = data - full.get_array("background")
+    for background in (full, mesh):
+        subtracted = subtract_background(image, background).get_array()
+        np.testing.assert_allclose(subtracted, expected, rtol=1e-6, atol=1e-3)
+
+
+@pytest.mark.parametrize("sampling", ["stride", "random", "histogram"])
+def test_approximate_background_within_errors(aiida_profile, sampling):
+    data, _ = star_field(400, density=2e-3, sky=100.0, seed=7)
+    image = to_fitsdata(data).store()
+
+    exact = global_background_cf(image, orm.Dict({}))
+    parameters = {
+        "mode": "approximate",
+        "sampling": sampling,
+        "sample_size": 20000,
+        "bins": 256,
+    }
+    approximate = global_background_cf(image, orm.Dict(parameters))
+
+    # The histogram bins every pixel: only its resolution error remains.
+    # Samples scatter around the exact values by their standard errors.
+    tolerance = 1 if sampling == "histogram" else 3
+    for key in ("mean", "median", "std"):
+        error = approximate[f"{key}_err"]
+        assert abs(approximate[key] - exact[key]) < tolerance * error
@@ -0,0 +1,48 @@
+import io
+
+from aiida import orm
+
+from aiida_photometry import calcfunctions
+from aiida_photometry.caching import check_cacheable, enable_photometry_caching
+from aiida_photometry.calcfunctions import background_2d_cf
+from aiida_photometry.data.fits_data import FitsData
+from aiida_photometry.synthetic import star_field, to_fits_bytes
+
+
+def test_exports_are_calcfunctions():
+    # Adjacent strings in __all__ silently merge into names that do not exist
+    functions = {
+        name
+        for name in dir(calcfunctions)
+        if getattr(getattr(calcfunctions, name), "is_process_function", False)
+    }
+    assert all(hasattr(calcfunctions, name) for name in calcfunctions.__all__)
+    assert set(calcfunctions.__all__) == functions
+
+
+def test_calcfunctions_are_cacheable(aiida_profile):
+    assert check_cacheable() == {}
+
+
+def test_identical_files_hash_equally(aiida_profile):
+    content = to_fits_bytes(star_field(64, seed=1)[0])
+    first = FitsData(file=io.BytesIO(content), filename="night1.fits").store()
+    second = FitsData(file=io.BytesIO(content), filename="copy.fits").store()
+
+    assert first.get_content_digest() == second.get_content_digest()
+    assert first.base.caching.get_hash() == second.base.caching.get_hash()
+
+
+def test_rerun_served_from_cache(aiida_profile):
+    content = to_fits_bytes(star_field(64, seed=2)[0])
+    first = FitsData(file=io.BytesIO(content), filename="night1.fits").store()
+    second = FitsData(file=io.BytesIO(content), filename="copy.fits").store()
+    parameters = {"box_size": 16, "filter_size": 3}
+
+    with enable_photometry_caching():
+        cold = background_2d_cf(first, orm.Dict(parameters))
+        warm = background_2d_cf(second, orm.Dict(parameters))
+
+    assert not cold.creator.base.caching.is_created_from_cache
+    assert warm.creator.base.caching.is_created_from_cache
+    assert warm.creator.base.caching.get_cache_source() == cold.creator.uuid
@@ -0,0 +1,119 @@
+import ccdproc
+import numpy as np
+import pytest
+from aiida import orm
+from astropy.io import fits
+from astropy.nddata import CCDData, StdDevUncertainty
+
+from aiida_photometry.calcfunctions import (
+    create_master_bias,
+    create_master_dark,
+    create_master_flat,
+)
+from aiida_photometry.calcfunctions.calibration import (
+    _banded_median,
+    _ccdproc_calibrate,
+    _fused_calibrate,
+)
+from aiida_photometry.synthetic import to_fitsdata
+
+# Splits the 60 x 50 frames into bands of 16 rows
+STREAMING = {"combine_mode": "streaming", "mem_limit": 60000}
+
+
+def frames(level, exptime, seed, n=3):
+    rng = np.random.default_rng(seed)
+    header = fits.Header({"EXPTIME": exptime})
+    return {
+        f"frame_{i}": to_fitsdata(level + rng.normal(0, 5, (60, 50)), header).store()
+        for i in range(n)
+    }
+
+
+@pytest.mark.parametrize("rows", [1, 7, 60])
+def test_banded_median(rows):
+    rng = np.random.default_rng(rows)
+    # Ties and an even number of values
+    image = rng.integers(0, 20, (60, 50)).astype(float)
+    bands = [slice(start, start + rows) for start in range(0, 60, rows)]
+
+    median = _banded_median(lambda band: image[band].ravel(), bands, 100, n_bins=8)
+
+    assert median == np.median(image)
+
+
+@pytest.mark.parametrize("with_dark", [True, False])
+def test_streaming_combine_matches_in_memory(aiida_profile, with_dark):
+    def masters(parameters):
+        parameters = orm.Dict(parameters)
+        bias = create_master_bias(parameters, **frames(100.0, 0.0, seed=1))
+        dark = create_master_dark(bias, parameters, **frames(110.0, 10.0, seed=2))
+        flat = create_master_flat(
+            bias,
+            dark if with_dark else None,
+            parameters,
+            **frames(5000.0, 1.0, seed=3),
+        )
+        return bias, dark, flat
+
+    for in_memory, streaming in zip(masters({}), masters(STREAMING)):
+        ccd, streamed = in_memory.get_ccddata(), streaming.get_ccddata()
+        np.testing.assert_array_equal(streamed.data, ccd.data)
+        np.testing.assert_allclose(
+            streamed.uncertainty.array, ccd.uncertainty.array, rtol=1e-12
+        )
+
+
+@pytest.mark.parametrize("sigma_clip", [False, True])
+def test_streaming_combine_unsigned_frames(aiida_profile, sigma_clip):
+    rng = np.random.default_rng(4)
+    # uint16 raw frames are stored as int16 with BZERO = 32768
+    stack = rng.normal(40000, 20, (5, 60, 50)).astype(np.uint16)
+    stack[2, 10:12, 5:9] = 65000
+    nodes = {f"frame_{i}": to_fitsdata(data).store() for i, data in enumerate(stack)}
+
+    parameters = orm.Dict({**STREAMING, "sigma_clip": sigma_clip})
+    streamed = create_master_bias(parameters, **nodes).get_ccddata()
+
+    expected = ccdproc.combine(
+        [CCDData(data, unit="adu") for data in stack],
+        method="median",
+        sigma_clip=sigma_clip,
+    )
+    np.testing.assert_array_equal(streamed.data, expected.data)
+    np.testing.assert_allclose(
+        streamed.uncertainty.array, expected.uncertainty.array, rtol=1e-12
+    )
+
+
+def frame_ccd(level, seed, exptime, masked=False):
+    rng = np.random.default_rng(seed)
+    data = level + rng.normal(0, 5, (40, 30))
+    mask = None
+    if masked:
+        mask = np.zeros(data.shape, dtype=bool)
+        mask[rng.integers(0, 40, 5), rng.integers(0, 30, 5)] = True
+    uncertainty = StdDevUncertainty(np.full(data.shape, 2.0))
+    return CCDData(
+        data, unit="adu", meta={"EXPTIME": exptime}, mask=mask, uncertainty=uncertainty
+    )
+
+
+@pytest.mark.parametrize("scale_dark", [False, True])
+@pytest.mark.parametrize("masters", ["bias", "bias_dark", "bias_dark_flat"])
+def test_fused_calibration_matches_ccdproc(scale_dark, masters):
+    sci = frame_ccd(1000.0, 1, 30.0, masked=True)
+    bias = frame_ccd(100.0, 2, 0.0)
+    dark = frame_ccd(10.0, 3, 10.0, masked=True) if "dark" in masters else None
+    flat = frame_ccd(20000.0, 4, 1.0) if "flat" in masters else None
+    params = {"scale_dark": scale_dark, "band_rows": 7}
+
+    expected = _ccdproc_calibrate(sci, bias, dark, flat, params)
+    fused = _fused_calibrate(sci, bias, dark, flat, params)
+
+    np.testing.assert_array_equal(fused.data, expected.data)
+    np.testing.assert_allclose(
+        fused.uncertainty.array, expected.uncertainty.array, rtol=1e-12
+    )
+    np.testing.assert_array_equal(fused.mask, expected.mask)
+    assert fused.unit == expected.unit
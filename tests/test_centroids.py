@@ -0,0 +1,99 @@
+import warnings
+
+import numpy as np
+import pytest
+from aiida import orm
+from photutils.centroids import (
+    centroid_1dg,
+    centroid_2dg,
+    centroid_com,
+    centroid_quadratic,
+    centroid_sources,
+)
+
+from aiida_photometry.calcfunctions import detect_sources_cf
+from aiida_photometry.calcfunctions.centroids import _batched_centroids
+from aiida_photometry.synthetic import star_field, to_fitsdata
+
+
+def test_tiled_detection_matches_single_pass(star_image):
+    image, _ = star_image
+    options = {"threshold": 30.0, "fwhm": 3.0}
+
+    single = detect_sources_cf(image, orm.Dict(options))
+    tiled = detect_sources_cf(
+        image, orm.Dict({**options, "tile_size": 48, "max_workers": 2})
+    )
+
+    # Same sources in the same order; the tile offset is added after the fit
+    assert len(single.get_array("x")) > 0
+    for key in ("x", "y"):
+        np.testing.assert_allclose(
+            tiled.get_array(key), single.get_array(key), rtol=0, atol=1e-9
+        )
+
+
+def test_tiled_detection_on_unsigned_frame(aiida_profile):
+    # uint16 raw frames are stored as int16 with BZERO = 32768
+    data, _ = star_field(128, density=1e-3, sky=100.0, seed=3)
+    data = np.round(data + 1000).astype(np.uint16)
+    options = {"threshold": 30.0, "fwhm": 3.0}
+
+    single = detect_sources_cf(
+        to_fitsdata(data.astype(float)).store(), orm.Dict(options)
+    )
+    tiled = detect_sources_cf(
+        to_fitsdata(data).store(),
+        orm.Dict({**options, "tile_size": 48, "max_workers": 2}),
+    )
+
+    assert len(single.get_array("x")) > 0
+    for key in ("x", "y"):
+        np.testing.assert_allclose(
+            tiled.get_array(key), single.get_array(key), rtol=0, atol=1e-9
+        )
+
+
+@pytest.mark.parametrize(
+    "method, centroid_func",
+    [
+        ("com", centroid_com),
+        ("quadratic", centroid_quadratic),
+        ("1dg", centroid_1dg),
+        ("2dg", centroid_2dg),
+    ],
+)
+def test_batched_centroids_match_photutils(method, centroid_func):
+    # Faint stars and blends, some of whose fits fail
+    data, catalog = star_field(256, density=3e-3, sky=100.0, seed=3)
+    rng = np.random.default_rng(0)
+    x = catalog["x"] + rng.normal(0, 0.5, len(catalog["x"]))
+    y = catalog["y"] + rng.normal(0, 0.5, len(catalog["y"]))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        expected = centroid_sources(
+            data.astype(float), x, y, box_size=11, centroid_func=centroid_func
+        )
+    xc, yc, converged = _batched_centroids(data, x, y, method, 11, 2, 5)
+
+    assert converged.mean() > 0.5
+    np.testing.assert_allclose(xc[converged], expected[0][converged], atol=1e-9)
+    np.testing.assert_allclose(yc[converged], expected[1][converged], atol=1e-9)
+    # Failed fits keep the input position
+    np.testing.assert_array_equal(xc[~converged], x[~converged])
+    np.testing.assert_array_equal(yc[~converged], y[~converged])
+
+
+@pytest.mark.parametrize("method", ["1dg", "2dg"])
+def test_failed_gaussian_fits_keep_input_position(method):
+    # No star to fit: most fits fail and are flagged by the fitter
+    rng = np.random.default_rng(1)
+    data = rng.normal(100.0, 5.0, (128, 128))
+    x, y = rng.uniform(10, 118, (2, 40))
+
+    xc, yc, converged = _batched_centroids(data, x, y, method, 11, 2, 5)
+
+    assert converged.mean() < 0.4
+    np.testing.assert_array_equal(xc[~converged], x[~converged])
+    np.testing.assert_array_equal(yc[~converged], y[~converged])
@@ -0,0 +1,42 @@
+import numpy as np
+from aiida import orm
+from scipy.spatial import cKDTree
+
+from aiida_photometry.calcfunctions import crossmatch_sources_cf
+from aiida_photometry.calcfunctions.crossmatch import _nearest_matches
+
+
+def source_list(x, y):
+    sources = orm.ArrayData()
+    sources.set_array("x", np.asarray(x, dtype=float))
+    sources.set_array("y", np.asarray(y, dtype=float))
+    return sources
+
+
+def test_source_losing_its_nearest_match_takes_the_next():
+    # Both reference sources are nearest to the first catalog source, which
+    # goes to the closer one; the other falls back to its second candidate
+    ref = np.array([[0.0, 0.0], [0.5, 0.0]])
+    tree = cKDTree(np.array([[0.3, 0.0], [-0.6, 0.0]]))
+
+    index, separation = _nearest_matches(ref, tree, np.zeros(2), 1.0, 1)
+
+    np.testing.assert_array_equal(index, [1, 0])
+    np.testing.assert_allclose(separation, [0.6, 0.2])
+
+    index, _ = _nearest_matches(ref, tree, np.zeros(2), 1.0, 1, k=1)
+    np.testing.assert_array_equal(index, [-1, 0])
+
+
+def test_crossmatch_is_one_to_one(aiida_profile):
+    rng = np.random.default_rng(1)
+    x, y = rng.uniform(0, 30, (2, 200))
+    reference = source_list(x, y)
+    catalog = source_list(x + rng.normal(0, 0.2, 200), y + rng.normal(0, 0.2, 200))
+
+    matches = crossmatch_sources_cf(reference, orm.Dict({"tolerance": 1.0}), a=catalog)
+
+    index = matches.get_array("index")[0]
+    matched = index[index >= 0]
+    assert len(np.unique(matched)) == len(matched)
+    assert (matches.get_array("separation")[0][index >= 0] <= 1.0).all()
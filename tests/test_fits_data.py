@@ -0,0 +1,77 @@
+import io
+
+import numpy as np
+import pytest
+from aiida import orm
+from astropy.io import fits
+from astropy.nddata import CCDData
+from photutils.aperture import BoundingBox
+
+from aiida_photometry.calcfunctions import detect_sources_cf, global_background_cf
+from aiida_photometry.synthetic import star_field, to_fits_bytes, to_fitsdata
+from aiida_photometry.utils import _write_ccd_to_fitsdata
+
+
+@pytest.fixture
+def raw_frame(aiida_profile):
+    """
+    Unsigned 16-bit frame, stored as int16 with BZERO = 32768.
+    """
+    data = np.arange(60 * 50, dtype=np.uint16).reshape(60, 50) * 21
+    header = fits.getheader(io.BytesIO(to_fits_bytes(data)))
+    assert header["BZERO"] == 32768
+    return data, to_fitsdata(data).store()
+
+
+def test_scaled_memmap_array(raw_frame):
+    data, node = raw_frame
+
+    with node.memmap_array() as array:
+        assert array.dtype == np.uint16
+        np.testing.assert_array_equal(array, data)
+        assert not array.flags.writeable
+
+
+def test_scaled_sections(raw_frame):
+    data, node = raw_frame
+
+    section = node.get_section(section=(slice(10, 20), slice(5, 45)))
+    np.testing.assert_array_equal(section, data[10:20, 5:45])
+
+    bbox = node.get_section(bbox=BoundingBox(45, 60, 55, 70))
+    np.testing.assert_array_equal(bbox, data[55:60, 45:50])
+
+    cutout, (ixmin, iymin) = node.get_cutout(2.2, 30.0, 5)
+    assert (ixmin, iymin) == (0, 28)
+    np.testing.assert_array_equal(cutout, data[28:33, 0:5])
+
+
+def test_int16_product_round_trip(aiida_profile):
+    data, _ = star_field(128, density=1e-3, sky=100.0, seed=3)
+    ccd = CCDData(data.copy(), unit="adu")
+
+    product = _write_ccd_to_fitsdata(ccd, output={"dtype": "int16"}).store()
+    reference = to_fitsdata(data).store()
+
+    # The caller's data is not rescaled
+    np.testing.assert_array_equal(ccd.data, data)
+    # BSCALE spans the data range in 2**16 steps
+    step = np.ptp(data) / 65535
+    np.testing.assert_allclose(product.get_array(), data, atol=step)
+
+    for parameters in ({}, {"mode": "approximate", "sampling": "histogram"}):
+        expected = global_background_cf(reference, orm.Dict(parameters))
+        result = global_background_cf(product, orm.Dict(parameters))
+        for key in ("mean", "median", "std"):
+            assert result[key] == pytest.approx(expected[key], abs=step)
+
+    options = orm.Dict(
+        {"threshold": 30.0, "fwhm": 3.0, "tile_size": 48, "max_workers": 2}
+    )
+    expected = detect_sources_cf(reference, options)
+    result = detect_sources_cf(product, options)
+    # Same sources; the quantisation moves centroids by a fraction of a pixel
+    for key in ("x", "y"):
+        np.testing.assert_allclose(
+            result.get_array(key), expected.get_array(key), atol=0.02
+        )
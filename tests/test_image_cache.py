@@ -0,0 +1,60 @@
+import hashlib
+import io
+
+import numpy as np
+import pytest
+
+from aiida_photometry.data import fits_data
+from aiida_photometry.data.image_cache import (
+    disable_image_cache,
+    enable_image_cache,
+    image_cache_info,
+)
+from aiida_photometry.synthetic import to_fits_bytes, to_fitsdata
+
+
+@pytest.fixture
+def image_cache():
+    enable_image_cache(max_mb=16)
+    yield
+    disable_image_cache()
+
+
+@pytest.fixture
+def digests(monkeypatch):
+    """
+    Count the files hashed by FitsData.
+    """
+    calls = []
+
+    class Hashlib:
+        @staticmethod
+        def sha256():
+            calls.append(1)
+            return hashlib.sha256()
+
+    monkeypatch.setattr(fits_data, "hashlib", Hashlib)
+    return calls
+
+
+def test_unstored_node_hashed_once(aiida_profile, image_cache, digests):
+    node = to_fitsdata(np.arange(64.0).reshape(8, 8))
+
+    for _ in range(3):
+        np.testing.assert_array_equal(node.get_array(), np.arange(64.0).reshape(8, 8))
+
+    assert len(digests) == 1
+    assert image_cache_info()["hits"] == 2
+
+    # A new file is a new repository object, hashed again
+    node.set_file(io.BytesIO(to_fits_bytes(np.zeros((8, 8)))), filename="zeros.fits")
+    assert node.get_array().sum() == 0
+    assert len(digests) == 2
+
+
+def test_stored_digest_from_repository(aiida_profile, digests):
+    content = to_fits_bytes(np.ones((8, 8)))
+    node = to_fitsdata(np.ones((8, 8))).store()
+
+    assert node.get_content_digest() == hashlib.sha256(content).hexdigest()
+    assert digests == []
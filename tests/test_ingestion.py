@@ -0,0 +1,39 @@
+import numpy as np
+from aiida import orm
+from astropy.io import fits
+
+from aiida_photometry.ingestion import ingest_directory, query_frames
+
+
+def write_night(directory, n_bias=3, n_flat=2):
+    for i in range(n_bias):
+        header = fits.Header({"IMAGETYP": "BIAS", "EXPTIME": 0.0})
+        fits.writeto(
+            directory / f"bias_{i}.fits", np.zeros((8, 8)), header, overwrite=True
+        )
+    for i in range(n_flat):
+        header = fits.Header({"IMAGETYP": "FLAT", "EXPTIME": 2.0, "FILTER": "V"})
+        fits.writeto(
+            directory / f"flat_{i}.fits", np.ones((8, 8)), header, overwrite=True
+        )
+
+
+def test_ingest_in_batches_and_resume(aiida_profile, tmp_path):
+    write_night(tmp_path)
+
+    nodes = ingest_directory(tmp_path, group_label="night", batch_size=2)
+
+    assert len(nodes) == 5
+    assert all(node.is_stored for node in nodes)
+    assert len(orm.load_group("night").nodes) == 5
+    assert nodes[0].base.attributes.get("shape") == [8, 8]
+
+    # Files already in the group are skipped
+    write_night(tmp_path, n_bias=4, n_flat=0)
+    assert len(ingest_directory(tmp_path, group_label="night")) == 1
+
+    assert len(query_frames(imagetyp="bias", group_label="night")) == 4
+    flats = query_frames(
+        imagetyp="flat", filter_name="V", exptime=(1, 10), group_label="night"
+    )
+    assert [node.filename for node in flats] == ["flat_0.fits", "flat_1.fits"]
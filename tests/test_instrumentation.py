@@ -0,0 +1,28 @@
+import pytest
+from aiida import orm
+
+from aiida_photometry.calcfunctions import detect_sources_cf
+from aiida_photometry.instrumentation import (
+    EXTRA_KEY,
+    disable_instrumentation,
+    enable_instrumentation,
+)
+
+
+@pytest.fixture
+def instrumentation():
+    enable_instrumentation()
+    yield
+    disable_instrumentation()
+
+
+def test_memmap_reads_are_a_decode_phase(star_image, instrumentation):
+    image, _ = star_image
+    sources = detect_sources_cf(image, orm.Dict({"threshold": 30.0, "fwhm": 3.0}))
+
+    phases = sources.base.extras.get(EXTRA_KEY)["phases"]
+    assert phases["fits_decode"]["bytes_mapped"] == image.get_array().nbytes
+    assert "photutils_detect" in phases
+    for entry in phases.values():
+        assert "peak_rss_mb" not in entry
+    assert phases["total"]["peak_rss_growth_mb"] >= 0
@@ -0,0 +1,101 @@
+import io
+
+import numpy as np
+import pytest
+from aiida import orm
+from astropy.io import fits
+
+from aiida_photometry.calcfunctions import (
+    background_2d_mef_cf,
+    calibrate_science_mef,
+    detect_sources_mef_cf,
+)
+from aiida_photometry.data.fits_data import FitsData
+from aiida_photometry.synthetic import star_field, to_fitsdata
+
+
+def mosaic(n_chips=2, dtype=float):
+    """
+    Stored mosaic whose observation keywords are only in the primary header.
+    """
+    primary = fits.PrimaryHDU()
+    primary.header["IMAGETYP"] = "LIGHT"
+    primary.header["DATE-OBS"] = "2024-01-01T00:00:00"
+    primary.header["EXPTIME"] = 30.0
+    primary.header["FILTER"] = "V"
+
+    hdus = [primary]
+    for i in range(n_chips):
+        data, _ = star_field(96, density=1e-3, sky=100.0, seed=i)
+        hdus.append(fits.ImageHDU(data=data.astype(dtype), name=f"CHIP{i + 1}"))
+    hdus[-1].header["FILTER"] = "R"
+
+    buffer = io.BytesIO()
+    fits.HDUList(hdus).writeto(buffer)
+    buffer.seek(0)
+    return FitsData(file=buffer, filename="mosaic.fits").store()
+
+
+def test_extensions_inherit_primary_header(aiida_profile):
+    image = mosaic()
+
+    assert image.header["IMAGETYP"] == "LIGHT"
+    assert image.header["DATE-OBS"] == "2024-01-01T00:00:00"
+    assert [ext["fits_header"]["FILTER"] for ext in image.extensions] == ["V", "R"]
+
+    ccd = image.get_ccddata("CHIP2")
+    assert ccd.header["EXPTIME"] == 30.0
+    assert ccd.header["FILTER"] == "R"
+    assert ccd.header["EXTNAME"] == "CHIP2"
+
+
+def test_calibrate_mef_with_exposure_time_in_primary(aiida_profile):
+    image = mosaic()
+    bias = to_fitsdata(np.zeros((96, 96)), fits.Header({"EXPTIME": 0.0}))
+    dark = to_fitsdata(np.ones((96, 96)), fits.Header({"EXPTIME": 30.0}))
+
+    calibrated = calibrate_science_mef(image, bias.store(), master_dark=dark.store())
+
+    assert calibrated.is_mef
+    np.testing.assert_allclose(
+        calibrated.get_array("CHIP1"), image.get_array("CHIP1") - 1.0
+    )
+
+
+def test_single_image_masters_decoded_once(aiida_profile, monkeypatch):
+    image = mosaic(n_chips=3)
+    bias = to_fitsdata(np.zeros((96, 96)), fits.Header({"EXPTIME": 0.0})).store()
+    flat = to_fitsdata(np.full((96, 96), 2.0), fits.Header({"EXPTIME": 1.0})).store()
+
+    reads = []
+    read_ccddata = FitsData._read_ccddata
+
+    def counting(self, *args, **kwargs):
+        reads.append(self.uuid)
+        return read_ccddata(self, *args, **kwargs)
+
+    monkeypatch.setattr(FitsData, "_read_ccddata", counting)
+    calibrated = calibrate_science_mef(
+        image, bias, master_flat=flat, parameters=orm.Dict({"max_workers": 2})
+    )
+
+    assert reads.count(bias.uuid) == 1
+    assert reads.count(flat.uuid) == 1
+    for chip in ("CHIP1", "CHIP2", "CHIP3"):
+        np.testing.assert_allclose(calibrated.get_array(chip), image.get_array(chip))
+
+
+# uint16 chips are stored as int16 with BZERO = 32768
+@pytest.mark.parametrize("dtype", [float, np.uint16])
+def test_mef_chips_processed_in_workers(aiida_profile, dtype):
+    image = mosaic(dtype=dtype)
+    parameters = {"box_size": 32, "filter_size": 3, "max_workers": 2}
+
+    backgrounds = background_2d_mef_cf(image, orm.Dict(parameters))
+    sources = detect_sources_mef_cf(
+        image, orm.Dict({"threshold": 30.0, "fwhm": 3.0, "max_workers": 2})
+    )
+
+    assert sorted(backgrounds) == ["chip1", "chip2"]
+    assert sources.base.attributes.get("chips") == ["chip1", "chip2"]
+    assert set(sources.get_array("chip")) == {0, 1}
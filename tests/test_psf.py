@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+from aiida import orm
+from aiida.engine import run_get_node
+from aiida.plugins import WorkflowFactory
+
+from aiida_photometry.calcfunctions.psf import _psf_groups, _psf_photometry
+from aiida_photometry.synthetic import star_field
+
+
+def test_oversized_blends_are_split():
+    rng = np.random.default_rng(0)
+    x, y = rng.uniform(0, 40, (2, 300))
+
+    assert np.bincount(_psf_groups(x, y, 7)).max() == 300
+
+    labels = _psf_groups(x, y, 7, max_size=10)
+    sizes = np.bincount(labels)
+    assert sizes.max() <= 10
+    assert sizes.min() >= 1
+
+
+def test_split_of_coincident_stars_terminates():
+    x = np.full(30, 5.0)
+    labels = _psf_groups(x, x, 5, max_size=8)
+    assert np.bincount(labels).max() <= 8
+
+
+@pytest.mark.parametrize("model", ["gaussian", "empirical"])
+def test_psf_fit_accuracy(model):
+    data, catalog = star_field(400, density=7.5e-4, sky=100.0, seed=1)
+    x, y, flux = catalog["x"], catalog["y"], catalog["flux"]
+    # Positions of a detection, off by a few tenths of a pixel
+    rng = np.random.default_rng(2)
+    x_init, y_init = x + rng.normal(0, 0.3, len(x)), y + rng.normal(0, 0.3, len(y))
+
+    table, _ = _psf_photometry(
+        data, x_init, y_init, {"model": model, "fwhm": 3.0}, {"max_workers": 1}
+    )
+
+    # Isolated stars only fail to converge near the noise level (S/N < 5);
+    # some unresolved blends do not converge within maxiters
+    converged = np.asarray(table["converged"])
+    snr = np.asarray(table["flux_fit"] / table["flux_err"])
+    isolated = np.asarray(table["group_size"]) == 1
+    assert converged.mean() > 0.85
+    assert converged[isolated & (snr > 5)].all()
+
+    bright = isolated & (flux > 3e3)
+    flux_error = np.asarray(table["flux_fit"])[bright] / flux[bright] - 1
+    offset = np.hypot(table["x_fit"] - x, table["y_fit"] - y)[bright]
+    assert np.median(abs(flux_error)) < 0.02
+    assert np.abs(flux_error).max() < 0.07
+    assert np.median(offset) < 0.03
+
+
+def psf_photometry(image, catalog, **inputs):
+    positions = orm.ArrayData()
+    positions.set_array("x", catalog["x"])
+    positions.set_array("y", catalog["y"])
+    return run_get_node(
+        WorkflowFactory("aperture.photometry"),
+        image=image,
+        positions=positions,
+        method=orm.Str("psf"),
+        **inputs,
+    )
+
+
+def test_psf_method_defaults(star_image):
+    results, node = psf_photometry(*star_image)
+
+    assert node.is_finished_ok
+    assert isinstance(results["photometry"], orm.Dict)
+    assert results["photometry"]["psf_model"] == "gaussian"
+
+
+def test_psf_method_rejects_aperture_keys(star_image):
+    _, node = psf_photometry(*star_image, aperture=orm.Dict({"r": 2.0}))
+    assert node.exit_status == 303
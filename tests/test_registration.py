@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+from aiida import orm
+from astropy.nddata import CCDData
+
+from aiida_photometry.calcfunctions import stack_frames_cf
+from aiida_photometry.calcfunctions.registration import exposure_map
+from aiida_photometry.synthetic import science_header, star_field, to_fitsdata
+from aiida_photometry.utils import _write_ccd_to_fitsdata
+
+HIT = (32, 40)
+# Pixels of a fractionally shifted frame whose interpolation uses one pixel
+STENCIL = {"nearest": 1, "linear": 4, "cubic": 16}
+
+
+def frame(seed, hit_value=None):
+    """
+    Stored frame with a MASK extension flagging one pixel, set to hit_value.
+    """
+    data, _ = star_field(64, density=1e-3, sky=100.0, seed=seed)
+    mask = np.zeros(data.shape, dtype=bool)
+    if hit_value is not None:
+        data[HIT] = hit_value
+        mask[HIT] = True
+    ccd = CCDData(data, unit="adu", mask=mask, meta=science_header())
+    return _write_ccd_to_fitsdata(ccd).store()
+
+
+def offsets(labels, dx, dy):
+    node = orm.ArrayData()
+    node.set_array("dx", np.asarray(dx, dtype=float))
+    node.set_array("dy", np.asarray(dy, dtype=float))
+    node.base.attributes.set("labels", labels)
+    node.base.attributes.set("reference", labels[0])
+    return node.store()
+
+
+@pytest.mark.parametrize("interpolation", ["nearest", "linear", "cubic"])
+def test_masked_values_do_not_leak(aiida_profile, interpolation):
+    shifts = offsets(["a", "b"], [0.0, 0.4], [0.0, -0.3])
+    options = orm.Dict({"method": "mean", "interpolation": interpolation})
+
+    stacks = [
+        stack_frames_cf(shifts, options, a=frame(1), b=frame(2, hit_value=value))
+        for value in (1e6, 0.0)
+    ]
+
+    # A masked cosmic ray only changes which pixels the frame covers
+    first, second = (stack.get_array() for stack in stacks)
+    np.testing.assert_array_equal(first, second)
+
+    # The reference covers every pixel; the shifted frame is left out where
+    # its interpolation stencil holds the hit
+    exposure = exposure_map(stacks[0])
+    assert exposure.min() == 60.0
+    around = exposure[HIT[0] - 8 : HIT[0] + 8, HIT[1] - 8 : HIT[1] + 8]
+    assert (around == 60.0).sum() == STENCIL[interpolation]
+    assert (around == 120.0).sum() == around.size - STENCIL[interpolation]
+
+
+@pytest.mark.parametrize("method", ["mean", "median"])
+def test_stack_unsigned_frames(aiida_profile, method):
+    # uint16 raw frames are stored as int16 with BZERO = 32768
+    stack = [
+        np.round(star_field(64, density=1e-3, sky=1000.0, seed=seed)[0])
+        for seed in range(3)
+    ]
+    frames = {
+        label: to_fitsdata(data.astype(np.uint16), science_header()).store()
+        for label, data in zip("abc", stack)
+    }
+    shifts = offsets(list(frames), [0.0] * 3, [0.0] * 3)
+
+    result = stack_frames_cf(shifts, orm.Dict({"method": method}), **frames)
+
+    expected = getattr(np, method)(stack, axis=0)
+    np.testing.assert_allclose(result.get_array(), expected, rtol=1e-6)
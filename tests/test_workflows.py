@@ -0,0 +1,153 @@
+import numpy as np
+from aiida import orm
+from aiida.engine import run_get_node
+from aiida.plugins import WorkflowFactory
+
+from aiida_photometry.calcfunctions import forced_photometry_cf
+from aiida_photometry.synthetic import (
+    render_stars,
+    science_header,
+    star_field,
+    to_fitsdata,
+)
+
+
+def pipeline_inputs():
+    return {
+        "background": {
+            "method": orm.Str("background_2d"),
+            "parameters": orm.Dict(dict={"box_size": 32, "filter_size": 3}),
+        },
+        "detection": {
+            "detection_params": orm.Dict(dict={"threshold": 30.0, "fwhm": 3.0})
+        },
+        "aperture": {"aperture": orm.Dict(dict={"r": 3.0})},
+    }
+
+
+def test_photometry_pipeline(star_image):
+    image, _ = star_image
+    results, node = run_get_node(
+        WorkflowFactory("photometry.pipeline"), image=image, **pipeline_inputs()
+    )
+
+    assert node.is_finished_ok
+    assert "background" in results["background"]
+    assert len(results["detection"]["sources"].get_array("x")) > 0
+    assert "photometry" in results["aperture"]
+
+
+def test_photometry_pipeline_with_background_map(star_image):
+    image, _ = star_image
+    background = orm.ArrayData()
+    background.set_array("background", image.get_array() * 0 + 100.0)
+
+    inputs = pipeline_inputs()
+    del inputs["background"]
+    results, node = run_get_node(
+        WorkflowFactory("photometry.pipeline"),
+        image=image,
+        background_map=background,
+        **inputs,
+    )
+
+    assert node.is_finished_ok
+    assert "background" not in results
+
+
+def test_batch_pipeline(aiida_profile):
+    images = {
+        f"image_{i}": to_fitsdata(star_field(128, density=1e-3, seed=i)[0]).store()
+        for i in range(3)
+    }
+    results, node = run_get_node(
+        WorkflowFactory("photometry.batch_pipeline"),
+        images=images,
+        pipeline=pipeline_inputs(),
+        max_concurrent=orm.Int(2),
+    )
+
+    assert node.is_finished_ok
+    assert set(results["photometry"]) == set(images)
+    summary = results["summary"].get_dict()
+    assert summary["n_succeeded"] == 3
+    assert summary["n_failed"] == 0
+
+
+def test_calibration_flats_without_darks(aiida_profile):
+    rng = np.random.default_rng(0)
+
+    def frames(level, n=3, header=None):
+        return {
+            f"frame_{i}": to_fitsdata(
+                level + rng.normal(0, 1, (64, 64)), header
+            ).store()
+            for i in range(n)
+        }
+
+    science = {
+        f"science_{i}": to_fitsdata(star_field(64, seed=i)[0], science_header()).store()
+        for i in range(3)
+    }
+    results, node = run_get_node(
+        WorkflowFactory("images.reduction"),
+        bias_frames=frames(10.0),
+        flat_frames=frames(1000.0, header=science_header(exptime=1.0)),
+        science_frames=science,
+        parameters=orm.Dict(dict={"max_workers": 2}),
+    )
+
+    assert node.is_finished_ok
+    assert "master_dark" not in results
+    flat = results["master_flat"].get_array()
+    np.testing.assert_allclose(np.median(flat), 1.0, rtol=1e-3)
+    assert set(results["calibrated_frames"]) == set(science)
+
+
+def test_light_curve_known_fluxes(aiida_profile):
+    # Noise-free frames of four stars whose fluxes change between frames; the
+    # rendered profiles are cut at 4 sigma, which loses ~2e-6 of the flux
+    x = np.array([20.3, 61.7, 30.5, 74.1])
+    y = np.array([22.6, 25.2, 70.9, 73.4])
+    base = np.array([1e3, 5e3, 2e4, 8e4])
+    scales = [1.0, 0.5, 2.0]
+    # Passed out of chronological order
+    dates = ["2024-01-01T00:02:00", "2024-01-01T00:00:00", "2024-01-01T00:01:00"]
+
+    frames = {}
+    for i, (scale, date_obs) in enumerate(zip(scales, dates)):
+        data = 100.0 + render_stars(96, {"x": x, "y": y, "flux": base * scale})
+        header = science_header(date_obs=date_obs)
+        frames[f"frame_{i}"] = to_fitsdata(data, header).store()
+
+    positions = orm.ArrayData()
+    positions.set_array("x", x)
+    positions.set_array("y", y)
+
+    results, node = run_get_node(
+        WorkflowFactory("photometry.light_curve"),
+        frames=frames,
+        positions=positions,
+        aperture=orm.Dict(dict={"r": 8.0, "r_in": 12.0, "r_out": 16.0}),
+        photometry_options=orm.Dict(dict={"max_workers": 2}),
+    )
+
+    assert node.is_finished_ok
+    light_curve = results["light_curve"]
+    order = [1, 2, 0]
+    assert list(light_curve.get_array("frame")) == [f"frame_{i}" for i in order]
+    expected = np.array([base * scales[i] for i in order])
+    np.testing.assert_allclose(light_curve.get_array("flux"), expected, rtol=1e-5)
+    assert np.isfinite(light_curve.get_array("flux_err")).all()
+    np.testing.assert_allclose(np.diff(light_curve.get_array("mjd")), 1 / 1440)
+
+    # Without an annulus the sky stays in the aperture sum
+    forced = forced_photometry_cf(
+        positions=positions,
+        geometry=orm.Dict({"r": 8.0}),
+        options=orm.Dict({"max_workers": 2}),
+        **frames,
+    )
+    np.testing.assert_allclose(
+        forced.get_array("flux"), expected + 100.0 * np.pi * 8.0**2, rtol=1e-5
+    )